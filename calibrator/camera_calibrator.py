@@ -39,11 +39,10 @@ def show_checkerboard(img: np.ndarray) -> np.ndarray:
 DIM=(640, 360)
 K=np.array([[357.73227097100624, 0.0, 307.7278060660069], [0.0, 356.44733473350254, 173.55162026508373], [0.0, 0.0, 1.0]])
 D=np.array([[-0.09720157189831408], [-0.005837301167328796], [-0.007848844103543036], [0.0028272917117362056]])
+# the remap tables only depend on the calibration, so they're built once, not per frame
+map1, map2 = cv.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv.CV_16SC2)
 def undistort(img: np.ndarray) -> np.ndarray:
-    h,w = img.shape[:2]
-    map1, map2 = cv.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv.CV_16SC2)
-    undistorted_img = cv.remap(img, map1, map2, interpolation=cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT)
-    return undistorted_img
+    return cv.remap(img, map1, map2, interpolation=cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT)
 
 class CaptureCamera(Widget):
     playback = StringProperty("Pause")
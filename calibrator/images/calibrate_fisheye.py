@@ -61,10 +61,10 @@ import sys
     f.write("K=np.array(" + str(K.tolist()) + ")\n")
     f.write("D=np.array(" + str(D.tolist()) + ")\n")
     f.write("""
+map1, map2 = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv2.CV_16SC2)
+
 def undistort(img_path):
     img = cv2.imread(img_path)
-    h,w = img.shape[:2]
-    map1, map2 = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv2.CV_16SC2)
     undistorted_img = cv2.remap(img, map1, map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
     cv2.imshow("undistorted", undistorted_img)
     cv2.waitKey(0)
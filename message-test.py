@@ -49,8 +49,9 @@ image = cv.imread("demo.jpg")
 msg = format_frame(image)
 buf = BufferedSocket(msg)
 print(len(buf.data))
-out_image = parse_frame(buf)
-assert out_image is not None
+res = parse_frame(buf)
+assert res is not None
+out_image, _header = res
 assert np.array_equal(image, out_image)
 print("format_frame and parse_frame are inverse operations")
 
@@ -68,7 +69,7 @@ for i in range(1000):
     match = random_match()
     msg = format_data([match])
     buf = BufferedSocket(msg)
-    out_match = parse_data(buf)
+    out_match, _header = parse_data(buf)
     assert len(out_match) == 1
     assert match_equal(match, out_match[0])
     print(f"\r{(i+1) / 10}% complete", end="")
@@ -79,7 +80,7 @@ for i in range(100):
     matches = [random_match() for _ in range(match_count)]
     msg = format_data(matches)
     buf = BufferedSocket(msg)
-    out_match = parse_data(buf)
+    out_match, _header = parse_data(buf)
     assert len(out_match) == match_count
     assert all(match_equal(matches[i], out_match[i]) for i in range(match_count))
     print(f"\r{(i+1)}% complete", end="")
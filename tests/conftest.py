@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# the repository isn't installed as a package, so the tests import it from the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vistream.server import MatchStream
+from vistream.socket_pool import SocketPool
+
+
+@pytest.fixture
+def stream_port() -> int:
+    """The port to start a `MatchStream` on, from a socket pool of its own that's collapsed again
+    after the test.
+    """
+    port = 16240
+    MatchStream.socket_pool = SocketPool(port, port + 9, lock_dir=None)
+    yield port
+    MatchStream.socket_pool.collapse()
@@ -0,0 +1,81 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from vistream.buffer_pool import BufferPool
+from vistream.frame_limiter import FrameSequencer
+from vistream.simcam import ImageDirectoryCamera
+
+
+def test_free_buffers_are_reused():
+    pool = BufferPool(2)
+    first = pool.acquire((4, 4, 3))
+    first_id = id(first)
+    del first
+    pool.acquire((4, 4, 3))
+    # round robin, so the other buffer comes first, and then the first one again
+    assert id(pool.acquire((4, 4, 3))) == first_id
+    assert pool.overflow_count == 0
+
+
+def test_held_buffers_are_never_handed_out():
+    pool = BufferPool(3)
+    held = [pool.acquire((8, 8)) for _ in range(3)]
+    for i, buffer in enumerate(held):
+        buffer[:] = i
+    extra = pool.acquire((8, 8))
+    assert all(extra is not b for b in held)
+    assert pool.overflow_count == 1
+    extra[:] = 99
+    assert [int(b[0, 0]) for b in held] == [0, 1, 2]
+    assert pool.in_use() == 3
+
+
+def test_views_keep_buffers_in_use():
+    pool = BufferPool(1)
+    view = pool.acquire((8, 8))[2:4]
+    assert pool.in_use() == 1
+    assert not np.shares_memory(pool.acquire((8, 8)), view)
+    del view
+    assert pool.in_use() == 0
+
+
+def test_released_buffer_comes_back():
+    pool = BufferPool(2)
+    a = pool.acquire((4, 4))
+    b = pool.acquire((4, 4))
+    a_id = id(a)
+    del a
+    assert id(pool.acquire((4, 4))) == a_id
+    assert pool.overflow_count == 0
+    del b
+
+
+@pytest.mark.parametrize("shape, dtype", [((4, 4), np.uint8), ((4, 4, 3), np.uint8), ((4, 4), np.float32)])
+def test_buffers_follow_the_requested_layout(shape, dtype):
+    pool = BufferPool(1)
+    pool.acquire((2, 2))
+    buffer = pool.acquire(shape, dtype)
+    assert buffer.shape == shape and buffer.dtype == dtype
+
+
+def test_pool_needs_a_buffer():
+    with pytest.raises(ValueError):
+        BufferPool(0)
+
+
+def test_camera_frames_stay_intact_while_held(tmp_path):
+    for i in range(3):
+        cv.imwrite(str(tmp_path / f"{i}.png"), np.full((16, 16, 3), 50 * (i + 1), dtype=np.uint8))
+    cam = ImageDirectoryCamera(str(tmp_path), fps=200)
+    try:
+        frames = FrameSequencer(cam)
+        # more than the camera has buffers, so some of them have to come from elsewhere
+        held = [frames.get_frame(timeout=2) for _ in range(8)]
+        values = [int(f[0, 0, 0]) for f in held]
+        for _ in range(8):
+            frames.get_frame(timeout=2)
+        assert [int(f[0, 0, 0]) for f in held] == values
+        assert all((f == f[0, 0, 0]).all() for f in held)
+    finally:
+        cam.stop()
@@ -0,0 +1,117 @@
+import time
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from vistream.change_detector import ChangeDetector
+from vistream.client import FrameStreamClient
+from vistream.message import REPEAT
+from vistream.server import MatchStream, EncodingOptions
+from vistream.simcam import ImageDirectoryCamera
+
+
+def _scene(level: int = 100) -> np.ndarray:
+    return np.full((240, 320, 3), level, dtype=np.uint8)
+
+
+def _wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_a_static_scene_is_unchanged():
+    detector = ChangeDetector(threshold=3.0)
+    frame = _scene()
+    assert detector.changed(detector.thumbnail(frame), now=0)
+    # a copy is still the same scene, down to the last level
+    for t in range(1, 10):
+        assert not detector.changed(detector.thumbnail(frame.copy()), now=t * 0.05)
+
+
+def test_a_changed_region_counts():
+    detector = ChangeDetector(threshold=3.0)
+    frame = _scene()
+    detector.changed(detector.thumbnail(frame), now=0)
+    # a 40x40 patch is a few thumbnail cells, and the other 700 or so don't dilute it
+    frame[100:140, 160:200] = 160
+    assert detector.changed(detector.thumbnail(frame), now=0.1)
+    # and that's the new reference
+    assert not detector.changed(detector.thumbnail(frame), now=0.2)
+
+
+@pytest.mark.parametrize("threshold", [0.0, 3.0, 10.0])
+def test_changes_count_once_they_exceed_the_threshold(threshold):
+    detector = ChangeDetector(threshold=threshold)
+    detector.changed(detector.thumbnail(_scene(100)), now=0)
+    assert not detector.changed(detector.thumbnail(_scene(100 + int(threshold))), now=0.1)
+    assert not detector.changed(detector.thumbnail(_scene(100 - int(threshold))), now=0.2)
+    assert detector.changed(detector.thumbnail(_scene(101 + int(threshold))), now=0.3)
+
+
+def test_slow_drift_adds_up():
+    detector = ChangeDetector(threshold=3.0)
+    detector.changed(detector.thumbnail(_scene(100)), now=0)
+    # every step is within the threshold of the last, but not of the reference
+    assert [detector.changed(detector.thumbnail(_scene(100 + i)), now=i * 0.1) for i in range(1, 5)] == [False, False, False, True]
+
+
+def test_unchanged_keys_are_reported_again_after_max_repeat_age():
+    detector = ChangeDetector(threshold=3.0, max_repeat_age=1.0)
+    thumbnail = detector.thumbnail(_scene())
+    assert detector.changed(thumbnail, key="a", now=0)
+    assert detector.changed(thumbnail, key="b", now=0.5)
+    assert not detector.changed(thumbnail, key="a", now=0.9)
+    assert detector.changed(thumbnail, key="a", now=1.0)
+    assert not detector.changed(thumbnail, key="b", now=1.0)
+
+    detector.forget(["a"])
+    assert detector.changed(thumbnail, key="b", now=1.1)
+
+
+def test_negative_threshold():
+    with pytest.raises(ValueError):
+        ChangeDetector(threshold=-1)
+
+
+def _stream(images: list[np.ndarray], directory, port: int) -> tuple[MatchStream, FrameStreamClient]:
+    for i, image in enumerate(images):
+        cv.imwrite(str(directory / f"{i}.png"), image)
+    stream = MatchStream(ImageDirectoryCamera(str(directory), fps=50), port, encoding=EncodingOptions(change_threshold=3.0, max_repeat_age=10.0))
+    stream.start()
+    return stream, FrameStreamClient("127.0.0.1", port)
+
+
+def test_a_static_scene_streams_as_repeats(tmp_path, stream_port):
+    stream, client = _stream([_scene()], tmp_path, stream_port)
+    try:
+        client.start()
+        assert _wait_for(lambda: client.received >= 10)
+        stats = stream.encode_stats()
+        assert stats["encodes"] == 1 and stats["repeats"] >= 9
+        # the client keeps showing the one frame it got
+        assert client.latest_header.kind == REPEAT
+        assert client.latest_result.shape == (240, 320, 3)
+    finally:
+        client.stop()
+        stream.stop()
+        stream.source.stop()
+
+
+def test_a_changed_region_is_encoded_for_real(tmp_path, stream_port):
+    changed = _scene()
+    changed[100:140, 160:200] = 160
+    stream, client = _stream([_scene(), changed], tmp_path, stream_port)
+    try:
+        client.start()
+        assert _wait_for(lambda: client.received >= 10)
+        stats = stream.encode_stats()
+        assert stats["repeats"] == 0 and stats["encodes"] >= 10
+    finally:
+        client.stop()
+        stream.stop()
+        stream.source.stop()
@@ -0,0 +1,158 @@
+import time
+
+import pytest
+
+from typing import Optional
+
+from vistream.client_writer import ClientWriter, DROP_OLDEST, DROP_NEWEST, DISCONNECT
+
+
+class _Socket:
+    """Takes at most `room` bytes per call, and raises `BlockingIOError` once it's full (or has
+    taken `calls` sends), like a non-blocking socket whose buffer only has so much space.
+    """
+    def __init__(self, room: int = 1 << 20, calls: Optional[int] = None):
+        self.room = room
+        self.calls = calls
+        self.received = bytearray()
+        self.full = False
+        self.closed = False
+
+    def setblocking(self, blocking: bool):
+        pass
+
+    def fileno(self) -> int:
+        return -1
+
+    def send(self, data) -> int:
+        return self.sendmsg([data])
+
+    def sendmsg(self, buffers) -> int:
+        if self.full or self.calls == 0:
+            raise BlockingIOError()
+        if self.calls is not None:
+            self.calls -= 1
+        data = b"".join(bytes(b) for b in buffers)[:self.room]
+        self.received.extend(data)
+        return len(data)
+
+    def shutdown(self, how: int):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_messages_go_out_whole_and_in_order():
+    sock = _Socket()
+    writer = ClientWriter(sock, max_queue=4)
+    writer.enqueue(b"one")
+    writer.enqueue([memoryview(b"tw"), memoryview(b""), memoryview(b"o")])
+    assert writer.pump()
+    assert bytes(sock.received) == b"onetwo"
+    assert not writer.pending()
+    assert writer.stats() == {"sent": 2, "dropped": 0, "queued": 0, "bytes_sent": 6}
+
+
+def test_partial_sends_pick_up_where_they_left_off():
+    sock = _Socket(room=3)
+    writer = ClientWriter(sock, max_queue=4)
+    writer.enqueue([memoryview(b"head"), memoryview(b"er"), memoryview(b"payload")])
+    writer.enqueue(b"next")
+    writer.pump()
+    # the socket takes three bytes at a time, so each message ends partway through a call
+    assert bytes(sock.received) == b"headerpayloadnext"
+    assert writer.sent == 2
+
+
+def test_nothing_is_lost_when_the_socket_fills_up():
+    sock = _Socket(room=5)
+    writer = ClientWriter(sock, max_queue=4)
+    writer.enqueue(b"0123456789")
+    sock.full = True
+    writer.pump()
+    assert writer.pending()
+    sock.full = False
+    writer.pump()
+    assert bytes(sock.received) == b"0123456789"
+
+
+def test_started_messages_are_never_dropped():
+    # a little of the first message goes out, and then the socket is full
+    sock = _Socket(room=2, calls=1)
+    writer = ClientWriter(sock, max_queue=1, policy=DROP_OLDEST)
+    writer.enqueue(b"first")
+    writer.pump()
+    assert bytes(sock.received) == b"fi"
+    writer.enqueue(b"second")
+    writer.enqueue(b"third")
+    sock.room, sock.calls = 100, None
+    writer.pump()
+    # "first" had started, so it's finished, and "second" made way for "third"
+    assert bytes(sock.received) == b"firstthird"
+    assert writer.dropped == 1
+
+
+def test_drop_oldest_keeps_the_newest():
+    sock = _Socket()
+    sock.full = True
+    writer = ClientWriter(sock, max_queue=2, policy=DROP_OLDEST)
+    for msg in (b"a", b"b", b"c", b"d"):
+        writer.enqueue(msg)
+    sock.full = False
+    writer.pump()
+    assert bytes(sock.received) == b"cd"
+    assert writer.dropped == 2
+
+
+def test_drop_newest_keeps_the_oldest():
+    sock = _Socket()
+    writer = ClientWriter(sock, max_queue=2, policy=DROP_NEWEST)
+    for msg in (b"a", b"b", b"c", b"d"):
+        writer.enqueue(msg)
+    writer.pump()
+    assert bytes(sock.received) == b"ab"
+    assert writer.dropped == 2
+
+
+def test_disconnect_after_stalling():
+    sock = _Socket()
+    sock.full = True
+    writer = ClientWriter(sock, max_queue=2, policy=DISCONNECT, stall_timeout=0.05)
+    for msg in (b"a", b"b", b"c"):
+        writer.enqueue(msg)
+    assert writer.dropped == 1
+    assert writer.pump()
+    time.sleep(0.1)
+    assert not writer.pump()
+    assert writer.closed and sock.closed
+    # closed writers take nothing more
+    writer.enqueue(b"d")
+    assert not writer.pending()
+
+
+def test_idle_clients_are_not_stalled():
+    sock = _Socket()
+    writer = ClientWriter(sock, policy=DISCONNECT, stall_timeout=0.05)
+    time.sleep(0.1)
+    writer.enqueue(b"a")
+    assert writer.stalled_for() < 0.05
+    assert writer.pump()
+
+
+def test_failed_sends_close_the_client():
+    sock = _Socket()
+    def broken(buffers):
+        raise ConnectionResetError()
+    sock.sendmsg = broken
+    sock.send = lambda data: broken([data])
+    writer = ClientWriter(sock)
+    writer.enqueue(b"a")
+    assert not writer.pump()
+    assert writer.closed
+
+
+@pytest.mark.parametrize("options", [{"policy": "drop_everything"}, {"max_queue": 0}])
+def test_invalid_settings(options):
+    with pytest.raises(ValueError):
+        ClientWriter(_Socket(), **options)
@@ -0,0 +1,112 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from vistream import cvcam
+
+
+IMPORT_PROBES = """
+import glob, sys
+import cv2
+
+probes = []
+def spy(name, original):
+    def call(*args, **kwargs):
+        probes.append(name)
+        return original(*args, **kwargs)
+    return call
+cv2.VideoCapture = spy("VideoCapture", cv2.VideoCapture)
+glob.glob = spy("glob", glob.glob)
+
+import vistream.cvcam
+print(probes)
+"""
+
+
+def test_importing_doesnt_look_for_cameras():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", IMPORT_PROBES], cwd=root, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
+
+
+class _Devices:
+    """Stands in for the video nodes and their capabilities, and remembers what was asked."""
+    def __init__(self, sysfs: list[int], dev: list[int], capture: set[int]):
+        self.sysfs = sysfs
+        self.dev = dev
+        self.capture = capture
+        self.listed = []
+        self.queried = []
+
+    def glob(self, pattern: str) -> list[str]:
+        self.listed.append(pattern)
+        if pattern.startswith("/sys/"):
+            return [f"/sys/class/video4linux/video{i}" for i in self.sysfs]
+        return [f"/dev/video{i}" for i in self.dev]
+
+    def is_capture_device(self, index: int) -> bool:
+        self.queried.append(index)
+        return index in self.capture
+
+
+@pytest.fixture
+def devices(monkeypatch) -> _Devices:
+    # two UVC cameras, each with a metadata node after it
+    devices = _Devices(sysfs=[3, 0, 1, 2], dev=[0, 1, 2, 3], capture={0, 2})
+    monkeypatch.setattr(cvcam, "glob", devices.glob)
+    monkeypatch.setattr(cvcam, "_is_capture_device", devices.is_capture_device)
+    monkeypatch.setattr(cvcam, "_probe_cameras", lambda: pytest.fail("probed devices on Linux"))
+    monkeypatch.setattr(cvcam.sys, "platform", "linux")
+    monkeypatch.setattr(cvcam, "_camera_cache", None)
+    monkeypatch.setattr(cvcam, "_claimed_cameras", set())
+    return devices
+
+
+def test_cameras_are_found_on_first_use_only(devices):
+    assert devices.listed == [] and devices.queried == []
+    assert cvcam.CVCamera.possible_cameras == [0, 2]
+    assert devices.listed == ["/sys/class/video4linux/video*"]
+    assert devices.queried == [0, 1, 2, 3]
+
+    # cached from then on
+    assert cvcam.CVCamera.possible_cameras == [0, 2]
+    assert cvcam.detect_cameras() == [0, 2]
+    assert len(devices.listed) == 1 and len(devices.queried) == 4
+
+    # until asked to look again
+    devices.sysfs.append(4)
+    devices.capture.add(4)
+    assert cvcam.detect_cameras(refresh=True) == [0, 2, 4]
+    assert len(devices.listed) == 2
+
+
+def test_dev_is_listed_without_sysfs(devices):
+    devices.sysfs.clear()
+    assert cvcam.detect_cameras() == [0, 2]
+    assert devices.listed == ["/sys/class/video4linux/video*", "/dev/video*"]
+
+
+def test_claimed_cameras_arent_offered(devices):
+    cvcam._claimed_cameras.add(0)
+    assert cvcam.detect_cameras() == [2]
+    cvcam._claimed_cameras.discard(0)
+    assert cvcam.detect_cameras() == [0, 2]
+    assert len(devices.queried) == 4
+
+
+def test_other_platforms_probe_on_first_use_only(monkeypatch):
+    probes = []
+    def probe() -> list[int]:
+        probes.append(1)
+        return [0]
+    monkeypatch.setattr(cvcam, "_probe_cameras", probe)
+    monkeypatch.setattr(cvcam.sys, "platform", "darwin")
+    monkeypatch.setattr(cvcam, "_camera_cache", None)
+    monkeypatch.setattr(cvcam, "_claimed_cameras", set())
+    assert probes == []
+    assert cvcam.CVCamera.possible_cameras == [0]
+    assert cvcam.detect_cameras() == [0]
+    assert probes == [1]
@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+import pytest
+
+from vistream.camera import FrameInfo
+from vistream.client import FrameStreamClient
+from vistream.encode_cache import EncodeCache
+from vistream.message import StreamProfile, JPEG, PNG
+from vistream.server import MatchStream
+from vistream.simcam import PatternCamera
+
+
+@pytest.fixture
+def frame() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+
+
+def test_the_same_profile_shares_one_encode(frame):
+    cache = EncodeCache()
+    info = FrameInfo(1, 10.0)
+    first = cache.get(frame, info, StreamProfile(None, JPEG, 80))
+    # an equal profile is the same key, however it was made
+    again = cache.get(frame, info, StreamProfile(None, JPEG, 80))
+    assert again is first
+    assert (cache.encodes, cache.hits, len(cache)) == (1, 1, 1)
+
+
+@pytest.mark.parametrize("other", [StreamProfile(None, JPEG, 50), StreamProfile((32, 24), JPEG, 80), StreamProfile(None, PNG), StreamProfile(None, JPEG, 80, max_fps=10)])
+def test_different_profiles_dont_collide(frame, other):
+    cache = EncodeCache()
+    info = FrameInfo(1, 10.0)
+    profile = StreamProfile(None, JPEG, 80)
+    encoded = cache.get(frame, info, profile)
+    assert cache.get(frame, info, other) is not encoded
+    assert (cache.encodes, cache.hits, len(cache)) == (2, 0, 2)
+    # and each still gets its own back
+    assert np.array_equal(cache.get(frame, info, profile), profile.encode(frame))
+    assert np.array_equal(cache.get(frame, info, other), other.encode(frame))
+    assert cache.hits == 2
+
+
+def test_different_frames_dont_collide(frame):
+    cache = EncodeCache()
+    profile = StreamProfile(None, PNG)
+    first = cache.get(frame, FrameInfo(1, 10.0), profile)
+    second = cache.get(255 - frame, FrameInfo(2, 10.1), profile)
+    assert not np.array_equal(first, second)
+    assert (cache.encodes, cache.hits) == (2, 0)
+
+
+def test_old_frames_age_out():
+    cache = EncodeCache(max_age=0.5, max_entries=4)
+    profile = StreamProfile(None, PNG)
+    frame = np.zeros((8, 8), dtype=np.uint8)
+    for i in range(3):
+        cache.get(frame, FrameInfo(i, 10.0 + 0.3 * i), profile)
+    # 10.0 is more than max_age before 10.6
+    assert len(cache) == 2
+    cache.get(frame, FrameInfo(0, 10.0), profile)
+    assert (cache.encodes, cache.hits) == (4, 0)
+
+    for i in range(10):
+        cache.get(frame, FrameInfo(100 + i, 20.0), profile)
+    assert len(cache) == 4
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_negative_max_age():
+    with pytest.raises(ValueError):
+        EncodeCache(max_age=-1)
+
+
+def test_streams_sharing_a_cache_encode_each_frame_once(stream_port):
+    cam = PatternCamera((64, 48), "shapes", fps=30)
+    cache = EncodeCache()
+    streams = [MatchStream(cam, stream_port + 2 * i, encode_cache=cache) for i in range(2)]
+    clients = []
+    try:
+        for s in streams:
+            s.start()
+        clients = [FrameStreamClient("127.0.0.1", stream_port + 2 * i) for i in range(2)]
+        for c in clients:
+            c.start()
+        deadline = time.monotonic() + 5
+        while min(c.received for c in clients) < 10 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert min(c.received for c in clients) >= 10
+        # both streams report the cache's own counts
+        assert streams[0].encode_stats() == streams[1].encode_stats()
+        stats = cache.encodes, cache.hits
+        assert stats[1] >= 5 and stats[0] < sum(c.received for c in clients)
+    finally:
+        for c in clients:
+            c.stop()
+        for s in streams:
+            s.stop()
+        cam.stop()
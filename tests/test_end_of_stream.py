@@ -0,0 +1,102 @@
+import time
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from vistream.camera import ProcessedCamera, BGR, GRAY, YUV420
+from vistream.camera_group import CameraGroup
+from vistream.frame_limiter import FrameSequencer
+from vistream.layers import ColorConvertLayer, ResizeLayer
+from vistream.process_camera import ProcessPoolCamera
+from vistream.simcam import ImageDirectoryCamera
+
+FRAME_COUNT = 5
+
+
+@pytest.fixture
+def images(tmp_path) -> str:
+    for i in range(FRAME_COUNT):
+        cv.imwrite(str(tmp_path / f"{i}.png"), np.full((24, 32, 3), 40 * (i + 1), dtype=np.uint8))
+    return str(tmp_path)
+
+
+def _drain(camera) -> list[np.ndarray]:
+    # must end on its own, rather than time out on every frame after the last
+    frames = []
+    sequencer = FrameSequencer(camera)
+    started = time.monotonic()
+    while (frame := sequencer.get_frame(timeout=5)) is not None:
+        frames.append(frame)
+        assert time.monotonic() - started < 10
+    return frames
+
+
+def test_simcam_stops_after_the_last_image(images):
+    cam = ImageDirectoryCamera(images, fps=100, loop=False)
+    frames = _drain(cam)
+    assert 0 < len(frames) <= FRAME_COUNT
+    assert not cam.is_capturing()
+    assert cam.wait_for_frame(cam.frame_id(), timeout=1) is None
+    cam.stop()
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_processed_camera_stops_with_its_source(images, pipelined):
+    cam = ProcessedCamera(ImageDirectoryCamera(images, fps=100, loop=False), pipelined=pipelined)
+    cam.add_layer(ResizeLayer((16, 12)))
+    cam.add_layer(ColorConvertLayer(cv.COLOR_BGR2GRAY))
+    frames = _drain(cam)
+    assert len(frames) > 0
+    assert all(f.shape == (12, 16) for f in frames[1:])
+    assert not cam.is_capturing()
+    # waiting on a stopped camera returns straight away
+    started = time.monotonic()
+    assert cam.wait_for_frame(cam.frame_id(), timeout=2) is None
+    assert time.monotonic() - started < 1
+    cam.stop()
+
+
+def test_processed_camera_reports_what_its_layers_output(images):
+    cam = ProcessedCamera(ImageDirectoryCamera(images, fps=100, loop=False))
+    cam.add_layer(ColorConvertLayer(cv.COLOR_BGR2GRAY))
+    frames = _drain(cam)
+    assert frames[-1].ndim == 2
+    assert cam.pixel_formats()[0] == GRAY
+    (gray, bgr, yuv), _ = cam.get_frame_as([GRAY, BGR, YUV420])
+    assert gray.shape == (24, 32) and bgr.shape == (24, 32, 3) and yuv.shape == (36, 32)
+    cam.stop()
+
+
+def test_process_pool_camera_stops_with_its_source(images):
+    cam = ProcessPoolCamera(ImageDirectoryCamera(images, fps=20, loop=False), [ResizeLayer((16, 12))], workers=2)
+    try:
+        frames = _drain(cam)
+        assert len(frames) > 0
+        assert all(f.shape == (12, 16, 3) for f in frames)
+        assert not cam.is_capturing()
+        assert cam.wait_for_frame(cam.frame_id(), timeout=1) is None
+    finally:
+        cam.stop()
+    assert all(not p.is_alive() for p in cam.workers)
+
+
+def test_process_pool_camera_stops_when_its_layers_fail(images):
+    # a resize to nothing fails on the very first frame, which is run locally
+    cam = ProcessPoolCamera(ImageDirectoryCamera(images, fps=20, loop=False), [ResizeLayer((0, 0))], workers=1)
+    try:
+        assert _drain(cam) == []
+        assert not cam.is_capturing()
+    finally:
+        cam.stop()
+
+
+def test_camera_group_stops_with_a_member(images):
+    group = CameraGroup([ImageDirectoryCamera(images, fps=50, loop=False), ImageDirectoryCamera(images, fps=50)], tolerance=0.05)
+    frames = _drain(group)
+    assert len(frames) > 0
+    assert all(len(f) == 2 for f in frames)
+    assert not group.is_capturing()
+    (gray,), _ = group.get_frame_as([GRAY])
+    assert [f.shape for f in gray] == [(24, 32), (24, 32)]
+    group.stop()
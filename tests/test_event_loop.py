@@ -0,0 +1,162 @@
+import os
+import socket
+import time
+from threading import Condition, Event
+
+import pytest
+
+from typing import Any, Callable
+
+from vistream.client_writer import ClientWriter
+from vistream.event_loop import EventLoop
+
+
+def _on_loop(loop: EventLoop, f: Callable[..., Any], *args: Any) -> Any:
+    # runs `f` on the loop thread, the only place clients may be touched, and waits for it
+    done = Event()
+    result = []
+    def call():
+        result.append(f(*args))
+        done.set()
+    loop.call_soon(call)
+    assert done.wait(5)
+    return result[0]
+
+
+class _Server:
+    """Accepts clients on a loop and keeps track of them, the way a stream does."""
+    def __init__(self, loop: EventLoop):
+        self.loop = loop
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.clients = []
+        self.closed = []
+        self.received = []
+        self.changed = Condition()
+        _on_loop(loop, loop.add_listener, self.listener, self._accept)
+
+    def _accept(self, sock: socket.socket):
+        writer = ClientWriter(sock, max_queue=4)
+        self.loop.add_client(writer, self._closed, self._data)
+        with self.changed:
+            self.clients.append(writer)
+            self.changed.notify_all()
+
+    def _closed(self, writer: ClientWriter):
+        with self.changed:
+            self.closed.append(writer)
+            self.changed.notify_all()
+
+    def _data(self, writer: ClientWriter, data: bytes):
+        with self.changed:
+            self.received.append((writer, data))
+            self.changed.notify_all()
+
+    def wait_for(self, condition: Callable[[], bool]) -> bool:
+        with self.changed:
+            return self.changed.wait_for(condition, timeout=5)
+
+    def connect(self) -> socket.socket:
+        count = len(self.clients)
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        assert self.wait_for(lambda: len(self.clients) > count)
+        return sock
+
+
+def _receive(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            break
+        data.extend(chunk)
+    return bytes(data)
+
+
+@pytest.fixture
+def loop():
+    loop = EventLoop()
+    loop.acquire()
+    yield loop
+    loop.release()
+
+
+def test_accepted_clients_can_talk_both_ways(loop):
+    server = _Server(loop)
+    client = server.connect()
+    writer = server.clients[0]
+    client.sendall(b"hello")
+    assert server.wait_for(lambda: b"".join(d for _, d in server.received) == b"hello")
+    assert server.received[0][0] is writer
+
+    _on_loop(loop, loop.send, writer, b"welcome")
+    assert _receive(client, 7) == b"welcome"
+    assert writer.stats()["sent"] == 1
+    client.close()
+    server.listener.close()
+
+
+def test_clients_are_served_independently(loop):
+    server = _Server(loop)
+    clients = [server.connect() for _ in range(5)]
+    writers = list(server.clients)
+    for i, writer in enumerate(writers):
+        _on_loop(loop, loop.send, writer, f"client {i}".encode())
+    for i, client in enumerate(clients):
+        assert _receive(client, 8) == f"client {i}".encode()
+
+    # one hanging up leaves the others as they were
+    clients[2].close()
+    assert server.wait_for(lambda: server.closed == [writers[2]])
+    for i in (0, 1, 3, 4):
+        _on_loop(loop, loop.send, writers[i], b"still here")
+        assert _receive(clients[i], 10) == b"still here"
+    for i in (0, 1, 3, 4):
+        clients[i].close()
+    server.listener.close()
+
+
+def test_clients_hanging_up_mid_frame_are_cleaned_up(loop):
+    server = _Server(loop)
+    client = server.connect()
+    writer = server.clients[0]
+    # far more than the socket buffers hold, so the frame is still going out when the client leaves
+    _on_loop(loop, loop.send, writer, bytes(32 << 20))
+    assert len(_receive(client, 1000)) == 1000
+    client.close()
+
+    assert server.wait_for(lambda: server.closed == [writer])
+    assert writer.closed and writer.sock.fileno() == -1
+    assert writer.stats()["sent"] == 0
+    assert _on_loop(loop, lambda: writer in loop._clients) is False
+    # sending to a client that's gone is quietly ignored
+    _on_loop(loop, loop.send, writer, b"too late")
+    server.listener.close()
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to list open file descriptors")
+def test_stopping_closes_every_client():
+    loop = EventLoop()
+    loop.acquire()
+    server = _Server(loop)
+    before = set(os.listdir("/proc/self/fd"))
+    clients = [server.connect() for _ in range(3)]
+    # one with something still waiting to go out, too
+    _on_loop(loop, loop.send, server.clients[0], bytes(32 << 20))
+    loop.release()
+
+    assert not loop.loop_thread.is_alive()
+    assert sorted(map(id, server.closed)) == sorted(map(id, server.clients))
+    assert all(w.closed for w in server.clients)
+    for client in clients:
+        client.settimeout(5)
+        while len(client.recv(1 << 20)) > 0:
+            pass
+        client.close()
+    # the accepted sockets were the only new descriptors, and they're all gone again (while 
+    # whatever earlier tests left behind may have been collected in the meantime)
+    deadline = time.monotonic() + 5
+    while len(set(os.listdir("/proc/self/fd")) - before) > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert set(os.listdir("/proc/self/fd")) - before == set()
+    server.listener.close()
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from vistream.camera import FrameSource, FrameInfo
+from vistream.frame_history import FrameHistory
+
+
+def _frame(value: int, size: int = 4) -> np.ndarray:
+    return np.full((size, size), value, dtype=np.uint8)
+
+
+@pytest.fixture
+def history() -> FrameHistory:
+    # frames 1-5, captured every 0.1s from t=10
+    history = FrameHistory(max_frames=8)
+    for i in range(1, 6):
+        history.add(_frame(i), FrameInfo(i, 10 + 0.1 * (i - 1)))
+    return history
+
+
+def test_lookup_by_id(history):
+    frame, info = history.get_frame_by_id(3)
+    assert info.frame_id == 3 and frame[0, 0] == 3
+    assert history.get_frame_by_id(6) is None
+
+
+def test_lookup_by_timestamp_finds_the_closest(history):
+    assert history.get_frame_at(10.2)[1].frame_id == 3
+    assert history.get_frame_at(10.14)[1].frame_id == 2
+    assert history.get_frame_at(10.16)[1].frame_id == 3
+    # before the first and after the last frame
+    assert history.get_frame_at(0)[1].frame_id == 1
+    assert history.get_frame_at(100)[1].frame_id == 5
+
+
+def test_lookup_by_timestamp_within_a_tolerance(history):
+    assert history.get_frame_at(10.13, tolerance=0.05)[1].frame_id == 2
+    assert history.get_frame_at(10.45, tolerance=0.05)[1].frame_id == 5
+    assert history.get_frame_at(10.46, tolerance=0.05) is None
+    assert history.get_frame_at(9.94, tolerance=0.05) is None
+    # exactly on a frame, no tolerance is needed
+    assert history.get_frame_at(10.3, tolerance=0)[1].frame_id == 4
+
+
+def test_old_frames_are_evicted():
+    history = FrameHistory(max_frames=3)
+    for i in range(1, 6):
+        history.add(_frame(i), FrameInfo(i, float(i)))
+    assert len(history) == 3
+    assert history.get_frame_by_id(2) is None
+    assert history.get_frame_by_id(3) is not None
+    # the earliest frame left is now the closest to anything before it
+    assert history.get_frame_at(1.0)[1].frame_id == 3
+    assert history.get_frame_at(1.0, tolerance=1.5) is None
+
+
+def test_max_bytes_keeps_at_least_the_newest_frame():
+    history = FrameHistory(max_frames=8, max_bytes=40)
+    for i in range(1, 4):
+        history.add(_frame(i), FrameInfo(i, float(i)))
+    # 16 bytes each, so only two fit
+    assert len(history) == 2 and history.total_bytes == 32
+    history.add(_frame(4, size=10), FrameInfo(4, 4.0))
+    assert len(history) == 1 and history.get_frame_by_id(4) is not None
+
+
+def test_repeated_and_out_of_order_frames_are_ignored(history):
+    history.add(_frame(9), FrameInfo(3, 20.0))
+    assert history.get_frame_by_id(3)[0][0, 0] == 3
+    history.add(_frame(9), FrameInfo(9, 9.0))
+    assert history.get_frame_by_id(9) is None
+    assert len(history) == 5
+
+
+def test_clear(history):
+    history.clear()
+    assert len(history) == 0 and history.total_bytes == 0
+    assert history.get_frame_at(10.0) is None
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        FrameHistory(max_frames=0)
+
+
+def test_sources_without_a_history_find_nothing():
+    assert FrameSource().get_frame_by_id(1) is None
+    assert FrameSource().get_frame_at(10.0, tolerance=1) is None
@@ -0,0 +1,78 @@
+import pytest
+
+from vistream.message import MessageHeader, FRAME, DATA, RESENT, STANDALONE, read_header, split_header, sequence_gap
+from vistream.socket_buffer import BufferedSocket
+
+
+class _Chunks:
+    """Stands in for a socket, handing out `data` a few bytes at a time."""
+    def __init__(self, data: bytes, chunk: int = 5):
+        self.data = data
+        self.chunk = chunk
+
+    def recv(self, n: int) -> bytes:
+        out, self.data = self.data[:min(n, self.chunk)], self.data[min(n, self.chunk):]
+        return out
+
+
+def _header(**fields) -> MessageHeader:
+    defaults = {"sequence": 7, "frame_id": 1234, "timestamp": 1.5, "age": 0.25, "codec_id": 3, "width": 640,
+                "height": 480, "length": 9999, "flags": RESENT | STANDALONE}
+    defaults.update(fields)
+    return MessageHeader(FRAME, **defaults)
+
+
+def test_pack_and_parse_round_trip():
+    header = _header()
+    data = header.to_bytes()
+    assert len(data) == MessageHeader.byte_length
+    assert data[0] == header.version
+    assert data[1] == MessageHeader.byte_length
+    assert MessageHeader.from_bytes(data) == header
+
+
+def test_counters_wrap_to_32_bits():
+    header = MessageHeader.from_bytes(_header(sequence=(1 << 32) + 5, frame_id=-1).to_bytes())
+    assert header.sequence == 5
+    assert header.frame_id == 0xFFFFFFFF
+
+
+def test_read_header_from_a_stream():
+    header = MessageHeader(DATA, sequence=3, frame_id=9, length=2)
+    sock = BufferedSocket(_Chunks(header.to_bytes() + b"rest"))
+    assert read_header(sock) == header
+    assert sock.read(4) == b"rest"
+
+
+def test_longer_headers_of_later_versions_are_skipped():
+    header = _header()
+    data = bytearray(header.to_bytes())
+    data[0] = header.version + 1
+    data[1] = MessageHeader.byte_length + 4
+    data.extend(b"newX")
+    parsed, rest = split_header(bytes(data) + b"payload")
+    assert parsed.frame_id == header.frame_id
+    assert bytes(rest) == b"payload"
+
+    sock = BufferedSocket(_Chunks(bytes(data) + b"payload"))
+    assert read_header(sock).frame_id == header.frame_id
+    assert sock.read(7) == b"payload"
+
+
+@pytest.mark.parametrize("data", [b"", bytes(10), bytes([0, MessageHeader.byte_length]) + bytes(31), bytes([1, 2]) + bytes(31)])
+def test_split_header_rejects_malformed_headers(data):
+    assert split_header(data) is None
+
+
+@pytest.mark.parametrize("sequence, previous, gap", [
+    (5, None, 0),
+    (6, 5, 0),
+    (9, 5, 3),
+    (5, 5, 0), # a repeat, or the server starting over
+    (2, 5, 0),
+    (0, 0xFFFFFFFF, 0),
+    (1, 0xFFFFFFFE, 2),
+    (3, 0xFFFFFFFF, 3),
+])
+def test_sequence_gap(sequence, previous, gap):
+    assert sequence_gap(sequence, previous) == gap
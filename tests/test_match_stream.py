@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+
+from vistream.camera_group import CameraGroup
+from vistream.client import FrameStreamClient, MatchDataStreamClient
+from vistream.match_data import MatchData
+from vistream.server import MatchStream
+from vistream.simcam import PatternCamera
+
+
+def _fuse(frames: tuple[np.ndarray, ...]) -> list[MatchData]:
+    # one match per camera, carrying the size of that camera's frame
+    return [MatchData(float(f.shape[1]), float(f.shape[0]), 0.0, True, i) for i, f in enumerate(frames, start=1)]
+
+
+def _wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_camera_group_streams_through_a_fusing_matcher(stream_port):
+    group = CameraGroup([PatternCamera((64, 48), "shapes", fps=30), PatternCamera((32, 24), "shapes", fps=30)], tolerance=0.05)
+    stream = MatchStream(group, stream_port)
+    stream.set_matcher(_fuse)
+    stream.start()
+    frames = matches = None
+    try:
+        frames = FrameStreamClient("127.0.0.1", stream_port)
+        matches = MatchDataStreamClient("127.0.0.1", stream_port + 1)
+        frames.start()
+        matches.start()
+        assert _wait_for(lambda: frames.latest_result is not None and matches.latest_result is not None)
+        assert stream.match_worker.is_alive() and stream.frame_encoder.is_alive()
+
+        # the matcher saw every camera, while video and the match size follow the first one
+        assert [(m.x, m.y, m.fiducial_id) for m in matches.latest_result] == [(64, 48, 1), (32, 24, 2)]
+        assert (matches.latest_header.width, matches.latest_header.height) == (64, 48)
+        assert frames.latest_result.shape == (48, 64, 3)
+    finally:
+        for client in (frames, matches):
+            if client is not None:
+                client.stop()
+        stream.stop()
+        group.stop()
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from vistream.camera import ProcessedCamera, JPEG
+from vistream.client import FrameStreamClient
+from vistream.server import MatchStream
+from vistream.simcam import ImageDirectoryCamera
+
+
+@pytest.fixture
+def jpegs(tmp_path) -> str:
+    rng = np.random.default_rng(0)
+    for i in range(4):
+        cv.imwrite(str(tmp_path / f"{i}.jpg"), rng.integers(0, 256, (48, 64, 3), dtype=np.uint8))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def codec_calls(monkeypatch) -> list[tuple[str, threading.Thread]]:
+    """Every JPEG encode and decode from here on, and the thread it happened on."""
+    calls = []
+    for name in ("imdecode", "imencode"):
+        def spy(*args, original=getattr(cv, name), name=name, **kwargs):
+            calls.append((name, threading.current_thread()))
+            return original(*args, **kwargs)
+        monkeypatch.setattr(cv, name, spy)
+    return calls
+
+
+def test_processed_camera_without_layers_doesnt_decode(jpegs, codec_calls):
+    cam = ProcessedCamera(ImageDirectoryCamera(jpegs, fps=50, passthrough=True))
+    try:
+        assert cam.pixel_formats()[0] == JPEG
+        last_id = None
+        for _ in range(10):
+            last_id = cam.wait_for_frame(last_id, timeout=5)
+            assert last_id is not None
+            encoded, info = cam.get_encoded_frame()
+            assert encoded is not None and encoded.ndim == 1
+        assert codec_calls == []
+        # decoding only happens for whoever asks for pixels
+        frame, info = cam.get_frame_with_info()
+        assert frame.shape == (48, 64, 3) and info is not None
+        assert [name for name, _ in codec_calls] == ["imdecode"]
+    finally:
+        cam.stop()
+
+
+def test_streaming_a_passthrough_camera_does_no_encodes_or_decodes(jpegs, codec_calls, stream_port):
+    cam = ProcessedCamera(ImageDirectoryCamera(jpegs, fps=50, passthrough=True))
+    stream = MatchStream(cam, stream_port)
+    client = None
+    try:
+        stream.start()
+        client = FrameStreamClient("127.0.0.1", stream_port)
+        client.start()
+        deadline = time.monotonic() + 5
+        while client.received < 10 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert client.received >= 10
+        assert client.latest_result.shape == (48, 64, 3)
+
+        # the client decodes what it gets, but nothing on the way there touched the pixels
+        assert [name for name, thread in codec_calls if thread is not client.listen_worker] == []
+        assert stream.encode_stats()["encodes"] == 0
+    finally:
+        if client is not None:
+            client.stop()
+        stream.stop()
+        cam.stop()
@@ -0,0 +1,75 @@
+import multiprocessing as mp
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from vistream.frame_limiter import FrameSequencer, FrameRateLimiter
+from vistream.layers import ResizeLayer
+from vistream.process_camera import ProcessPoolCamera
+from vistream.simcam import ImageDirectoryCamera
+
+
+class _ExitOnce:
+    """Passes frames through, except that the first worker to see `trigger` exist removes it and
+    dies on the spot.
+    """
+    def __init__(self, trigger: str):
+        self.trigger = trigger
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        if mp.parent_process() is not None:
+            try:
+                os.remove(self.trigger)
+            except FileNotFoundError:
+                return frame
+            os._exit(1)
+        return frame
+
+
+@pytest.fixture
+def images(tmp_path) -> str:
+    directory = tmp_path / "images"
+    directory.mkdir()
+    for i in range(4):
+        cv.imwrite(str(directory / f"{i}.png"), np.full((24, 32, 3), 40 * (i + 1), dtype=np.uint8))
+    return str(directory)
+
+
+def _frames_keep_coming(cam: ProcessPoolCamera, count: int = 10, timeout: float = 10) -> bool:
+    last_id = cam.frame_id()
+    deadline = time.monotonic() + timeout
+    for _ in range(count):
+        last_id = cam.wait_for_frame(last_id, timeout=max(0, deadline - time.monotonic()))
+        if last_id is None:
+            return False
+    return True
+
+
+def test_frames_lost_with_a_dead_worker_are_given_up_on(images, tmp_path):
+    trigger = str(tmp_path / "exit")
+    cam = ProcessPoolCamera(ImageDirectoryCamera(images, fps=50), [_ExitOnce(trigger), ResizeLayer((16, 12))], workers=2)
+    try:
+        assert _frames_keep_coming(cam)
+        # As if a worker took this task and died before it could mark it as in progress. Nothing
+        # will ever come of it, and frames are published in order, so it has to be given up on.
+        cam._tasks.get(timeout=5)
+        open(trigger, "w").close()
+        assert _frames_keep_coming(cam)
+        assert not os.path.exists(trigger)
+        assert cam.get_frame().shape == (12, 16, 3)
+    finally:
+        cam.stop()
+
+
+def test_any_source_can_be_sequenced_and_limited(images):
+    cam = ProcessPoolCamera(ImageDirectoryCamera(images, fps=50), [ResizeLayer((16, 12))], workers=1)
+    try:
+        assert isinstance(cam.sequential_frames(), FrameSequencer)
+        limited = cam.limit_framerate(10)
+        assert isinstance(limited, FrameRateLimiter) and limited.target_fps == 10
+        assert limited.get_frame(timeout=5).shape == (12, 16, 3)
+    finally:
+        cam.stop()
@@ -0,0 +1,125 @@
+from collections import deque
+
+import pytest
+
+from vistream.message import StreamProfile, JPEG, PNG
+from vistream.rate_control import AdaptiveController
+
+TARGET = 1_000_000
+INTERVAL = 0.5
+
+
+class _Writer:
+    """The parts of a `ClientWriter` the controller looks at, set by hand."""
+    def __init__(self):
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.queue = deque()
+        self.max_queue = 2
+        self.latency = 0.0
+
+    def stalled_for(self) -> float:
+        return 0
+
+
+class _Client:
+    """Feeds a controller one measurement per interval, on a clock of its own."""
+    def __init__(self, controller: AdaptiveController):
+        self.controller = controller
+        self.writer = _Writer()
+        self.now = 0.0
+        controller.update(self.writer, now=self.now)
+
+    def send(self, bitrate: float, intervals: int = 1, dropped: int = 0) -> int:
+        for _ in range(intervals):
+            self.now += INTERVAL
+            self.writer.bytes_sent += int(bitrate * INTERVAL / 8)
+            self.writer.dropped += dropped
+            self.controller.update(self.writer, now=self.now)
+        return self.controller.level
+
+
+def _controller(**kwargs) -> AdaptiveController:
+    return AdaptiveController(StreamProfile(None, JPEG, 50), (640, 480), target_bitrate=TARGET, interval=INTERVAL, up_after=2.0, **kwargs)
+
+
+def test_ladder_lowers_quality_then_size_then_rate():
+    ladder = _controller().ladder
+    assert [p.quality for p in ladder[:7]] == [50, 35, 24, 16, 11, 7, 5]
+    assert all(p.size is None and p.max_fps == 0 for p in ladder[:7])
+    assert [p.size for p in ladder[7:9]] == [(480, 360), (320, 240)]
+    assert [p.max_fps for p in ladder[9:]] == [15, 10, 5]
+    assert all(p.quality == 5 and p.size == (320, 240) for p in ladder[9:])
+
+
+def test_lossless_codecs_skip_the_quality_steps():
+    ladder = AdaptiveController(StreamProfile((320, 240), PNG, 1), (640, 480)).ladder
+    assert all(p.quality == 1 for p in ladder)
+    assert [p.size for p in ladder[:3]] == [(320, 240), (240, 180), (160, 120)]
+
+
+def test_steps_down_holds_inside_the_band_and_recovers():
+    client = _Client(_controller())
+    # waits for a whole interval before measuring anything
+    client.now += INTERVAL / 2
+    assert client.controller.update(client.writer, now=client.now) == client.controller.ladder[0]
+    client.now -= INTERVAL / 2
+
+    # one step per interval spent over the target
+    assert client.send(1.5 * TARGET) == 1
+    assert client.send(1.5 * TARGET) == 2
+    assert client.controller.profile.quality == 24
+
+    # between 70% of the target and the target itself, it neither drops nor climbs
+    assert client.send(0.8 * TARGET, intervals=20) == 2
+
+    # comfortably under it, it climbs a step every `up_after` seconds
+    assert client.send(0.5 * TARGET, intervals=4) == 2
+    assert client.send(0.5 * TARGET) == 1
+    assert client.send(0.5 * TARGET, intervals=3) == 1
+    assert client.send(0.5 * TARGET) == 0
+    assert client.send(0.5 * TARGET, intervals=10) == 0
+    assert client.controller.profile == StreamProfile(None, JPEG, 50)
+
+
+def test_congestion_drops_halfway_at_once():
+    client = _Client(_controller())
+    last = len(client.controller.ladder) - 1
+    assert client.send(0.1 * TARGET, dropped=1) == (last + 1) // 2
+    assert client.send(0.1 * TARGET, dropped=1) == (last + 1) // 2 + (last - (last + 1) // 2 + 1) // 2
+    assert client.send(0.1 * TARGET, dropped=1, intervals=10) == last
+
+
+def test_latency_over_budget_counts_as_congestion():
+    client = _Client(_controller(latency_budget=0.1))
+    client.writer.latency = 0.2
+    assert client.send(0.1 * TARGET) > 1
+    # back under half the budget, it recovers
+    level = client.controller.level
+    client.writer.latency = 0.01
+    assert client.send(0.1 * TARGET, intervals=5) == level - 1
+
+
+def test_step_up_that_fails_right_away_waits_longer_next_time():
+    client = _Client(_controller())
+    assert client.send(1.5 * TARGET, intervals=2) == 2
+    assert client.send(0.5 * TARGET, intervals=5) == 1
+    # the climb didn't hold
+    assert client.send(1.5 * TARGET) == 2
+
+    # so that step, and the ones above it, now take twice as long to retake
+    assert client.send(0.5 * TARGET, intervals=5) == 2
+    assert client.send(0.5 * TARGET, intervals=4) == 1
+    assert client.send(0.5 * TARGET, intervals=7) == 1
+    assert client.send(0.5 * TARGET) == 0
+
+    # having made it past that step, the wait started over, so failing again only doubles it once
+    assert client.send(1.5 * TARGET) == 1
+    assert client.send(0.5 * TARGET, intervals=8) == 1
+    assert client.send(0.5 * TARGET) == 0
+
+
+@pytest.mark.parametrize("interval", [0, -1])
+def test_invalid_interval(interval):
+    with pytest.raises(ValueError):
+        AdaptiveController(StreamProfile(), (640, 480), interval=interval)
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from vistream import socket_pool
+from vistream.socket_pool import SocketPool
+
+FIRST, LAST = 16300, 16305
+
+pytestmark = pytest.mark.skipif(socket_pool.fcntl is None, reason="ports are only shared between pools where flock exists")
+
+
+def _port(sock) -> int:
+    return sock.getsockname()[1]
+
+
+def test_pools_sharing_a_lock_dir_never_share_a_port(tmp_path):
+    a = SocketPool(FIRST, LAST, lock_dir=str(tmp_path))
+    b = SocketPool(FIRST, LAST, lock_dir=str(tmp_path))
+    try:
+        taken = {"a": [], "b": []}
+        # take turns until the range runs out
+        while True:
+            got = False
+            for name, pool in (("a", a), ("b", b)):
+                s = pool.allocate(None)
+                if s is not None:
+                    taken[name].append(_port(s))
+                    got = True
+            if not got:
+                break
+        assert len(taken["a"]) > 0 and len(taken["b"]) > 0
+        assert set(taken["a"]).isdisjoint(taken["b"])
+        assert sorted(taken["a"] + taken["b"]) == list(range(FIRST, LAST + 1))
+
+        # asking for a port the other pool holds doesn't get it either
+        assert b.allocate(taken["a"][0]) is None
+        # until it's given back
+        a.deallocate(taken["a"][0])
+        s = b.allocate(taken["a"][0])
+        assert s is not None and _port(s) == taken["a"][0]
+    finally:
+        a.collapse()
+        b.collapse()
+
+
+def test_lock_files_that_cant_be_opened_make_the_port_unavailable(tmp_path, monkeypatch):
+    # as when another user's process created the lock file first
+    blocked = os.path.join(str(tmp_path), f"{FIRST}.lock")
+    open_file = os.open
+    def guarded_open(path, *args, **kwargs):
+        if path == blocked:
+            raise PermissionError(13, "Permission denied", path)
+        return open_file(path, *args, **kwargs)
+    monkeypatch.setattr(os, "open", guarded_open)
+
+    pool = SocketPool(FIRST, LAST, lock_dir=str(tmp_path))
+    try:
+        assert pool.allocate(FIRST) is None
+        s = pool.allocate(None)
+        assert s is not None and _port(s) == FIRST + 1
+        # the port stays in the pool, in case it comes free later
+        assert FIRST in pool.available_ports
+    finally:
+        pool.collapse()
@@ -0,0 +1,54 @@
+import os
+import time
+
+import pytest
+
+from vistream import socket_pool
+from vistream.supervisor import Supervisor
+
+pytestmark = pytest.mark.skipif(socket_pool.fcntl is None, reason="groups share ports through flock")
+
+
+def _crash_once(starts: str) -> list:
+    """A group that crashes the first time it's started, and runs no streams after that."""
+    with open(starts, "a") as f:
+        f.write(f"{os.getpid()}\n")
+    with open(starts) as f:
+        if len(f.readlines()) == 1:
+            os._exit(3)
+    return []
+
+
+def _starts(path: str) -> list[int]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [int(line) for line in f]
+
+
+def _wait_for(condition, timeout: float = 20) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_crashed_groups_are_restarted(tmp_path):
+    starts = str(tmp_path / "starts")
+    supervisor = Supervisor((16310, 16315), lock_dir=str(tmp_path / "ports"), restart_delay=0.1)
+    supervisor.add_group("crashy", _crash_once, starts)
+    supervisor.start()
+    try:
+        # a process counts as running before it gets to building its streams
+        assert _wait_for(lambda: len(_starts(starts)) == 2)
+        # it stays up the second time round
+        time.sleep(0.5)
+        status = supervisor.status()["crashy"]
+        assert status["running"] and status["restarts"] == 1
+        pids = _starts(starts)
+        assert len(pids) == 2 and pids[0] != pids[1] and pids[1] == status["pid"]
+    finally:
+        supervisor.stop()
+    assert not supervisor.status()["crashy"]["running"]
@@ -0,0 +1,137 @@
+import numpy as np
+import bitstring as bs
+import pytest
+
+from vistream.message import TileEncoder, TileDecoder, TILE_MAGIC_FLAG, TILE_HEADER_LAYOUT, TILE_HEADER_LENGTH, is_tile_payload
+
+
+def _frame(w: int = 100, h: int = 70) -> np.ndarray:
+    # sizes that aren't a multiple of the tile size leave partial tiles along the right and bottom
+    x = np.linspace(0, 200, w, dtype=np.float32)
+    frame = np.empty((h, w, 3), dtype=np.uint8)
+    frame[...] = x[None, :, None]
+    return frame
+
+
+def _info(payload: bytes) -> tuple[int, bool, int]:
+    sequence, keyframe, _, _, _, count = bs.Bits(bytes=payload[len(TILE_MAGIC_FLAG):TILE_HEADER_LENGTH]).unpack(TILE_HEADER_LAYOUT)
+    return sequence, bool(keyframe), count
+
+
+def _close(a: np.ndarray, b: np.ndarray) -> bool:
+    return np.abs(a.astype(int) - b).mean() < 6
+
+
+def test_first_payload_is_a_keyframe():
+    encoder, decoder = TileEncoder(quality=90, tile_size=32), TileDecoder()
+    payload = encoder.encode(_frame(), now=0)
+    assert is_tile_payload(payload)
+    assert _info(payload) == (1, True, 0)
+    frame = decoder.apply(payload)
+    assert frame.shape == (70, 100, 3)
+    assert _close(frame, _frame())
+
+
+def test_unchanged_frames_send_nothing():
+    encoder = TileEncoder(tile_size=32)
+    encoder.encode(_frame(), now=0)
+    assert encoder.encode(_frame(), now=0.1) is None
+
+
+@pytest.mark.parametrize("sample", [1, 4])
+@pytest.mark.parametrize("y, x", [(0, 0), (40, 70), (64, 96), (69, 99)])
+def test_only_changed_tiles_are_sent(y, x, sample):
+    encoder, decoder = TileEncoder(quality=90, tile_size=32, sample=sample), TileDecoder()
+    decoder.apply(encoder.encode(_frame(), now=0))
+    changed = _frame()
+    # (64, 96) and (69, 99) are in the partial tiles at the bottom right corner
+    changed[y - y % 32:y - y % 32 + 32, x - x % 32:x - x % 32 + 32] = (0, 0, 255)
+    payload = encoder.encode(changed, now=0.1)
+    assert _info(payload) == (2, False, 1)
+    frame = decoder.apply(payload)
+    assert _close(frame, changed)
+
+
+def test_several_tiles_pack_into_one_image():
+    encoder, decoder = TileEncoder(quality=90, tile_size=16), TileDecoder()
+    decoder.apply(encoder.encode(_frame(), now=0))
+    changed = _frame()
+    changed[:, :40] = 255
+    payload = encoder.encode(changed, now=0.1)
+    assert _info(payload)[2] == 3 * 5 # three columns of tiles, all five rows
+    assert _close(decoder.apply(payload), changed)
+
+
+def test_slow_changes_add_up():
+    encoder = TileEncoder(tile_size=32, threshold=4.0, sample=1)
+    encoder.encode(_frame(), now=0)
+    frame = _frame()
+    sent = []
+    for i in range(1, 6):
+        frame[:32, :32] = np.clip(_frame()[:32, :32].astype(int) + 2 * i, 0, 255)
+        sent.append(encoder.encode(frame, now=0.1 * i) is not None)
+    # each step is under the threshold, but compared with what was last sent they get there
+    assert sent[0] is False
+    assert any(sent)
+
+
+def test_keyframes_come_regularly_and_on_request():
+    encoder = TileEncoder(tile_size=32, keyframe_interval=2.0)
+    encoder.encode(_frame(), now=0)
+    assert encoder.encode(_frame(), now=1.0) is None
+    assert _info(encoder.encode(_frame(), now=2.5))[1]
+    assert _info(encoder.encode(_frame(), keyframe=True, now=2.6))[1]
+
+
+def test_size_changes_force_a_keyframe():
+    encoder = TileEncoder(tile_size=32)
+    encoder.encode(_frame(), now=0)
+    assert _info(encoder.encode(_frame(64, 48), now=0.1))[1]
+
+
+def test_missed_payload_needs_a_keyframe():
+    encoder, decoder = TileEncoder(quality=90, tile_size=32), TileDecoder()
+    decoder.apply(encoder.encode(_frame(), now=0))
+    first = _frame()
+    first[:32, :32] = 255
+    encoder.encode(first, now=0.1) # lost on the way
+    second = first.copy()
+    second[32:64, 64:] = 0
+    assert decoder.apply(encoder.encode(second, now=0.2)) is None
+    assert decoder.needs_keyframe
+
+    # deltas still can't be applied, until a keyframe comes along
+    third = second.copy()
+    third[:32, 64:] = 0
+    assert decoder.apply(encoder.encode(third, now=0.3)) is None
+    frame = decoder.apply(encoder.encode(third, keyframe=True, now=0.4))
+    assert not decoder.needs_keyframe
+    assert _close(frame, third)
+
+    fourth = third.copy()
+    fourth[32:, :32] = 128
+    assert _close(decoder.apply(encoder.encode(fourth, now=0.5)), fourth)
+
+
+def test_delta_without_a_keyframe_is_refused():
+    encoder = TileEncoder(tile_size=32)
+    encoder.encode(_frame(), now=0)
+    changed = _frame()
+    changed[:32, :32] = 255
+    decoder = TileDecoder()
+    assert decoder.apply(encoder.encode(changed, now=0.1)) is None
+    assert decoder.needs_keyframe
+
+
+def test_decoded_frames_are_copies():
+    encoder, decoder = TileEncoder(tile_size=32), TileDecoder()
+    frame = decoder.apply(encoder.encode(_frame(), now=0))
+    frame[:] = 0
+    assert decoder.frame.any()
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        TileEncoder(tile_size=0)
+    with pytest.raises(ValueError):
+        TileEncoder(tile_size=30, sample=4)
@@ -0,0 +1,86 @@
+import pytest
+
+from vistream.message import MessageHeader, FRAME, RESENT
+from vistream.udp import fragment_frame, FrameReassembler, FRAGMENT_HEADER_LENGTH, _RESTART_RUN
+
+
+def _datagrams(sequence: int, size: int = 3000, frame_id: int = 0, flags: int = 0, datagram_size: int = 1000) -> list[bytes]:
+    image = bytes(i % 251 for i in range(size))
+    header = MessageHeader(FRAME, sequence=sequence, frame_id=frame_id, flags=flags)
+    return [b"".join(bytes(part) for part in f) for f in fragment_frame(image, header, datagram_size)]
+
+
+def _add_all(reassembler: FrameReassembler, datagrams: list[bytes]):
+    res = None
+    for d in datagrams:
+        res = reassembler.add(d) or res
+    return res
+
+
+def test_fragments_fit_in_a_datagram():
+    datagrams = _datagrams(1, size=5000, datagram_size=1000)
+    assert all(len(d) <= 1000 for d in datagrams)
+    assert sum(len(d) - FRAGMENT_HEADER_LENGTH for d in datagrams) == 5000
+
+
+def test_fragments_reassemble_in_any_order():
+    datagrams = _datagrams(1, frame_id=42)
+    image, header = _add_all(FrameReassembler(), list(reversed(datagrams)))
+    assert image == bytes(i % 251 for i in range(3000))
+    assert (header.sequence, header.frame_id, header.length) == (1, 42, 3000)
+
+
+def test_duplicates_count_once():
+    reassembler = FrameReassembler()
+    datagrams = _datagrams(1)
+    assert _add_all(reassembler, datagrams[:1] * 3 + datagrams[1:]) is not None
+    assert reassembler.completed == 1
+    assert _add_all(reassembler, datagrams) is None
+    assert reassembler.late == len(datagrams)
+
+
+def test_newer_message_abandons_an_incomplete_one():
+    reassembler = FrameReassembler()
+    first = _datagrams(1)
+    assert _add_all(reassembler, first[:-1]) is None
+    assert _add_all(reassembler, _datagrams(2)) is not None
+    # the rest of the first one turns up too late
+    assert reassembler.add(first[-1]) is None
+    assert reassembler.stats() == {"completed": 1, "discarded": 1, "late": 1}
+
+
+def test_resent_frames_are_not_late():
+    reassembler = FrameReassembler()
+    _add_all(reassembler, _datagrams(1, frame_id=10))
+    _add_all(reassembler, _datagrams(2, frame_id=11))
+    # an older frame sent again, to a client that joined since, is a new message
+    _, header = _add_all(reassembler, _datagrams(3, frame_id=10, flags=RESENT))
+    assert header.frame_id == 10 and header.flags & RESENT
+    assert reassembler.late == 0
+
+
+def test_sequence_numbers_wrap_around():
+    reassembler = FrameReassembler()
+    assert _add_all(reassembler, _datagrams(0xFFFFFFFF)) is not None
+    assert _add_all(reassembler, _datagrams(0)) is not None
+    assert reassembler.late == 0
+
+
+def test_restarted_server_is_followed():
+    reassembler = FrameReassembler()
+    _add_all(reassembler, _datagrams(1000, size=10))
+    # single fragment messages numbered from the start again look late, until there are enough
+    restarted = [_datagrams(i, size=10)[0] for i in range(1, _RESTART_RUN + 2)]
+    results = [reassembler.add(d) for d in restarted]
+    assert all(r is None for r in results[:_RESTART_RUN])
+    assert results[_RESTART_RUN] is not None
+
+
+@pytest.mark.parametrize("datagram", [b"", b"junk" * 20, _datagrams(1)[0][:FRAGMENT_HEADER_LENGTH - 1]])
+def test_other_datagrams_are_ignored(datagram):
+    assert FrameReassembler().add(datagram) is None
+
+
+def test_datagrams_too_small_for_the_header():
+    with pytest.raises(ValueError):
+        fragment_frame(bytes(10), MessageHeader(FRAME), FRAGMENT_HEADER_LENGTH)
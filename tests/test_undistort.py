@@ -0,0 +1,99 @@
+import os
+import pickle
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from vistream.undistort import UndistortLayer
+
+
+SIZE = (64, 48)
+K = np.array([[50.0, 0, 32], [0, 50.0, 24], [0, 0, 1]])
+PINHOLE_D = np.array([-0.3, 0.1, 0.001, -0.002, 0.0])
+FISHEYE_D = np.array([0.05, -0.02, 0.01, -0.005])
+
+
+@pytest.fixture
+def frame() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (SIZE[1], SIZE[0], 3), dtype=np.uint8)
+
+
+@pytest.fixture
+def map_computations(monkeypatch) -> list[str]:
+    """The name of every remap table computation from here on."""
+    calls = []
+    for module, name in ((cv, "initUndistortRectifyMap"), (cv.fisheye, "initUndistortRectifyMap")):
+        label = "fisheye" if module is cv.fisheye else "pinhole"
+        def spy(*args, original=getattr(module, name), label=label):
+            calls.append(label)
+            return original(*args)
+        monkeypatch.setattr(module, name, spy)
+    return calls
+
+
+@pytest.mark.parametrize("fisheye", [False, True])
+def test_output_matches_remapping_with_opencvs_own_maps(frame, fisheye, tmp_path):
+    if fisheye:
+        map1, map2 = cv.fisheye.initUndistortRectifyMap(K, FISHEYE_D, np.eye(3), K, SIZE, cv.CV_16SC2)
+    else:
+        map1, map2 = cv.initUndistortRectifyMap(K, PINHOLE_D, np.eye(3), K, SIZE, cv.CV_16SC2)
+    expected = cv.remap(frame, map1, map2, cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT)
+
+    layer = UndistortLayer(K, FISHEYE_D if fisheye else PINHOLE_D, SIZE, fisheye=fisheye, cache_dir=str(tmp_path))
+    undistorted = layer(frame)
+    assert undistorted.shape == frame.shape
+    assert np.array_equal(undistorted, expected)
+    # and it really did something
+    assert not np.array_equal(undistorted, frame)
+
+
+def test_a_second_instance_reuses_the_cached_maps(frame, tmp_path, map_computations):
+    first = UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=str(tmp_path))
+    assert map_computations == ["pinhole"]
+    key = first.calibration_key()
+    assert sorted(os.listdir(tmp_path)) == [key + ".map1.npy", key + ".map2.npy"]
+
+    second = UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=str(tmp_path))
+    assert map_computations == ["pinhole"]
+    assert isinstance(second.map1, np.memmap) and isinstance(second.map2, np.memmap)
+    assert np.array_equal(second.map1, first.map1) and np.array_equal(second.map2, first.map2)
+    assert np.array_equal(second(frame), first(frame))
+
+    # unpickled copies, as process pool workers get, load them from the cache too
+    copy = pickle.loads(pickle.dumps(second))
+    assert map_computations == ["pinhole"]
+    assert np.array_equal(copy(frame), first(frame))
+
+
+def test_a_different_calibration_gets_its_own_maps(tmp_path, map_computations):
+    first = UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=str(tmp_path))
+    other = UndistortLayer(K, PINHOLE_D * 2, SIZE, cache_dir=str(tmp_path))
+    resized = UndistortLayer(K, PINHOLE_D, (32, 24), cache_dir=str(tmp_path))
+    fisheye = UndistortLayer(K, FISHEYE_D, SIZE, fisheye=True, cache_dir=str(tmp_path))
+    assert map_computations == ["pinhole", "pinhole", "pinhole", "fisheye"]
+    assert len({l.calibration_key() for l in (first, other, resized, fisheye)}) == 4
+    assert len(os.listdir(tmp_path)) == 8
+
+
+def test_broken_cache_files_are_replaced(frame, tmp_path, map_computations):
+    layer = UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=str(tmp_path))
+    with open(tmp_path / (layer.calibration_key() + ".map1.npy"), "wb") as f:
+        f.write(b"not a table")
+    again = UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=str(tmp_path))
+    assert map_computations == ["pinhole", "pinhole"]
+    assert np.array_equal(again(frame), layer(frame))
+    UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=str(tmp_path))
+    assert map_computations == ["pinhole", "pinhole"]
+
+
+def test_no_cache_dir(tmp_path, map_computations):
+    UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=None)
+    UndistortLayer(K, PINHOLE_D, SIZE, cache_dir=None)
+    assert map_computations == ["pinhole", "pinhole"]
+
+
+def test_fisheye_needs_four_coefficients():
+    with pytest.raises(ValueError):
+        UndistortLayer(K, PINHOLE_D, SIZE, fisheye=True, cache_dir=None)
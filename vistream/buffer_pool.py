@@ -0,0 +1,66 @@
+import sys
+import numpy as np
+from threading import Lock
+
+from typing import Optional
+
+
+class BufferPool:
+    """A fixed ring of preallocated frame buffers that producers can fill in place, instead of
+    allocating a new array for every frame.
+
+    Buffers are reference counted by the interpreter itself: a buffer is only handed out again
+    once nothing outside of the pool holds a reference to it (views included, since a view keeps
+    its base alive). Consumers therefore never see a buffer overwritten underneath them, and
+    don't need to explicitly release anything; they just drop the array when they're done.
+
+    If every buffer is still in use, `acquire` falls back to a fresh allocation rather than
+    stalling the producer. `overflow_count` tracks how often that happens, which is a sign that
+    the pool is too small for its consumers.
+    """
+    buffers: list[Optional[np.ndarray]]
+    pool_lock: Lock
+    overflow_count: int
+    _next: int
+    _free_refs: int
+
+    def __init__(self, count: int):
+        if count <= 0:
+            raise ValueError(f"buffer count must be positive ({count})")
+        self.buffers = [None] * count
+        self.pool_lock = Lock()
+        self.overflow_count = 0
+        self._next = 0
+        # Measure the reference count of an unused buffer the same way `_in_use` does, rather
+        # than hard-coding it, since the exact number differs between interpreter versions.
+        probe = [np.empty(0)]
+        self._free_refs = BufferPool._refs(probe, 0)
+
+    @staticmethod
+    def _refs(buffers: list[Optional[np.ndarray]], index: int) -> int:
+        return sys.getrefcount(buffers[index])
+
+    def _in_use(self, index: int) -> bool:
+        return BufferPool._refs(self.buffers, index) > self._free_refs
+
+    def acquire(self, shape: tuple[int, ...], dtype: np.dtype = np.uint8) -> np.ndarray:
+        """Returns a buffer of the given shape and type that no one else is using. Its contents
+        are undefined.
+        """
+        with self.pool_lock:
+            count = len(self.buffers)
+            for offset in range(count):
+                i = (self._next + offset) % count
+                if self.buffers[i] is not None and self._in_use(i):
+                    continue
+                if self.buffers[i] is None or self.buffers[i].shape != tuple(shape) or self.buffers[i].dtype != dtype:
+                    self.buffers[i] = np.empty(shape, dtype=dtype)
+                self._next = (i + 1) % count
+                return self.buffers[i]
+            self.overflow_count += 1
+        return np.empty(shape, dtype=dtype)
+
+    def in_use(self) -> int:
+        """The number of pooled buffers currently referenced outside of the pool."""
+        with self.pool_lock:
+            return sum(1 for i in range(len(self.buffers)) if self.buffers[i] is not None and self._in_use(i))
@@ -5,11 +5,102 @@ import cv2 as cv
 import time
 import numpy as np
 from collections import deque
-from threading import Thread, Lock, Event
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event, Condition, current_thread
+from dataclasses import dataclass
+
+from .buffer_pool import BufferPool
+from .frame_history import FrameHistory
+from .layers import _apply_layers
 
 
 from typing import Any, Optional, Callable
 
+# Pixel formats frames can be served in
+BGR = "BGR" # 3 channels, (h, w, 3)
+GRAY = "GRAY" # luminance only, (h, w)
+YUV420 = "YUV420" # I420 planar: the full size Y plane followed by quarter size U and V planes, (h*3/2, w)
+JPEG = "JPEG" # compressed, as a flat array of bytes
+
+def convert_frame(frame: np.ndarray, source_format: str, pixel_format: str, known: Optional[dict[str, np.ndarray]] = None) -> np.ndarray:
+    """Converts `frame` from `source_format` to `pixel_format`. `known` may hold conversions of 
+    the same frame that have already been done, which are used as shortcuts where possible.
+    """
+    if pixel_format == source_format:
+        return frame
+    if known is not None and pixel_format in known:
+        return known[pixel_format]
+    if known is not None and BGR in known and source_format in (JPEG, YUV420):
+        frame, source_format = known[BGR], BGR
+
+    if source_format == JPEG:
+        if pixel_format == GRAY:
+            # decoding straight to gray skips the colour conversion altogether
+            return cv.imdecode(frame, cv.IMREAD_GRAYSCALE)
+        return convert_frame(cv.imdecode(frame, cv.IMREAD_COLOR), BGR, pixel_format)
+    if source_format == YUV420:
+        if pixel_format == GRAY:
+            # the Y plane is the luminance, so no conversion is needed at all
+            return frame[:frame.shape[0] * 2 // 3]
+        if pixel_format == BGR:
+            return cv.cvtColor(frame, cv.COLOR_YUV2BGR_I420)
+    if source_format == BGR:
+        if pixel_format == GRAY:
+            return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        if pixel_format == YUV420:
+            return cv.cvtColor(frame, cv.COLOR_BGR2YUV_I420)
+    if source_format == GRAY:
+        if pixel_format == BGR:
+            return cv.cvtColor(frame, cv.COLOR_GRAY2BGR)
+        if pixel_format == YUV420:
+            h, w = frame.shape[:2]
+            out = np.full((h * 3 // 2, w), 128, dtype=np.uint8)
+            out[:h] = frame
+            return out
+    raise ValueError(f"can't convert frames from {source_format} to {pixel_format}")
+
+def frame_format(frame: np.ndarray) -> str:
+    """The pixel format of a decoded frame, going by its shape. Layers may well turn BGR frames
+    into gray ones, so a processed frame's format can't simply be assumed.
+    """
+    if frame.ndim == 2 or (frame.ndim == 3 and frame.shape[2] == 1):
+        return GRAY
+    return BGR
+
+def _formats_from(native: str) -> tuple[str, ...]:
+    return (native,) + tuple(f for f in (BGR, GRAY, YUV420) if f != native)
+
+
+class _FormatCache:
+    """Conversions of the newest frame into other pixel formats, so that each conversion is done 
+    at most once per frame id, no matter how many consumers ask for it.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.frame_id = None
+        self.conversions = {}
+
+    def convert(self, frame: np.ndarray, info: "FrameInfo", source_format: str, pixel_format: str) -> np.ndarray:
+        if pixel_format == source_format:
+            return frame
+        with self.lock:
+            if self.frame_id is None or info.frame_id > self.frame_id:
+                self.frame_id = info.frame_id
+                self.conversions = {}
+            elif info.frame_id != self.frame_id:
+                # an older frame (from a history, say). Not worth evicting the newest one over
+                return convert_frame(frame, source_format, pixel_format)
+            if pixel_format not in self.conversions:
+                self.conversions[pixel_format] = convert_frame(frame, source_format, pixel_format, self.conversions)
+            return self.conversions[pixel_format]
+
+@dataclass(frozen=True)
+class FrameInfo:
+    """Bookkeeping that travels with a frame through the processing chain."""
+    frame_id: int
+    timestamp: float # `time.monotonic()` at the moment the frame was captured
+    sensor_timestamp: Optional[float] = None # in seconds, on the backend's own clock, where it has one
+
 class FrameSource:
     def get_frame(self) -> Optional[np.ndarray]:
         """Returns the current frame of the device, in the form of a `numpy.ndarray`.
@@ -40,6 +131,79 @@ class FrameSource:
         """
         raise NotImplementedError()
 
+    def frame_info(self) -> Optional[FrameInfo]:
+        """The `FrameInfo` of the current frame, or `None` if there hasn't been one yet."""
+        raise NotImplementedError()
+
+    def get_frame_with_info(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        """Same as `get_frame`, but also returns the frame's `FrameInfo`. The two are read 
+        together, so the info is guaranteed to belong to the frame, which isn't the case when 
+        calling `get_frame` and `frame_info` separately.
+        """
+        raise NotImplementedError()
+
+    def pixel_formats(self) -> tuple[str, ...]:
+        """The pixel formats `get_frame_as` can provide, with the source's native format first.
+        Asking for the native format is free, anything else costs a conversion, which is shared 
+        between everyone that asks for it.
+        """
+        return (BGR,)
+
+    def get_frame_as(self, pixel_formats: list[str]) -> tuple[Optional[list[np.ndarray]], Optional[FrameInfo]]:
+        """Returns the current frame in each of the given pixel formats (see `pixel_formats`), all
+        guaranteed to be from the same frame, along with its info. A luminance-only consumer 
+        can ask for `[GRAY]` and skip the colour data entirely when the source is natively YUV.
+
+        By default, this converts the frame from `get_frame_with_info`, whatever its format is.
+        """
+        frame, info = self.get_frame_with_info()
+        if frame is None:
+            return None, None
+        native = frame_format(frame)
+        known = {}
+        for f in pixel_formats:
+            known[f] = convert_frame(frame, native, f, known)
+        return [known[f] for f in pixel_formats], info
+
+    def get_encoded_frame(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        """Returns the current frame exactly as the camera delivered it, still JPEG compressed, as
+        a flat `numpy.ndarray` of bytes, along with its info. This lets frames be forwarded 
+        without decoding and re-encoding them.
+
+        Most sources only have decoded frames, and return `(None, None)`.
+        """
+        return None, None
+
+    def get_frame_by_id(self, frame_id: int) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        """Returns a recent frame by its id, along with its info, so that results can be matched 
+        back up with the exact frame they came from. Only sources that keep a `FrameHistory` 
+        support this, and it returns `None` once the frame has aged out of the history, or 
+        always for sources without one.
+        """
+        return None
+
+    def get_frame_at(self, timestamp: float, tolerance: Optional[float] = None) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        """Like `get_frame_by_id`, but finds the frame captured closest to `timestamp`, on the 
+        `time.monotonic()` clock. Frames more than `tolerance` seconds away don't count.
+        """
+        return None
+
+    def wait_for_frame(self, last_id: Optional[int] = None, timeout: Optional[float] = None) -> Optional[int]:
+        """Blocks until a frame with an id different from `last_id` is available, and returns 
+        the id of that frame. Waiting is done on a notification from the producing thread, 
+        so an idle consumer costs nothing while it waits.
+
+        Returns `None` if `timeout` (in seconds) elapses first, or if the source stops capturing.
+        Use `is_capturing` to tell the two apart.
+        """
+        raise NotImplementedError()
+
+    def is_capturing(self) -> bool:
+        """Whether the source is still producing frames. Once it isn't, `wait_for_frame` returns
+        `None` straight away, and no new frames will come.
+        """
+        return True
+
     def field_of_view(self) -> tuple[float, float]:
         """The horizontal and vertical field-of-views of the root frame source, respectively."""
         raise NotImplementedError()
@@ -47,25 +211,59 @@ class FrameSource:
 class Camera(FrameSource):
     frame_grabber: Thread
     frame_lock: Lock
+    frame_ready: Condition
     stop_capture: Event
     current_frame: np.ndarray
+    current_info: Optional[FrameInfo]
+    buffer_pool: BufferPool
+    history: Optional[FrameHistory]
     _frameid: int
 
-    def __init__(self):
+    # The format `_next_frame_` produces frames in. Subclasses change this before calling 
+    # `Camera.__init__`. Frames are stored as captured and only converted on request, so a 
+    # `JPEG` camera never decodes frames that are just forwarded (see `get_encoded_frame`), and
+    # a `YUV420` camera hands out `GRAY` frames without any conversion.
+    pixel_format: str = BGR
+
+    def __init__(self, buffer_count: int = 4, history_size: int = 0, history_bytes: Optional[int] = None):
+        """`buffer_count` is the number of preallocated frame buffers the camera cycles through.
+        A buffer is only reused once every consumer has let go of it, so this should be at least 
+        one more than the number of frames expected to be held at any one time.
+
+        If `history_size` is positive, that many recent frames (and at most `history_bytes` 
+        worth of them) are kept for `get_frame_by_id` and `get_frame_at`. Frames in the history 
+        hold on to their buffers, so the buffer pool is grown to match.
+        """
         self.frame_lock = Lock()
+        self.frame_ready = Condition(self.frame_lock)
         self.stop_capture = Event()
         # Only one thread should ever modify this, so no need for a mutex
         self._frameid = 0
         self.current_frame = None
+        self.current_info = None
+        self.buffer_pool = BufferPool(buffer_count + max(0, history_size))
+        self.history = FrameHistory(history_size, history_bytes) if history_size > 0 else None
+        self._conversions = _FormatCache()
 
         def _grab_frame():
+            layout = None
             while not self.stop_capture.is_set():
-                frame = self._next_frame_()
+                # compressed frames change size every time, so there's nothing to reuse
+                out = None if layout is None or self.encoded else self.buffer_pool.acquire(*layout)
+                frame = self._next_frame_(out)
+                captured = time.monotonic()
                 if frame is None:
                     continue
-                with self.frame_lock:
+                layout = (frame.shape, frame.dtype)
+                sensor_timestamp = self._sensor_timestamp_()
+                info = FrameInfo(self._frameid + 1, captured, sensor_timestamp)
+                if self.history is not None:
+                    self.history.add(frame, info)
+                with self.frame_ready:
                     self.current_frame = frame
-                self._frameid += 1
+                    self._frameid = info.frame_id
+                    self.current_info = info
+                    self.frame_ready.notify_all()
         self._frame_grabber_f = _grab_frame
         self.frame_grabber = Thread(target=self._frame_grabber_f)
         self.frame_grabber.start()
@@ -77,6 +275,8 @@ class Camera(FrameSource):
         if self.stop_capture.is_set():
             return
         self.stop_capture.set()
+        with self.frame_ready:
+            self.frame_ready.notify_all()
         self.frame_grabber.join()
 
     def get_frame(self) -> np.ndarray:
@@ -85,16 +285,80 @@ class Camera(FrameSource):
         between calls. For semi-guaranteed sequential frames, prefer any of the 
         frame limiter/sequencer classes.
 
-        Frame data is returned as a `numpy.ndarray` with depth 3 in BGR format
+        Frame data is returned as a `numpy.ndarray` with depth 3 in BGR format. The array 
+        belongs to the camera's buffer pool, but won't be reused while it (or any view of it)
+        is still referenced, so there is no need to copy it.
         """
-        with self.frame_lock:
-            # shouldn't take very long to copy, but better safe than sorry
-            res = self.current_frame
-        return res
+        return self.get_frame_with_info()[0]
+
+    def get_frame_with_info(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        frames, info = self.get_frame_as([BGR])
+        if frames is None:
+            return None, None
+        return frames[0], info
+
+    @property
+    def encoded(self) -> bool:
+        return self.pixel_format == JPEG
+
+    def pixel_formats(self) -> tuple[str, ...]:
+        others = tuple(f for f in (BGR, GRAY, YUV420) if f != self.pixel_format)
+        return (self.pixel_format,) + others
 
-    def _next_frame_(self) -> Optional[np.ndarray]:
+    def get_frame_as(self, pixel_formats: list[str]) -> tuple[Optional[list[np.ndarray]], Optional[FrameInfo]]:
+        with self.frame_lock:
+            frame, info = self.current_frame, self.current_info
+        if frame is None:
+            return None, None
+        return [self._conversions.convert(frame, info, self.pixel_format, f) for f in pixel_formats], info
+
+    def get_encoded_frame(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        if not self.encoded:
+            return None, None
+        with self.frame_lock:
+            return self.current_frame, self.current_info
+
+    def frame_info(self) -> Optional[FrameInfo]:
+        return self.current_info
+
+    def get_frame_by_id(self, frame_id: int) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        if self.history is None:
+            return None
+        return self._from_history(self.history.get_frame_by_id(frame_id))
+
+    def get_frame_at(self, timestamp: float, tolerance: Optional[float] = None) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        if self.history is None:
+            return None
+        return self._from_history(self.history.get_frame_at(timestamp, tolerance))
+
+    def _from_history(self, entry: Optional[tuple[np.ndarray, FrameInfo]]) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        # the history holds frames as captured, which is far cheaper for encoded cameras
+        if entry is None:
+            return entry
+        return self._conversions.convert(entry[0], entry[1], self.pixel_format, BGR), entry[1]
+
+    def _end_of_stream_(self):
+        """For use by subclasses whose source can run out of frames (files, for instance). Stops 
+        capturing from inside the capture thread, and wakes anyone waiting on a frame.
+        """
+        self.stop_capture.set()
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+
+    def _next_frame_(self, out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        """Captures the next frame. When `out` is provided, implementations should write the 
+        frame into it and return it, rather than allocating a new array. `out` is always 
+        shaped like the previous frame, and may be ignored if the frame size changed or the 
+        backend can't capture in place.
+        """
         raise NotImplementedError()
 
+    def _sensor_timestamp_(self) -> Optional[float]:
+        """The backend's own timestamp for the frame most recently returned by `_next_frame_`, 
+        in seconds, if it provides one.
+        """
+        return None
+
     def source(self) -> Any:
         raise NotImplementedError()
 
@@ -104,49 +368,185 @@ class Camera(FrameSource):
     def frame_id(self) -> int:
         return self._frameid
 
+    def wait_for_frame(self, last_id: Optional[int] = None, timeout: Optional[float] = None) -> Optional[int]:
+        return _wait_for_frame(self.frame_ready, lambda: self.current_frame is not None, 
+                               lambda: self._frameid, last_id, self.stop_capture, timeout)
+
+
+def _wait_for_frame(cond: Condition, has_frame: Callable[[], bool], current_id: Callable[[], int], 
+                    last_id: Optional[int], stopped: Event, timeout: Optional[float]) -> Optional[int]:
+    def ready() -> bool:
+        return stopped.is_set() or (has_frame() and current_id() != last_id)
+    with cond:
+        if not cond.wait_for(ready, timeout) or not has_frame() or current_id() == last_id:
+            return None
+        return current_id()
 
+
+# Either a plain callable, which returns a new frame, or a `BufferedLayer`, which writes into 
+# a buffer provided by the camera
 Layer = Callable[[np.ndarray], np.ndarray]
 
+class _LayerStage:
+    """A group of layers run back to back on a single worker thread of a pipelined `ProcessedCamera`."""
+    layers: list[Layer]
+    queue: Queue
+    worker: Thread
+    buffer_pool: BufferPool
+
+    def __init__(self, queue_depth: int, buffer_count: int):
+        self.layers = []
+        self.queue = Queue(maxsize=queue_depth)
+        # frames wait in the next stage's queue as well as being worked on and held by consumers
+        self.buffer_pool = BufferPool(queue_depth + buffer_count)
+        self.scratch = [None, None]
+
 class ProcessedCamera(FrameSource):
     _source: FrameSource
 
     frame_grabber: Thread
     frame_lock: Lock
+    frame_ready: Condition
     current_frame: np.ndarray
+    current_info: Optional[FrameInfo]
+    history: Optional[FrameHistory]
     _frame_id: int
 
     layers: list[Layer]
-
-    def __init__(self, source):
+    pipelined: bool
+    stages: list[_LayerStage]
+    stage_lock: Lock
+    queue_depth: int
+    buffer_count: int
+    buffer_pool: BufferPool
+
+    def __init__(self, source, pipelined: bool = False, queue_depth: int = 2, history_size: int = 0, history_bytes: Optional[int] = None, buffer_count: int = 4):
+        """Wraps `source` so that every frame is run through the layers added with `add_layer`.
+
+        By default all layers run serially on one thread. If `pipelined` is set, each stage of 
+        layers instead runs on its own worker, and stages hand frames to each other through 
+        queues holding at most `queue_depth` frames. This lets frame N+1 move through the first 
+        stage while frame N is in the second, so throughput is bound by the slowest stage rather 
+        than the sum of all of them. Frames always come out in order with their original ids. 
+        If the first stage falls behind, new frames are dropped rather than queued indefinitely.
+
+        `history_size` and `history_bytes` keep a history of processed frames, as for `Camera`.
+
+        Layers that are `BufferedLayer`s write into buffers the camera hands them instead of 
+        allocating their own. The results of the last layer come from a pool of `buffer_count` 
+        buffers (plus the history), which works like the pool of a `Camera`.
+        """
         self._source = source
         self.frame_lock = Lock()
+        self.frame_ready = Condition(self.frame_lock)
         self.stop_capture = Event()
         # Only one thread should ever modify this, so no need for a mutex
         self._frame_id = 0
 
         self.layers = []
         self.current_frame = None
+        self.current_info = None
+        self.history = FrameHistory(history_size, history_bytes) if history_size > 0 else None
+        self._conversions = _FormatCache()
+
+        self.pipelined = pipelined
+        self.stages = []
+        self.stage_lock = Lock()
+        self.queue_depth = queue_depth
+        self.buffer_count = buffer_count
+        self.buffer_pool = BufferPool(buffer_count + max(0, history_size))
+        self._scratch = [None, None]
 
         def _grab_frame():
+            last_id = None
             while not self.stop_capture.is_set():
-                if self._frame_id == self._source.frame_id():
+                # the timeout only exists so that stop requests are noticed
+                if self._source.wait_for_frame(last_id, timeout=0.1) is None:
+                    if not self._source.is_capturing():
+                        # the source ran out (the end of a file, say), so there's nothing 
+                        # more to wait for, and anyone waiting on this camera should know
+                        self._end_of_stream()
+                        return
+                    continue
+                if len(self.layers) == 0 and self.history is None:
+                    # Nothing to do to the frame, so it isn't even fetched, which would decode it
+                    # on a compressed camera. Whoever wants it gets it from the source instead.
+                    info = self._source.frame_info()
+                    if info is None:
+                        continue
+                    last_id = info.frame_id
+                    self._publish(info, None)
                     continue
-                frame = self._source.get_frame()
-                self._frame_id = self._source.frame_id()
+                frame, info = self._source.get_frame_with_info()
                 if frame is None:
                     continue
-                for layer in self.layers:
-                    frame = layer(frame)
-                with self.frame_lock:
-                    self.current_frame = frame
+                last_id = info.frame_id
+                if self.pipelined:
+                    self._enter_pipeline(info, frame)
+                    continue
+                frame = _apply_layers(self.layers, frame, self._scratch, self.buffer_pool.acquire)
+                self._publish(info, frame)
         self.frame_grabber = Thread(target=_grab_frame)
         self.frame_grabber.start()
-       
-    def stop(self):
-        if self.stop_capture.is_set():
+
+    def _publish(self, info: FrameInfo, frame: Optional[np.ndarray]):
+        if self.history is not None:
+            self.history.add(frame, info)
+        with self.frame_ready:
+            self.current_frame = frame
+            self.current_info = info
+            self._frame_id = info.frame_id
+            self.frame_ready.notify_all()
+
+    def _enter_pipeline(self, info: FrameInfo, frame: np.ndarray):
+        with self.stage_lock:
+            first = self.stages[0] if len(self.stages) > 0 else None
+        if first is None:
+            self._publish(info, frame)
             return
+        try:
+            first.queue.put_nowait((info, frame))
+        except Full:
+            # the pipeline is saturated; a newer frame will be along shortly
+            pass
+
+    def _run_stage(self, stage: _LayerStage):
+        while not self.stop_capture.is_set():
+            try:
+                info, frame = stage.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            frame = _apply_layers(stage.layers, frame, stage.scratch, stage.buffer_pool.acquire)
+
+            with self.stage_lock:
+                index = self.stages.index(stage)
+                following = self.stages[index+1] if index+1 < len(self.stages) else None
+            if following is None:
+                self._publish(info, frame)
+                continue
+            # Block rather than drop here, so that work already done isn't thrown away. The
+            # back pressure ends up at the first stage, which is where frames get dropped.
+            while not self.stop_capture.is_set():
+                try:
+                    following.queue.put((info, frame), timeout=0.1)
+                    break
+                except Full:
+                    continue
+       
+    def _end_of_stream(self):
         self.stop_capture.set()
-        self.frame_grabber.join()
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+
+    def stop(self):
+        # also after the source ended on its own, since the stages and source still need to stop
+        self._end_of_stream()
+        if self.frame_grabber is not current_thread():
+            self.frame_grabber.join()
+        with self.stage_lock:
+            stages = list(self.stages)
+        for stage in stages:
+            stage.worker.join()
         self._source.stop()
 
     def is_capturing(self) -> bool:
@@ -160,13 +560,78 @@ class ProcessedCamera(FrameSource):
 
         Frame data is returned as a `numpy.ndarray` with depth 3 in BGR format
         """
+        return self.get_frame_with_info()[0]
+
+    def get_frame_with_info(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
         with self.frame_lock:
-            # shouldn't take very long to copy, but better safe than sorry
-            res = self.current_frame
-        return res
+            frame, info = self.current_frame, self.current_info
+        if frame is None and info is not None:
+            # passed through without being fetched (see `_grab_frame`), so the source hands it out
+            return self._source.get_frame_with_info()
+        return frame, info
+
+    def frame_info(self) -> Optional[FrameInfo]:
+        return self.current_info
+
+    def pixel_formats(self) -> tuple[str, ...]:
+        # Layers work on BGR frames, so only an unprocessed source keeps its native format. What
+        # comes out of them is usually BGR too, unless the chain ends by converting to gray.
+        if len(self.layers) == 0:
+            return self._source.pixel_formats()
+        with self.frame_lock:
+            frame = self.current_frame
+        return _formats_from(BGR if frame is None else frame_format(frame))
 
-    def add_layer(self, layer: Layer):
+    def get_frame_as(self, pixel_formats: list[str]) -> tuple[Optional[list[np.ndarray]], Optional[FrameInfo]]:
+        if len(self.layers) == 0:
+            return self._source.get_frame_as(pixel_formats)
+        with self.frame_lock:
+            frame, info = self.current_frame, self.current_info
+        if frame is None:
+            return (None, None) if info is None else self._source.get_frame_as(pixel_formats)
+        native = frame_format(frame)
+        return [self._conversions.convert(frame, info, native, f) for f in pixel_formats], info
+
+    def get_frame_by_id(self, frame_id: int) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        if self.history is None:
+            return None
+        return self.history.get_frame_by_id(frame_id)
+
+    def get_frame_at(self, timestamp: float, tolerance: Optional[float] = None) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        if self.history is None:
+            return None
+        return self.history.get_frame_at(timestamp, tolerance)
+
+    def get_encoded_frame(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        # only unprocessed frames are still the same as the compressed original
+        if len(self.layers) != 0:
+            return None, None
+        return self._source.get_encoded_frame()
+
+    def add_layer(self, layer: Layer, stage: Optional[int] = None) -> int:
+        """Appends `layer` to the processing chain, and returns the index of the stage it runs in.
+
+        For pipelined cameras, each layer gets a stage (and worker) of its own unless `stage` 
+        is given, in which case it is grouped with the layers already in that stage. Grouping 
+        only makes sense with the last stage, since layers always run in the order they were 
+        added. Serial cameras have a single stage, 0.
+        """
         self.layers.append(layer)
+        if not self.pipelined:
+            return 0
+
+        with self.stage_lock:
+            if stage is not None:
+                if stage != len(self.stages) - 1:
+                    raise ValueError(f"layers can only be grouped into the last stage ({len(self.stages) - 1}), not {stage}")
+                self.stages[stage].layers.append(layer)
+                return stage
+            new_stage = _LayerStage(self.queue_depth, self.buffer_count)
+            new_stage.layers.append(layer)
+            new_stage.worker = Thread(target=self._run_stage, args=(new_stage,))
+            self.stages.append(new_stage)
+            new_stage.worker.start()
+            return len(self.stages) - 1
 
     def source(self) -> Any:
         return self._source.source()
@@ -176,3 +641,7 @@ class ProcessedCamera(FrameSource):
     
     def frame_id(self) -> int:
         return self._frame_id
+
+    def wait_for_frame(self, last_id: Optional[int] = None, timeout: Optional[float] = None) -> Optional[int]:
+        return _wait_for_frame(self.frame_ready, lambda: self.current_info is not None, 
+                               lambda: self._frame_id, last_id, self.stop_capture, timeout)
@@ -0,0 +1,229 @@
+import numpy as np
+from collections import deque
+from dataclasses import dataclass
+from threading import Thread, Lock, Event, Condition
+
+from typing import Any, Optional
+
+from .camera import FrameSource, FrameInfo, BGR, convert_frame, frame_format, _formats_from, _wait_for_frame
+
+
+@dataclass
+class SkewStats:
+    """Capture time offsets of one camera in a `CameraGroup`, relative to the group's first camera."""
+    matched: int = 0 # frames that made it into a group
+    dropped: int = 0 # frames that had no partner within the tolerance, or arrived too late
+    mean_skew: float = 0.0 # seconds, signed, so a consistent offset shows up here
+    max_skew: float = 0.0 # seconds, largest absolute offset seen
+
+    def _record(self, skew: float):
+        self.matched += 1
+        self.mean_skew += (skew - self.mean_skew) / self.matched
+        self.max_skew = max(self.max_skew, abs(skew))
+
+
+class CameraGroup(FrameSource):
+    """Captures from several sources at once, and pairs up frames that were captured at (nearly)
+    the same time.
+
+    Each published frame is a tuple with one frame per source, in the order the sources were
+    given, all captured within `tolerance` seconds of each other. Frames that can't be paired
+    up are dropped. The group hands out its own frame ids, while the `FrameInfo` of each member
+    frame is available from `member_infos`. The timestamp of a group is that of its earliest frame.
+
+    Each source is followed by its own thread, and only the `buffer_depth` most recent frames of
+    each are considered for pairing, so a slow source can't make the others back up. Once any
+    source stops, the groups that can still be made are published, and then the group stops too.
+    """
+    sources: list[FrameSource]
+    tolerance: float
+    buffer_depth: int
+
+    frame_lock: Lock
+    frame_ready: Condition
+    stop_capture: Event
+    current_frame: Optional[tuple[np.ndarray, ...]]
+    current_info: Optional[FrameInfo]
+    current_members: Optional[tuple[FrameInfo, ...]]
+    _frame_id: int
+
+    collectors: list[Thread]
+    pairer: Thread
+
+    def __init__(self, sources: list[FrameSource], tolerance: float = 0.005, buffer_depth: int = 4):
+        if len(sources) == 0:
+            raise ValueError("a camera group needs at least one source")
+        if tolerance < 0:
+            raise ValueError(f"tolerance must not be negative ({tolerance})")
+        self.sources = list(sources)
+        self.tolerance = tolerance
+        self.buffer_depth = buffer_depth
+
+        self.frame_lock = Lock()
+        self.frame_ready = Condition(self.frame_lock)
+        self.stop_capture = Event()
+        self.current_frame = None
+        self.current_info = None
+        self.current_members = None
+        self._frame_id = 0
+        self._stopped = False
+
+        self._pending = [deque() for _ in self.sources]
+        self._ended = [False for _ in self.sources]
+        self._pending_changed = Condition()
+        self._stats = [SkewStats() for _ in self.sources]
+
+        self.collectors = [Thread(target=self._collect, args=(i,)) for i in range(len(self.sources))]
+        self.pairer = Thread(target=self._pair)
+        for t in self.collectors:
+            t.start()
+        self.pairer.start()
+
+    def _collect(self, index: int):
+        source = self.sources[index]
+        pending = self._pending[index]
+        last_id = None
+        while not self.stop_capture.is_set():
+            # the timeout only exists so that stop requests are noticed
+            if source.wait_for_frame(last_id, timeout=0.1) is None:
+                if not source.is_capturing():
+                    # no more frames to pair with, the pairer ends the group once it runs dry
+                    with self._pending_changed:
+                        self._ended[index] = True
+                        self._pending_changed.notify()
+                    return
+                continue
+            frame, info = source.get_frame_with_info()
+            if frame is None:
+                continue
+            last_id = info.frame_id
+            with self._pending_changed:
+                if len(pending) >= self.buffer_depth:
+                    pending.popleft()
+                    self._stats[index].dropped += 1
+                pending.append((frame, info))
+                self._pending_changed.notify()
+
+    def _pair(self):
+        while not self.stop_capture.is_set():
+            with self._pending_changed:
+                self._pending_changed.wait_for(lambda: self.stop_capture.is_set() or self._can_pair(), timeout=0.1)
+                group = self._next_group()
+                ended = any(e and len(p) == 0 for e, p in zip(self._ended, self._pending))
+            if group is None:
+                if ended:
+                    self._end_of_stream()
+                continue
+            frames = tuple(f for f, _ in group)
+            members = tuple(info for _, info in group)
+            with self.frame_ready:
+                self._frame_id += 1
+                self.current_frame = frames
+                self.current_members = members
+                self.current_info = FrameInfo(self._frame_id, min(info.timestamp for info in members))
+                self.frame_ready.notify_all()
+
+    def _can_pair(self) -> bool:
+        # Must hold `_pending_changed`. True when there's something for `_pair` to do.
+        return all(len(p) > 0 or e for p, e in zip(self._pending, self._ended))
+
+    def _next_group(self) -> Optional[list[tuple[np.ndarray, FrameInfo]]]:
+        # Must hold `_pending_changed`. Looks at the oldest frame from each source: if they're all
+        # close enough together, that's a group. Otherwise the oldest of them can't be paired with
+        # anything that will arrive later, so it's dropped, and we look again.
+        while all(len(p) > 0 for p in self._pending):
+            times = [p[0][1].timestamp for p in self._pending]
+            if max(times) - min(times) <= self.tolerance:
+                group = [p.popleft() for p in self._pending]
+                for stats, t in zip(self._stats, times):
+                    stats._record(t - times[0])
+                return group
+            oldest = times.index(min(times))
+            self._pending[oldest].popleft()
+            self._stats[oldest].dropped += 1
+        return None
+
+    def _end_of_stream(self):
+        self.stop_capture.set()
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+        with self._pending_changed:
+            self._pending_changed.notify_all()
+
+    def stop(self):
+        # also after the group ended on its own, since the sources still need to stop
+        if self._stopped:
+            return
+        self._stopped = True
+        self._end_of_stream()
+        for t in self.collectors:
+            t.join()
+        self.pairer.join()
+        for source in self.sources:
+            source.stop()
+
+    def is_capturing(self) -> bool:
+        return self.pairer.is_alive()
+
+    def get_frame(self) -> Optional[tuple[np.ndarray, ...]]:
+        """Returns the most recent group of frames, one per source."""
+        with self.frame_lock:
+            return self.current_frame
+
+    def get_frame_with_info(self) -> tuple[Optional[tuple[np.ndarray, ...]], Optional[FrameInfo]]:
+        with self.frame_lock:
+            return self.current_frame, self.current_info
+
+    def frame_info(self) -> Optional[FrameInfo]:
+        return self.current_info
+
+    def pixel_formats(self) -> tuple[str, ...]:
+        """The formats every member frame can be had in, see `get_frame_as`."""
+        with self.frame_lock:
+            frames = self.current_frame
+        return _formats_from(BGR if frames is None else frame_format(frames[0]))
+
+    def get_frame_as(self, pixel_formats: list[str]) -> tuple[Optional[list[tuple[np.ndarray, ...]]], Optional[FrameInfo]]:
+        """Like `get_frame_with_info`, but with each member frame converted to each of the given 
+        pixel formats: one tuple of member frames per format, in source order.
+        """
+        frames, info = self.get_frame_with_info()
+        if frames is None:
+            return None, None
+        converted = []
+        for frame in frames:
+            native = frame_format(frame)
+            known = {}
+            for f in pixel_formats:
+                known[f] = convert_frame(frame, native, f, known)
+            converted.append(known)
+        return [tuple(known[f] for known in converted) for f in pixel_formats], info
+
+    def member_infos(self) -> Optional[tuple[FrameInfo, ...]]:
+        """The `FrameInfo` of each frame in the current group, in source order."""
+        with self.frame_lock:
+            return self.current_members
+
+    def skew_statistics(self) -> list[SkewStats]:
+        """Per-source pairing statistics, in source order. The first source is the reference, so its
+        skew is always 0.
+        """
+        with self._pending_changed:
+            return [SkewStats(s.matched, s.dropped, s.mean_skew, s.max_skew) for s in self._stats]
+
+    def source(self) -> tuple[Any, ...]:
+        return tuple(s.source() for s in self.sources)
+
+    def frame_size(self) -> tuple[int, int]:
+        """The frame size of the first source. Use `frame_sizes` for the rest."""
+        return self.sources[0].frame_size()
+
+    def frame_sizes(self) -> list[tuple[int, int]]:
+        return [s.frame_size() for s in self.sources]
+
+    def frame_id(self) -> int:
+        return self._frame_id
+
+    def wait_for_frame(self, last_id: Optional[int] = None, timeout: Optional[float] = None) -> Optional[int]:
+        return _wait_for_frame(self.frame_ready, lambda: self.current_frame is not None,
+                               lambda: self._frame_id, last_id, self.stop_capture, timeout)
@@ -0,0 +1,57 @@
+import cv2 as cv
+import numpy as np
+import time
+
+from typing import Any, Optional
+
+
+class ChangeDetector:
+    """Tells whether a frame looks any different from the last one sent, cheaply.
+
+    Frames are shrunk to a small luminance `thumbnail_size` (width, height) by area averaging,
+    which also averages away sensor noise, and a frame counts as changed once any cell of its
+    thumbnail differs from the reference by more than `threshold` (in 0-255 levels). Changes
+    are always measured against the last frame that counted as changed, so slow drift still
+    adds up to a change eventually.
+
+    References are kept per key (a `StreamProfile`, say), since streams sent at different
+    rates have each last seen a different frame. A key is reported as changed at least every
+    `max_repeat_age` seconds regardless, so anything that missed a frame catches up.
+    """
+    threshold: float
+    thumbnail_size: tuple[int, int]
+    max_repeat_age: float
+
+    def __init__(self, threshold: float = 3.0, thumbnail_size: tuple[int, int] = (32, 24), max_repeat_age: float = 1.0):
+        if threshold < 0:
+            raise ValueError(f"threshold must not be negative ({threshold})")
+        self.threshold = threshold
+        self.thumbnail_size = (int(thumbnail_size[0]), int(thumbnail_size[1]))
+        self.max_repeat_age = max_repeat_age
+        self._references = {}
+
+    def thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        """The luminance thumbnail of a BGR or grayscale frame."""
+        small = cv.resize(frame, self.thumbnail_size, interpolation=cv.INTER_AREA)
+        if small.ndim == 3:
+            small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        # signed, so differences don't wrap around
+        return small.astype(np.int16)
+
+    def changed(self, thumbnail: np.ndarray, key: Any = None, now: Optional[float] = None) -> bool:
+        """Whether `thumbnail` differs from the reference for `key`. If it does, it becomes the
+        new reference.
+        """
+        if now is None:
+            now = time.monotonic()
+        reference = self._references.get(key)
+        if (reference is None or reference[0].shape != thumbnail.shape or now - reference[1] >= self.max_repeat_age
+                or np.abs(thumbnail - reference[0]).max() > self.threshold):
+            self._references[key] = (thumbnail, now)
+            return True
+        return False
+
+    def forget(self, keep: Any):
+        """Drops the references for every key not in `keep`."""
+        for key in [k for k in self._references if k not in keep]:
+            del self._references[key]
@@ -7,33 +7,65 @@ from typing import Optional
 
 
 from .socket_buffer import BufferedSocket
-from .message import parse_frame, parse_data, salvage_frame_stream, salvage_data_stream
+from .message import MessageHeader, FRAME, StreamProfile, TileDecoder, SUBSCRIBE_MAGIC_FLAG, KEYFRAME_REQUEST, format_subscription, decode_image, sequence_gap, parse_repeat, parse_frame, parse_data, salvage_frame_stream, salvage_data_stream
 from .match_data import MatchData
+from .udp import FrameReassembler, multicast_membership, DATAGRAM_KEEPALIVE
 
 class FrameStreamClient:
     _latest_result: Optional[np.ndarray]
+    _latest_header: Optional[MessageHeader]
+    _received_at: float
     listen_worker: Thread
     listener: BufferedSocket
+    tiles: TileDecoder
     latest_lock: Lock
+    received: int
+    missed: int # messages the server sent that never arrived, going by their sequence numbers
 
     terminate_call: Event
 
-    def __init__(self, address: str, port: int):
+    def __init__(self, address: str, port: int, profile: Optional[StreamProfile] = None, latest_only: bool = False):
+        """`profile` asks the server for video at a particular size, codec, quality and rate. 
+        Without one, the server sends its default stream.
+
+        With `latest_only`, frames that already have another frame waiting behind them aren't 
+        decoded, so a client that fell behind skips straight to the newest frame rather than 
+        working through the backlog.
+        """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(10)
         sock.connect((address, port))
+        if profile is not None:
+            sock.sendall(format_subscription(profile))
         sock.settimeout(1)
         
         self.latest_lock = Lock()
         self.terminate_call = Event()
         self.listener = BufferedSocket(sock)
+        # for `TILES` streams, which only send what changed
+        self.tiles = TileDecoder()
+        self.received = 0
+        self.missed = 0
         def listen_up():
+            requested = 0
+            sequence = None
             try:
                 while not self.terminate_call.is_set():
                     try:
-                        res = parse_frame(self.listener)
+                        res = parse_frame(self.listener, self.tiles, latest_only)
                         if res is not None:
-                            self.latest_result = res
+                            frame, header = res
+                            self.received += 1
+                            self.missed += sequence_gap(header.sequence, sequence)
+                            sequence = header.sequence
+                            if frame is not None:
+                                self._set_latest(frame, header)
+                            elif header.kind != FRAME:
+                                # a repeat keeps the image we have, and only brings a new header
+                                self._set_latest(self._latest_result, header)
+                            if self.tiles.needs_keyframe and time.monotonic() - requested > 0.5:
+                                sock.sendall(KEYFRAME_REQUEST)
+                                requested = time.monotonic()
                         else:
                             if not salvage_frame_stream(self.listener):
                                 raise ValueError("frame stream was corrupted and could not be salvaged")
@@ -42,12 +74,15 @@ class FrameStreamClient:
                         continue
             except OSError:
                 self._latest_result = None
+                self._latest_header = None
                 print("Something went wrong and the stream no longer works")
                 return
                     
 
         self.listen_worker = Thread(target=listen_up)
         self._latest_result = None
+        self._latest_header = None
+        self._received_at = 0
 
     def start(self):
         if self.terminate_call.is_set():
@@ -62,6 +97,10 @@ class FrameStreamClient:
         self.listener.sock.close()
         self.listen_worker.join()
 
+    def subscribe(self, profile: StreamProfile):
+        """Switches to video in `profile`, from the next frame the server sends."""
+        self.listener.sock.sendall(format_subscription(profile))
+
     @property
     def latest_result(self) -> Optional[np.ndarray]:
         with self.latest_lock:
@@ -72,14 +111,41 @@ class FrameStreamClient:
         with self.latest_lock:
             self._latest_result = matches
 
+    def _set_latest(self, result, header: MessageHeader):
+        with self.latest_lock:
+            self._latest_result = result
+            self._latest_header = header
+            self._received_at = time.monotonic()
+
+    @property
+    def latest_header(self) -> Optional[MessageHeader]:
+        """The header of the latest result: which frame it's from, when that was captured (on 
+        the server's clock) and how long it spent on the server, see `MessageHeader`.
+        """
+        with self.latest_lock:
+            return self._latest_header
+
+    def latest_age(self) -> Optional[float]:
+        """How long ago, in seconds, the latest result was captured. This covers the time spent 
+        on the server and the time since it arrived here, but not the time spent in transit.
+        """
+        with self.latest_lock:
+            if self._latest_header is None:
+                return None
+            return self._latest_header.age + (time.monotonic() - self._received_at)
+
     def has_result(self) -> bool:
         return self._latest_result is not None
 
 class MatchDataStreamClient:
     _latest_result: Optional[list[MatchData]]
+    _latest_header: Optional[MessageHeader]
+    _received_at: float
     listen_worker: Thread
     listener: BufferedSocket
     latest_lock: Lock
+    received: int
+    missed: int # messages the server sent that never arrived, going by their sequence numbers
 
     def __init__(self, address: str, port: int):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -90,13 +156,19 @@ class MatchDataStreamClient:
         self.latest_lock = Lock()
         self.terminate_call = Event()
         self.listener = BufferedSocket(sock)
+        self.received = 0
+        self.missed = 0
         def listen_up():
+            sequence = None
             try:
                 while not self.terminate_call.is_set(): 
                     try:
                         res = parse_data(self.listener)
                         if res is not None:
-                            self.latest_result = res
+                            self.received += 1
+                            self.missed += sequence_gap(res[1].sequence, sequence)
+                            sequence = res[1].sequence
+                            self._set_latest(*res)
                         else: 
                             if not salvage_data_stream(self.listener):
                                 raise ValueError("data stream was corrupted and could not be salvaged")
@@ -105,11 +177,14 @@ class MatchDataStreamClient:
                         continue
             except OSError:
                 self._latest_result = None
+                self._latest_header = None
                 print("Something went wrong and the stream no longer works")
                 return
 
         self.listen_worker = Thread(target=listen_up)
         self._latest_result = None
+        self._latest_header = None
+        self._received_at = 0
 
     def start(self):
         if self.terminate_call.is_set():
@@ -129,5 +204,173 @@ class MatchDataStreamClient:
         with self.latest_lock:
             self._latest_result = matches
 
+    def _set_latest(self, result, header: MessageHeader):
+        with self.latest_lock:
+            self._latest_result = result
+            self._latest_header = header
+            self._received_at = time.monotonic()
+
+    @property
+    def latest_header(self) -> Optional[MessageHeader]:
+        """The header of the latest result: which frame it's from, when that was captured (on 
+        the server's clock) and how long it spent on the server, see `MessageHeader`.
+        """
+        with self.latest_lock:
+            return self._latest_header
+
+    def latest_age(self) -> Optional[float]:
+        """How long ago, in seconds, the latest result was captured. This covers the time spent 
+        on the server and the time since it arrived here, but not the time spent in transit.
+        """
+        with self.latest_lock:
+            if self._latest_header is None:
+                return None
+            return self._latest_header.age + (time.monotonic() - self._received_at)
+
+    def has_result(self) -> bool:
+        return self._latest_result is not None
+
+class DatagramFrameStreamClient:
+    """Receives video over UDP, see `DatagramOptions`.
+
+    Frames arrive in fragments, and a frame that lost any of them is simply skipped (see 
+    `FrameReassembler`), so a lost packet never delays the frames after it, the way it would 
+    on a `FrameStreamClient`.
+
+    Without a `multicast_group`, the client subscribes at `address`:`port` with `profile` (the 
+    server's default, if `None`), and keeps renewing the subscription while it runs. With one 
+    (an address and port), it joins that group on `multicast_interface` instead, and gets 
+    whatever the server sends there.
+    """
+    _latest_result: Optional[np.ndarray]
+    _latest_header: Optional[MessageHeader]
+    _received_at: float
+    listen_worker: Thread
+    sock: socket.socket
+    reassembler: FrameReassembler
+    tiles: TileDecoder
+    latest_lock: Lock
+    missed: int # messages the server sent that never arrived, going by their sequence numbers
+
+    terminate_call: Event
+
+    def __init__(self, address: str, port: int, profile: Optional[StreamProfile] = None, multicast_group: Optional[tuple[str, int]] = None, multicast_interface: Optional[str] = None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # frames are lost rather than delayed when the buffer overflows, so make room for a few
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        if multicast_group is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(("", multicast_group[1]))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_membership(multicast_group[0], multicast_interface))
+            subscription = None
+        else:
+            self.sock.bind(("", 0))
+            subscription = SUBSCRIBE_MAGIC_FLAG if profile is None else format_subscription(profile)
+        self.sock.settimeout(0.2)
+
+        self.latest_lock = Lock()
+        self.terminate_call = Event()
+        self.reassembler = FrameReassembler()
+        self.tiles = TileDecoder()
+        self.missed = 0
+        self._sequence = None
+        def listen_up():
+            renewed = 0
+            requested = 0
+            while not self.terminate_call.is_set():
+                try:
+                    if subscription is not None and time.monotonic() - renewed >= DATAGRAM_KEEPALIVE:
+                        self.sock.sendto(subscription, (address, port))
+                        renewed = time.monotonic()
+                    datagram = self.sock.recv(65535)
+                    header = parse_repeat(datagram)
+                    if header is not None:
+                        self._count(header)
+                        if self._latest_result is not None:
+                            self._set_latest(self._latest_result, header)
+                        continue
+                except TimeoutError:
+                    continue
+                except ConnectionRefusedError:
+                    # nothing listening at the server's port (yet), keep asking
+                    continue
+                except OSError:
+                    if not self.terminate_call.is_set():
+                        print("Something went wrong and the stream no longer works")
+                    return
+                res = self.reassembler.add(datagram)
+                if res is None:
+                    continue
+                image, header = res
+                self._count(header)
+                try:
+                    frame = decode_image(image, header.codec_id, self.tiles)
+                except ValueError:
+                    # sent with a codec we don't know
+                    continue
+                if self.tiles.needs_keyframe and time.monotonic() - requested > 0.5:
+                    try:
+                        self.sock.sendto(KEYFRAME_REQUEST, (address, port))
+                    except OSError:
+                        pass
+                    requested = time.monotonic()
+                if frame is not None:
+                    self._set_latest(frame, header)
+
+        self.listen_worker = Thread(target=listen_up)
+        self._latest_result = None
+        self._latest_header = None
+        self._received_at = 0
+
+    def start(self):
+        if self.terminate_call.is_set():
+            raise ValueError("cannot restart a terminated stream client")
+        self.listen_worker.start()
+
+    def stop(self):
+        if self.terminate_call.is_set():
+            return
+        self.terminate_call.set()
+        if self.listen_worker.ident is not None:
+            self.listen_worker.join()
+        self.sock.close()
+
+    @property
+    def latest_result(self) -> Optional[np.ndarray]:
+        with self.latest_lock:
+            return self._latest_result
+
+    def _set_latest(self, result, header: MessageHeader):
+        with self.latest_lock:
+            self._latest_result = result
+            self._latest_header = header
+            self._received_at = time.monotonic()
+
+    @property
+    def latest_header(self) -> Optional[MessageHeader]:
+        """The header of the latest frame, see `MessageHeader`."""
+        with self.latest_lock:
+            return self._latest_header
+
+    def latest_age(self) -> Optional[float]:
+        """How long ago, in seconds, the latest frame was captured. This covers the time spent 
+        on the server and the time since it arrived here, but not the time spent in transit.
+        """
+        with self.latest_lock:
+            if self._latest_header is None:
+                return None
+            return self._latest_header.age + (time.monotonic() - self._received_at)
+
     def has_result(self) -> bool:
         return self._latest_result is not None
+
+    def _count(self, header: MessageHeader):
+        # only new messages count, since the reassembler already passed over late fragments
+        self.missed += sequence_gap(header.sequence, self._sequence)
+        self._sequence = header.sequence
+
+    def stats(self) -> dict[str, int]:
+        """How many frames were completed, how many were lost to missing fragments, and how 
+        many messages went missing altogether.
+        """
+        return {**self.reassembler.stats(), "missed": self.missed}
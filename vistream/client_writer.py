@@ -0,0 +1,158 @@
+import socket
+import time
+from collections import deque
+
+from typing import Union
+
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+
+# A message is either a single buffer, or a list of them to be sent back to back (see 
+# `encoded_frame_segments`). Buffers are only ever read, so one message can be queued for 
+# any number of clients at once.
+Message = Union[bytes, list[memoryview]]
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+class ClientWriter:
+    """Sends messages to one client without ever blocking the caller.
+
+    Messages wait in a queue of at most `max_queue`, and `pump` writes as much as the socket
+    will take right now, picking up partway through a message where the last call left off.
+    A message that has started going out is always finished before the next one starts, so
+    messages are never interleaved or cut short. Messages made of several buffers go out with
+    `socket.sendmsg`, and a partial send just moves past what was sent, so message data is
+    never copied.
+
+    `latency` tracks (as a moving average) how long messages take from being queued to their 
+    last byte being handed to the kernel.
+
+    When the queue is full, `policy` decides what happens to a new message:
+        "drop_oldest":  the oldest message that hasn't started sending yet is dropped
+        "drop_newest":  the new message is dropped
+        "disconnect":   like "drop_oldest", but once the client has gone `stall_timeout`
+                        seconds without accepting a single byte, it is disconnected
+    """
+    sock: socket.socket
+    max_queue: int
+    policy: str
+    stall_timeout: float
+
+    sent: int
+    dropped: int
+    bytes_sent: int
+    latency: float
+    closed: bool
+
+    def __init__(self, sock: socket.socket, max_queue: int = 2, policy: str = DROP_OLDEST, stall_timeout: float = 1.0):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, DISCONNECT):
+            raise ValueError(f"unknown send policy '{policy}'")
+        if max_queue <= 0:
+            raise ValueError(f"queue must hold at least one message ({max_queue})")
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.max_queue = max_queue
+        self.policy = policy
+        self.stall_timeout = stall_timeout
+        # messages, along with when they were queued
+        self.queue = deque()
+        # what's left of the message being sent, as views into its buffers
+        self._current = None
+        self._current_queued_at = 0
+        self._last_progress = time.monotonic()
+
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.latency = 0
+        self.closed = False
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def pending(self) -> bool:
+        """Whether there's anything left to send."""
+        return self._current is not None or len(self.queue) > 0
+
+    def enqueue(self, msg: Message):
+        if self.closed:
+            return
+        if not self.pending():
+            # an idle client isn't stalled, however long it's been since it last took data
+            self._last_progress = time.monotonic()
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+            self.queue.popleft()
+        self.queue.append((msg, time.monotonic()))
+
+    def pump(self) -> bool:
+        """Writes as much as the socket accepts without blocking. Returns `False` once the client
+        is gone, either because the connection failed or because it stalled for too long.
+        """
+        while not self.closed and self.pending():
+            if self._current is None:
+                msg, self._current_queued_at = self.queue.popleft()
+                segments = [msg] if isinstance(msg, (bytes, bytearray, memoryview)) else msg
+                self._current = deque(memoryview(b).cast("B") for b in segments if len(b) > 0)
+                if len(self._current) == 0:
+                    self._finished()
+                    continue
+            try:
+                if len(self._current) == 1 or not _HAS_SENDMSG:
+                    n = self.sock.send(self._current[0])
+                else:
+                    n = self.sock.sendmsg(self._current)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close()
+                break
+            self.bytes_sent += n
+            self._last_progress = time.monotonic()
+            self._advance(n)
+            if len(self._current) == 0:
+                self._finished()
+
+        if self.policy == DISCONNECT and self.pending() and self.stalled_for() > self.stall_timeout:
+            self.close()
+        return not self.closed
+
+    def _finished(self):
+        self._current = None
+        self.sent += 1
+        self.latency += 0.25 * (time.monotonic() - self._current_queued_at - self.latency)
+
+    def _advance(self, n: int):
+        # drop whatever was sent entirely, and start the rest partway through its first buffer
+        while n > 0:
+            first = self._current[0]
+            if n < len(first):
+                self._current[0] = first[n:]
+                return
+            n -= len(first)
+            self._current.popleft()
+
+    def stalled_for(self) -> float:
+        """Seconds since the client last accepted any data while something was waiting to be sent."""
+        if not self.pending():
+            return 0
+        return time.monotonic() - self._last_progress
+
+    def stats(self) -> dict[str, int]:
+        return {"sent": self.sent, "dropped": self.dropped, "queued": len(self.queue), "bytes_sent": self.bytes_sent}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self._current = None
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
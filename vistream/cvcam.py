@@ -1,11 +1,24 @@
 
-from .camera import Camera
+from .camera import Camera, JPEG
 import cv2 as cv
 import numpy as np
+import os
+import sys
+import struct
+from glob import glob
+from threading import Lock
 
 from typing import Optional
 
-def _detect_cameras(skip: int = 0, max_fail: int = 3) -> list[int]:
+# from linux/videodev2.h
+VIDIOC_QUERYCAP = 0x80685600 # _IOR('V', 0, struct v4l2_capability), which is 104 bytes
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+
+def _probe_cameras(skip: int = 0, max_fail: int = 3) -> list[int]:
+    """The slow way of finding cameras: open each device id with OpenCV until a few in a row fail.
+    Only used where there's no sysfs to ask.
+    """
     failures = 0
     cam_id = skip
     ids = []
@@ -18,56 +31,153 @@ def _detect_cameras(skip: int = 0, max_fail: int = 3) -> list[int]:
             failures += 1
         cam.release()
         cam_id += 1
-    print(ids)
     return ids
 
+def _is_capture_device(index: int) -> bool:
+    """Asks V4L2 whether /dev/video`index` can capture video. This opens the device node, but
+    doesn't start a stream or claim the device. Nodes that can't be queried fall back to sysfs,
+    where UVC cameras list their metadata nodes with a non-zero index.
+    """
+    import fcntl # only ever called on Linux
+    try:
+        fd = os.open(f"/dev/video{index}", os.O_RDWR | os.O_NONBLOCK)
+        try:
+            caps = fcntl.ioctl(fd, VIDIOC_QUERYCAP, bytes(104))
+        finally:
+            os.close(fd)
+        capabilities, device_caps = struct.unpack_from("<II", caps, 84)
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        return bool(capabilities & V4L2_CAP_VIDEO_CAPTURE)
+    except OSError:
+        pass
+    try:
+        with open(f"/sys/class/video4linux/video{index}/index") as f:
+            return int(f.read().strip()) == 0
+    except (OSError, ValueError):
+        return True
+
+def _enumerate_cameras() -> list[int]:
+    if not sys.platform.startswith("linux"):
+        return _probe_cameras()
+    nodes = glob("/sys/class/video4linux/video*") or glob("/dev/video*")
+    ids = []
+    for node in nodes:
+        suffix = os.path.basename(node)[len("video"):]
+        if suffix.isdigit():
+            ids.append(int(suffix))
+    return [i for i in sorted(ids) if _is_capture_device(i)]
+
+
+_camera_cache: Optional[list[int]] = None
+_claimed_cameras: set[int] = set()
+_camera_lock = Lock()
+
+def detect_cameras(refresh: bool = False) -> list[int]:
+    """Returns the ids of video capture devices that aren't already in use by a `CVCamera`.
+
+    Devices are found once, on first use, and the result is cached. Pass `refresh` to look 
+    again, for instance after plugging in a camera. On Linux this only lists the video nodes 
+    and asks each one for its capabilities, which takes milliseconds. Elsewhere it falls back to opening 
+    devices with OpenCV, which is much slower.
+    """
+    global _camera_cache
+    with _camera_lock:
+        if _camera_cache is None or refresh:
+            _camera_cache = _enumerate_cameras()
+        return [i for i in _camera_cache if i not in _claimed_cameras]
+
+
+class _PossibleCameras:
+    # Keeps `CVCamera.possible_cameras` working as a class attribute, without doing any 
+    # discovery until someone actually reads it.
+    def __get__(self, _instance, _owner) -> list[int]:
+        return detect_cameras()
+
 
 class CVCamera(Camera):
     cam: cv.VideoCapture
+    device_id: int
 
-    possible_cameras = _detect_cameras()
+    possible_cameras = _PossibleCameras()
 
-    def __init__(self, source = None):
+    def __init__(self, source = None, passthrough: bool = False):
         """Create a new instance of a USB camera.
 
         `source` must be the valid video device number that can be accessed by OpenCV's
-        `VideoCapture`. A limited, but significant number of devices are checked on startup
-        and valid devices are listed in `USBCamera.possible_cameras`.
+        `VideoCapture`. Devices that are available and not already in use are listed in 
+        `USBCamera.possible_cameras`, which is worked out the first time it's needed 
+        (see `detect_cameras`).
 
         If `source` is `None`, the first device from `USBCamera.possible_cameras` is used.
+
+        With `passthrough`, OpenCV is asked not to decode the camera's MJPEG frames. They are 
+        then available as-is from `get_encoded_frame`, and only decoded if someone asks for 
+        pixels. Backends that can't deliver raw frames fall back to decoding as usual.
         """
         if source is not None and type(source) is not int:
             raise ValueError(f"device id must be an integer")
         
         if source is None:
-            if len(USBCamera.possible_cameras) != 0:
-                source = USBCamera.possible_cameras[0]
+            available = detect_cameras()
+            if len(available) != 0:
+                source = available[0]
             else:
                 raise ValueError("no known devices available. Cannot initialize camera")
 
-        USBCamera.possible_cameras.remove(source)
+        with _camera_lock:
+            if source in _claimed_cameras:
+                raise ValueError(f"device {source} is already in use")
+            _claimed_cameras.add(source)
 
         cam = cv.VideoCapture(source)
         cam.set(cv.CAP_PROP_FOURCC,cv.VideoWriter_fourcc(*"MJPG"))
         if not cam.isOpened():
-            raise f"VideoCapture could not open source at '{source}'"
+            with _camera_lock:
+                _claimed_cameras.discard(source)
+            raise ValueError(f"VideoCapture could not open source at '{source}'")
         self.cam = cam
+        self.device_id = source
+        if passthrough and self._enable_passthrough():
+            self.pixel_format = JPEG
         super().__init__()
 
+    def _enable_passthrough(self) -> bool:
+        self.cam.set(cv.CAP_PROP_CONVERT_RGB, 0)
+        ok, probe = self.cam.read()
+        if ok and probe.ndim <= 2 and probe.size > 2 and probe.reshape(-1)[0] == 0xFF and probe.reshape(-1)[1] == 0xD8:
+            return True
+        self.cam.set(cv.CAP_PROP_CONVERT_RGB, 1)
+        print(f"device {self.device_id} can't pass MJPEG frames through; decoding them instead")
+        return False
+
     def source(self) -> cv.VideoCapture:
         return self.cam
     
     def frame_size(self) -> tuple[int, int]:
         return (int(self.cam.get(cv.CAP_PROP_FRAME_WIDTH)), int(self.cam.get(cv.CAP_PROP_FRAME_HEIGHT)))
     
-    def _next_frame_(self) -> Optional[np.ndarray]:
-        ok, frame = self.cam.read()
+    def _next_frame_(self, out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        # OpenCV decodes straight into `out` when the size matches, and reallocates otherwise
+        ok, frame = self.cam.read(image=out)
         if not ok:
             return None
+        if self.encoded:
+            # raw frames come back as a single row or column of bytes
+            return frame.reshape(-1)
         return frame
+
+    def _sensor_timestamp_(self) -> Optional[float]:
+        # V4L2 reports the driver's buffer timestamp here. Zero means the backend doesn't have one.
+        msec = self.cam.get(cv.CAP_PROP_POS_MSEC)
+        if msec <= 0:
+            return None
+        return msec / 1000
     
     def stop(self):
         super().stop()
         self.cam.release()
+        with _camera_lock:
+            _claimed_cameras.discard(self.device_id)
 
 USBCamera = CVCamera
@@ -0,0 +1,64 @@
+import numpy as np
+from collections import OrderedDict
+from threading import Lock
+
+from .camera import FrameInfo
+from .message import StreamProfile
+
+
+class EncodeCache:
+    """Encoded frames, keyed by frame id and `StreamProfile`, so that each frame is encoded at
+    most once per profile, however many streams ask for it. A single stream already encodes 
+    each profile once per frame, so this is for several `MatchStream`s of the same source, 
+    which all pass the same cache.
+
+    Entries are dropped once their frame was captured more than `max_age` seconds before the
+    newest frame in the cache, so the cache only ever holds the last moments of video. At most
+    `max_entries` are kept regardless, in case frames arrive faster than expected.
+    """
+    max_age: float
+    max_entries: int
+    cache_lock: Lock
+    encodes: int
+    hits: int
+
+    def __init__(self, max_age: float = 0.5, max_entries: int = 32):
+        if max_age < 0:
+            raise ValueError(f"max_age must not be negative ({max_age})")
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.cache_lock = Lock()
+        self.encodes = 0
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._newest = None
+
+    def get(self, frame: np.ndarray, info: FrameInfo, profile: StreamProfile) -> np.ndarray:
+        """`frame` (whose info is `info`) encoded with `profile`."""
+        key = (info.frame_id, profile)
+        with self.cache_lock:
+            if key in self._entries:
+                self.hits += 1
+                return self._entries[key][1]
+        encoded = profile.encode(frame)
+        with self.cache_lock:
+            self.encodes += 1
+            self._entries[key] = (info.timestamp, encoded)
+            if self._newest is None or info.timestamp > self._newest:
+                self._newest = info.timestamp
+            self._evict()
+        return encoded
+
+    def _evict(self):
+        for key in [k for k, (timestamp, _) in self._entries.items() if timestamp < self._newest - self.max_age]:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self.cache_lock:
+            self._entries.clear()
+            self._newest = None
@@ -0,0 +1,220 @@
+import selectors
+import socket
+from collections import deque
+from threading import Thread, Lock, current_thread
+
+from typing import Any, Optional, Callable
+
+from .client_writer import ClientWriter, DISCONNECT
+
+
+class EventLoop:
+    """A single thread that does all the socket work for any number of streams: accepting
+    clients, writing to them as their sockets have room, and noticing when they go away.
+
+    Everything waits on one `selectors` call, so new clients are accepted the moment they
+    connect, and nothing polls. Other threads hand work to the loop with `call_soon`, which
+    wakes it through a socket pair. Clients are only ever touched from the loop thread.
+
+    The loop thread runs while anything holds it, see `acquire` and `release`.
+    """
+    selector: selectors.BaseSelector
+    loop_thread: Optional[Thread]
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._wake_send.setblocking(False)
+        self.selector.register(self._wake_recv, selectors.EVENT_READ, None)
+        self._calls = deque()
+        self._calls_lock = Lock()
+        self._users = 0
+        self._running = False
+        self.loop_thread = None
+        self._clients = {}
+
+    def acquire(self):
+        """Starts the loop thread, if this is its first user."""
+        with self._calls_lock:
+            self._users += 1
+            if self._users > 1:
+                return
+            # an earlier thread may still be on its way out
+            previous = self.loop_thread
+            self._running = True
+            self.loop_thread = Thread(target=self._run, args=(previous,))
+            self.loop_thread.start()
+
+    def release(self):
+        """Stops the loop thread once its last user has let go. Work that was already handed to
+        the loop with `call_soon` is finished first, and then any clients still left are closed.
+        """
+        with self._calls_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._running = False
+            thread = self.loop_thread
+        self._wake()
+        if thread is not None and thread is not current_thread():
+            thread.join()
+
+    def call_soon(self, f: Callable[..., Any], *args: Any):
+        """Runs `f(*args)` on the loop thread."""
+        with self._calls_lock:
+            self._calls.append((f, args))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_send.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # the loop already has a wakeup waiting, which is all it needs
+            pass
+
+    def add_listener(self, listener: socket.socket, on_accept: Callable[[socket.socket], None]):
+        """Calls `on_accept` with every connection `listener` accepts. Call from the loop thread."""
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, ("accept", on_accept))
+
+    def add_datagram_socket(self, sock: socket.socket, on_datagram: Callable[[bytes, Any], None]):
+        """Calls `on_datagram` with every datagram `sock` receives, and the address it came from.
+        Call from the loop thread, and remove it again with `remove_listener`.
+        """
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, ("datagram", on_datagram))
+
+    def remove_listener(self, listener: socket.socket):
+        self.selector.unregister(listener)
+
+    def add_client(self, writer: ClientWriter, on_close: Callable[[ClientWriter], None], on_data: Optional[Callable[[ClientWriter, bytes], None]] = None):
+        """Looks after `writer` until it closes, at which point `on_close` is called with it.
+        Anything the client sends goes to `on_data`. Call from the loop thread.
+        """
+        self._clients[writer] = (on_close, on_data)
+        self.selector.register(writer.sock, selectors.EVENT_READ, ("client", writer))
+
+    def send(self, writer: ClientWriter, msg: bytes):
+        """Queues `msg` for `writer`, and starts sending it right away. Call from the loop thread."""
+        if writer not in self._clients:
+            return
+        writer.enqueue(msg)
+        self._pump(writer)
+
+    def close_client(self, writer: ClientWriter):
+        """Disconnects `writer`. Call from the loop thread."""
+        if writer not in self._clients:
+            return
+        on_close, _ = self._clients.pop(writer)
+        self.selector.unregister(writer.sock)
+        writer.close()
+        on_close(writer)
+
+    def _pump(self, writer: ClientWriter):
+        if not writer.pump():
+            self.close_client(writer)
+            return
+        # only ask to hear about room in the socket while there's something waiting for it
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writer.pending() else 0)
+        if self.selector.get_key(writer.sock).events != events:
+            self.selector.modify(writer.sock, events, ("client", writer))
+
+    def _next_deadline(self) -> Optional[float]:
+        # the only timed thing the loop does is cut off clients that have stalled for too long
+        deadline = None
+        for writer in self._clients:
+            if writer.policy == DISCONNECT and writer.pending():
+                remaining = max(0, writer.stall_timeout - writer.stalled_for())
+                deadline = remaining if deadline is None else min(deadline, remaining)
+        return deadline
+
+    def _run(self, previous: Optional[Thread]):
+        if previous is not None:
+            previous.join()
+        while True:
+            with self._calls_lock:
+                if not self._running and len(self._calls) == 0:
+                    break
+            for key, events in self.selector.select(self._next_deadline()):
+                if key.data is None:
+                    try:
+                        while self._wake_recv.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                kind, target = key.data
+                if kind == "accept":
+                    try:
+                        sock, _addr = key.fileobj.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    target(sock)
+                    continue
+                if kind == "datagram":
+                    self._receive(key.fileobj, target)
+                    continue
+                if target not in self._clients:
+                    # closed by something earlier in this same batch
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._read(target)
+                if events & selectors.EVENT_WRITE and target in self._clients:
+                    self._pump(target)
+
+            for writer in [w for w in self._clients if w.policy == DISCONNECT and w.pending()]:
+                if writer.stalled_for() > writer.stall_timeout:
+                    self.close_client(writer)
+
+            with self._calls_lock:
+                calls, self._calls = self._calls, deque()
+            for f, args in calls:
+                try:
+                    f(*args)
+                except Exception as e:
+                    print(f"event loop call failed: {e!r}")
+
+        # nothing looks after clients once the loop is gone, so any left over are closed with it
+        for writer in list(self._clients):
+            self.close_client(writer)
+
+    def _receive(self, sock: socket.socket, on_datagram: Callable[[bytes, Any], None]):
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                # an earlier send went to somewhere nothing listens anymore, which UDP sockets 
+                # report on the next read. That doesn't concern this read.
+                continue
+            except OSError as e:
+                print(f"datagram receive failed: {e!r}")
+                return
+            try:
+                on_datagram(data, addr)
+            except Exception as e:
+                # one bad datagram shouldn't take the loop, or the next datagram, down with it
+                print(f"datagram from {addr} failed: {e!r}")
+
+    def _read(self, writer: ClientWriter):
+        try:
+            data = writer.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            # the client hung up
+            self.close_client(writer)
+            return
+        _, on_data = self._clients[writer]
+        if on_data is not None:
+            try:
+                on_data(writer, data)
+            except Exception as e:
+                # whatever the client sent broke its handler, so it's only this client that goes
+                print(f"handling data from a client failed, closing it: {e!r}")
+                self.close_client(writer)
+
@@ -0,0 +1,86 @@
+import numpy as np
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # camera.py keeps histories itself, so this can't be imported at runtime
+    from .camera import FrameInfo
+
+
+class FrameHistory:
+    """A bounded record of the most recent frames, looked up by frame id or by capture time.
+
+    Frames are kept by reference, not copied, so holding on to `max_frames` frames costs nothing
+    until the source would otherwise have reused their buffers. The history is capped both by
+    frame count and, optionally, by the total size of the frames in bytes. The newest frame is
+    always kept, even if it's larger than `max_bytes` on its own.
+    """
+    max_frames: int
+    max_bytes: Optional[int]
+    history_lock: Lock
+    total_bytes: int
+
+    def __init__(self, max_frames: int = 8, max_bytes: Optional[int] = None):
+        if max_frames <= 0:
+            raise ValueError(f"history must hold at least one frame ({max_frames})")
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.history_lock = Lock()
+        self.total_bytes = 0
+        self._by_id = {}
+        self._order = deque()
+        # capture times, in the same order as `_order`, for bisecting
+        self._times = []
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def add(self, frame: np.ndarray, info: "FrameInfo"):
+        with self.history_lock:
+            if info.frame_id in self._by_id:
+                return
+            # Capture times only ever go up for a single source, so appending keeps `_times`
+            # sorted. Anything out of order is dropped rather than breaking the bisect.
+            if len(self._times) > 0 and info.timestamp < self._times[-1]:
+                return
+            self._by_id[info.frame_id] = (frame, info)
+            self._order.append(info.frame_id)
+            self._times.append(info.timestamp)
+            self.total_bytes += frame.nbytes
+            while len(self._order) > self.max_frames or \
+                    (self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self._order) > 1):
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        frame, _ = self._by_id.pop(self._order.popleft())
+        self._times.pop(0)
+        self.total_bytes -= frame.nbytes
+
+    def get_frame_by_id(self, frame_id: int) -> Optional[tuple[np.ndarray, "FrameInfo"]]:
+        """The frame with the given id, and its info, or `None` if it's no longer in the history."""
+        with self.history_lock:
+            return self._by_id.get(frame_id)
+
+    def get_frame_at(self, timestamp: float, tolerance: Optional[float] = None) -> Optional[tuple[np.ndarray, "FrameInfo"]]:
+        """The frame captured closest to `timestamp` (on the `time.monotonic()` clock), and its info.
+        If `tolerance` is given, frames further than that many seconds away don't count.
+        """
+        with self.history_lock:
+            if len(self._times) == 0:
+                return None
+            i = bisect_left(self._times, timestamp)
+            candidates = [j for j in (i - 1, i) if 0 <= j < len(self._times)]
+            best = min(candidates, key=lambda j: abs(self._times[j] - timestamp))
+            if tolerance is not None and abs(self._times[best] - timestamp) > tolerance:
+                return None
+            return self._by_id[self._order[best]]
+
+    def clear(self):
+        with self.history_lock:
+            self._by_id.clear()
+            self._order.clear()
+            self._times.clear()
+            self.total_bytes = 0
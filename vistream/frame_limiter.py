@@ -1,31 +1,53 @@
 import time
 import numpy as np
 
-from typing import Optional
+from typing import Any, Optional, Callable
 
 
-from .camera import Camera, ProcessedCamera, FrameSource
+from .camera import Camera, FrameSource, FrameInfo
 
 class FrameSequencer(FrameSource):
     cam: FrameSource
     last_frame_id: Optional[int]
+    last_info: Optional[FrameInfo]
     
     def __init__(self, cam: FrameSource):
         self.last_frame_id = None
+        self.last_info = None
         self.cam = cam
 
     def frame_available(self) -> bool:
-        return self.cam.frame_id != self.last_frame_id
+        return self.cam.frame_id() != self.last_frame_id
 
-    def get_frame(self, blocking = True) -> Optional[np.ndarray]:
+    def get_frame(self, blocking = True, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """Returns the next frame that this sequencer hasn't handed out yet. When `blocking`, 
+        this waits (up to `timeout` seconds, if given) for the source to publish a new frame, 
+        returning `None` if it doesn't.
+        """
+        return self.get_frame_with_info(blocking, timeout)[0]
+
+    def get_frame_with_info(self, blocking = True, timeout: Optional[float] = None) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        return self._next(self.cam.get_frame_with_info, blocking, timeout)
+
+    def get_frame_as(self, pixel_formats: list[str], blocking = True, timeout: Optional[float] = None) -> tuple[Optional[list[np.ndarray]], Optional[FrameInfo]]:
+        """The `get_frame_as` counterpart of `get_frame_with_info`."""
+        return self._next(lambda: self.cam.get_frame_as(pixel_formats), blocking, timeout)
+
+    def pixel_formats(self) -> tuple[str, ...]:
+        return self.cam.pixel_formats()
+
+    def _next(self, fetch: Callable[[], tuple[Any, Optional[FrameInfo]]], blocking: bool, timeout: Optional[float]) -> tuple[Any, Optional[FrameInfo]]:
         if not blocking and not self.frame_available(): 
-            return None
+            return None, None
 
-        if blocking and not self.frame_available():
-            while not self.frame_available():
-                time.sleep(0.001) # don't hog resources waiting
-        self.last_frame_id = self.cam.frame_id()
-        return self.cam.get_frame()
+        if blocking and self.cam.wait_for_frame(self.last_frame_id, timeout) is None:
+            return None, None
+        frame, info = fetch()
+        if frame is None:
+            return None, None
+        self.last_frame_id = info.frame_id
+        self.last_info = info
+        return frame, info
 
     def __iter__(self):
         return self
@@ -39,16 +61,36 @@ class FrameSequencer(FrameSource):
     def frame_size(self) -> tuple[int, int]:
         return self.cam.frame_size()
 
+    def get_encoded_frame(self, blocking = True, timeout: Optional[float] = None) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        """The compressed counterpart of `get_frame_with_info`. If the source can't provide 
+        compressed frames, this returns `(None, None)` without consuming a frame.
+        """
+        return self._next(self.cam.get_encoded_frame, blocking, timeout)
+
     def frame_id(self) -> int:
         return self.cam.frame_id()
+
+    def frame_info(self) -> Optional[FrameInfo]:
+        return self.cam.frame_info()
+
+    def get_frame_by_id(self, frame_id: int) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        return self.cam.get_frame_by_id(frame_id)
+
+    def get_frame_at(self, timestamp: float, tolerance: Optional[float] = None) -> Optional[tuple[np.ndarray, FrameInfo]]:
+        return self.cam.get_frame_at(timestamp, tolerance)
+
+    def wait_for_frame(self, last_id: Optional[int] = None, timeout: Optional[float] = None) -> Optional[int]:
+        return self.cam.wait_for_frame(last_id, timeout)
     
+    def is_capturing(self) -> bool:
+        return self.cam.is_capturing()
+
     def stop(self):
         self.cam.stop()
             
 def _sequential_frames(self: FrameSource) -> FrameSequencer:
     return FrameSequencer(self)
-Camera.sequential_frames = _sequential_frames
-ProcessedCamera.sequential_frames = _sequential_frames
+FrameSource.sequential_frames = _sequential_frames
 
 
 class FrameRateLimiter(FrameSequencer):
@@ -68,21 +110,23 @@ class FrameRateLimiter(FrameSequencer):
     def frame_available(self) -> bool:
         return super().frame_available() and time.perf_counter() > (self._last_frame + self._frame_delay)
 
-    def get_frame(self, blocking = True) -> Optional[np.ndarray]:
+    def _next(self, fetch: Callable[[], tuple[Any, Optional[FrameInfo]]], blocking: bool, timeout: Optional[float]) -> tuple[Any, Optional[FrameInfo]]:
         if blocking and not self.frame_available():
-            time.sleep((self._last_frame + self._frame_delay) - time.perf_counter())
-            return super().get_frame()
-
-        if self.frame_available():
-            return super().get_frame()
+            time.sleep(max(0, (self._last_frame + self._frame_delay) - time.perf_counter()))
+            frame, info = super()._next(fetch, True, timeout)
+        elif self.frame_available():
+            frame, info = super()._next(fetch, True, None)
         else:
-            return None
+            return None, None
+
+        if frame is not None:
+            self._last_frame = time.perf_counter()
+        return frame, info
     
    
 
 def _limit_framerate(self: FrameSource, target_fps: float) -> FrameRateLimiter:
     return FrameRateLimiter(self, target_fps)
-Camera.limit_framerate = _limit_framerate
-ProcessedCamera.limit_framerate = _limit_framerate
+FrameSource.limit_framerate = _limit_framerate
 
 
@@ -0,0 +1,100 @@
+import cv2 as cv
+import numpy as np
+
+from typing import Optional, Callable
+
+
+class BufferedLayer:
+    """A layer that writes its output into a buffer it is given, rather than allocating one.
+
+    `ProcessedCamera` asks a buffered layer what it will produce with `output_spec`, and then
+    passes a matching buffer to `apply`. Intermediate results of a chain of buffered layers are
+    written back and forth between two scratch buffers, and only the final result needs a
+    buffer of its own, which comes from a pool. A chain of them therefore doesn't allocate at
+    all once it's warmed up.
+
+    Buffered layers are still plain callables too, so they work anywhere a layer does.
+    """
+
+    def output_spec(self, shape: tuple[int, ...], dtype: np.dtype) -> tuple[tuple[int, ...], np.dtype]:
+        """The shape and type of the frames this layer produces from frames of the given shape
+        and type. It should be cheap, since it's called for every frame.
+        """
+        raise NotImplementedError()
+
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        """Processes `src` into `dst`, and returns `dst`. `dst` is laid out as `output_spec`
+        said, and never overlaps `src`.
+        """
+        raise NotImplementedError()
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        shape, dtype = self.output_spec(frame.shape, frame.dtype)
+        return self.apply(frame, np.empty(shape, dtype=dtype))
+
+
+class ResizeLayer(BufferedLayer):
+    """Resizes frames to `size` (width, height)."""
+    size: tuple[int, int]
+    interpolation: int
+
+    def __init__(self, size: tuple[int, int], interpolation: int = cv.INTER_LINEAR):
+        self.size = (int(size[0]), int(size[1]))
+        self.interpolation = interpolation
+
+    def output_spec(self, shape: tuple[int, ...], dtype: np.dtype) -> tuple[tuple[int, ...], np.dtype]:
+        return (self.size[1], self.size[0]) + tuple(shape[2:]), dtype
+
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return cv.resize(src, self.size, dst=dst, interpolation=self.interpolation)
+
+
+class ColorConvertLayer(BufferedLayer):
+    """Runs `cv.cvtColor` with the given conversion `code` (`cv.COLOR_BGR2GRAY`, for instance)."""
+    code: int
+
+    def __init__(self, code: int):
+        self.code = code
+        self._specs = {}
+
+    def output_spec(self, shape: tuple[int, ...], dtype: np.dtype) -> tuple[tuple[int, ...], np.dtype]:
+        # There are far too many conversion codes to tabulate what each one produces, so convert
+        # a blank frame once per input layout and remember the result.
+        key = (tuple(shape), np.dtype(dtype))
+        if key not in self._specs:
+            probe = cv.cvtColor(np.zeros(shape, dtype=dtype), self.code)
+            self._specs[key] = (probe.shape, probe.dtype)
+        return self._specs[key]
+
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return cv.cvtColor(src, self.code, dst=dst)
+
+
+def _apply_layers(layers: list[Callable[[np.ndarray], np.ndarray]], frame: np.ndarray, scratch: list[Optional[np.ndarray]],
+                  output: Callable[[tuple[int, ...], np.dtype], np.ndarray]) -> np.ndarray:
+    """Runs `frame` through `layers`. Buffered layers write intermediate results into the two
+    `scratch` buffers (which are (re)allocated as needed and should be kept between calls), and
+    the final result into a buffer from `output(shape, dtype)`. The result never refers to the
+    scratch buffers, so it's safe to hand out.
+    """
+    for i, layer in enumerate(layers):
+        if not isinstance(layer, BufferedLayer):
+            frame = layer(frame)
+            continue
+        shape, dtype = layer.output_spec(frame.shape, frame.dtype)
+        if i == len(layers) - 1:
+            dst = output(shape, dtype)
+        else:
+            # normally the other buffer from the one the input is in, but a plain layer in
+            # between may have returned anything, so check
+            slot = 0 if scratch[0] is None or not np.may_share_memory(scratch[0], frame) else 1
+            if scratch[slot] is None or scratch[slot].shape != tuple(shape) or scratch[slot].dtype != dtype:
+                scratch[slot] = np.empty(shape, dtype=dtype)
+            dst = scratch[slot]
+        frame = layer.apply(frame, dst)
+    if any(s is not None and np.may_share_memory(s, frame) for s in scratch):
+        # a plain layer at the end returned (a view of) a scratch buffer
+        dst = output(frame.shape, frame.dtype)
+        np.copyto(dst, frame)
+        frame = dst
+    return frame
@@ -2,90 +2,599 @@ import numpy as np
 import bitstring as bs
 import cv2 as cv
 import zlib
+import time
+from dataclasses import dataclass, replace
 from .socket_buffer import BufferedSocket
 from .match_data import MatchData
 
-from typing import Optional, Any
+from typing import Optional, Any, Callable
+
+# What a message is, see `MessageHeader`
+FRAME = 0
+REPEAT = 1
+DATA = 2
+
+# Message flags
+RESENT = 1 << 0 # an older frame, sent again to a client that joined since it first went out
+# the frame neither needs any before it nor is needed by any after it, so it can be skipped. 
+# Tile payloads (`TILES`) never are.
+STANDALONE = 1 << 1
+
+NO_CODEC = 0xFF # the codec id of messages that don't carry an image
+HEADER_VERSION = 1
+
+@dataclass(frozen=True)
+class MessageHeader:
+    """Sent along with every frame, repeat and data message, right after its magic flag.
+
+    `sequence` counts the messages of a kind sent to one client (or, over UDP, to one address), 
+    so a gap means messages were dropped or lost on the way. `frame_id` is the source frame the 
+    message is about, which ties match data to the frame it was found in. `timestamp` is that 
+    frame's capture time on the server's `time.monotonic()` clock, which is only meaningful 
+    relative to other headers from the same server, and `age` is the time between capture and 
+    the message being formatted, which combined with the local receive time tells how stale a 
+    message is. `codec_id`, `width` and `height` describe the image (for data, the frame the 
+    matches were found in), and `length` is the number of payload bytes (for data, records).
+
+    Headers start with their version and their own length in bytes. Later versions only ever 
+    add fields at the end, so a reader skips whatever it doesn't know about.
+    """
+    kind: int
+    sequence: int = 0
+    frame_id: int = 0
+    timestamp: float = 0
+    age: float = 0
+    codec_id: int = NO_CODEC
+    width: int = 0
+    height: int = 0
+    length: int = 0
+    flags: int = 0
+    version: int = HEADER_VERSION
+
+    # version, header length, kind, flags, codec id, sequence, frame id, timestamp, age, width, 
+    # height, length
+    layout = ["uintbe8", "uintbe8", "uintbe8", "uintbe8", "uintbe8", "uintbe32", "uintbe32", "floatbe64", "floatbe32", "uintbe16", "uintbe16", "uintbe32"]
+    byte_length = 33
+
+    @classmethod
+    def now(cls, kind: int, timestamp: Optional[float] = None, **fields: Any) -> "MessageHeader":
+        """A header for a message formatted now, about a frame captured at `timestamp` (also now, 
+        by default).
+        """
+        now = time.monotonic()
+        if timestamp is None:
+            timestamp = now
+        return cls(kind, timestamp = timestamp, age = max(0.0, now - timestamp), **fields)
+
+    def to_bytes(self) -> bytes:
+        return bs.pack(MessageHeader.layout, self.version, MessageHeader.byte_length, self.kind, self.flags, self.codec_id,
+                       self.sequence & 0xFFFFFFFF, self.frame_id & 0xFFFFFFFF, self.timestamp, self.age, self.width, self.height, self.length).bytes
+
+    @classmethod
+    def from_bytes(cls, b: bytes) -> "MessageHeader":
+        """Reads a header from (at least) its first `byte_length` bytes."""
+        (version, _, kind, flags, codec_id, sequence, frame_id, timestamp, age, width, height, 
+         length) = bs.Bits(bytes=b[:MessageHeader.byte_length]).unpack(MessageHeader.layout)
+        return cls(kind, sequence, frame_id, timestamp, age, codec_id, width, height, length, flags, version)
+
+def read_header(sock: BufferedSocket) -> Optional[MessageHeader]:
+    start = sock.read(2)
+    if start is None or len(start) != 2:
+        return None
+    version, length = start
+    if version < 1 or length < MessageHeader.byte_length:
+        return None
+    rest = sock.read(length - 2)
+    if rest is None or len(rest) != length - 2:
+        return None
+    return MessageHeader.from_bytes(bytes(start) + rest)
+
+def split_header(data: Any) -> Optional[tuple[MessageHeader, Any]]:
+    """Splits a message received whole (less its magic flag), such as a datagram, into its 
+    header and what follows it.
+    """
+    data = memoryview(data).cast("B")
+    if len(data) < MessageHeader.byte_length or data[0] < 1 or data[1] < MessageHeader.byte_length or len(data) < data[1]:
+        return None
+    return MessageHeader.from_bytes(data[:MessageHeader.byte_length]), data[data[1]:]
+
+def sequence_gap(sequence: int, previous: Optional[int]) -> int:
+    """How many messages went missing between `previous` and `sequence`. Sequence numbers wrap 
+    around, so anything that isn't ahead of `previous` by less than half their range counts 
+    as starting over, rather than as a huge gap.
+    """
+    if previous is None:
+        return 0
+    gap = (sequence - previous - 1) & 0xFFFFFFFF
+    return gap if gap < 1 << 31 else 0
+
+
+@dataclass(frozen=True)
+class Codec:
+    """A way of compressing frames, see `register_codec`. `encode(frame, level)` compresses a
+    frame into an array of bytes, and `decode` turns those bytes back into a frame (or `None`,
+    if it can't). A profile's quality is this codec's level, and has to be in `levels`.
+    `lossy` codecs trade image quality for size as the level goes down, which is what
+    `AdaptiveController` lowers for a congested client.
+    """
+    name: str
+    id: int # identifies the codec in messages, so it has to fit in a byte
+    encode: Callable[[np.ndarray, int], np.ndarray]
+    decode: Callable[[Any], Optional[np.ndarray]]
+    levels: range
+    default_level: int
+    lossy: bool = True
+
+_codecs: dict[str, Codec] = {}
+_codec_ids: dict[int, Codec] = {}
+
+def register_codec(codec: Codec):
+    """Makes `codec` available to stream profiles. Servers and clients need to register the 
+    same codecs, with the same ids.
+    """
+    if not 0 <= codec.id < 256:
+        raise ValueError(f"codec id must fit in a byte ({codec.id})")
+    if codec.default_level not in codec.levels:
+        raise ValueError(f"default level {codec.default_level} of codec '{codec.name}' is not one of its levels")
+    if codec.name in _codecs or codec.id in _codec_ids:
+        raise ValueError(f"there already is a codec called '{codec.name}' or with id {codec.id}")
+    _codecs[codec.name] = codec
+    _codec_ids[codec.id] = codec
+
+def get_codec(name: str) -> Codec:
+    if name not in _codecs:
+        raise ValueError(f"unknown codec '{name}'")
+    return _codecs[name]
+
+def get_codec_by_id(codec_id: int) -> Codec:
+    if codec_id not in _codec_ids:
+        raise ValueError(f"unknown codec id {codec_id}")
+    return _codec_ids[codec_id]
+
+def _imdecode(data: Any) -> Optional[np.ndarray]:
+    return cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+
+# Raw frames are the pixels as they are, after their width, height and channel count
+RAW_LAYOUT = ["uintbe16", "uintbe16", "uintbe8"]
+RAW_HEADER_LENGTH = 5
+
+def _encode_raw(frame: np.ndarray, level: int = 0) -> np.ndarray:
+    if frame.dtype != np.uint8:
+        raise ValueError(f"raw frames have to be 8 bits per channel ({frame.dtype})")
+    h, w = frame.shape[:2]
+    channels = 1 if frame.ndim == 2 else frame.shape[2]
+    # one copy, straight into the message, rather than one for the bytes and one to join them
+    raw = np.empty(RAW_HEADER_LENGTH + frame.size, dtype=np.uint8)
+    raw[:RAW_HEADER_LENGTH] = np.frombuffer(bs.pack(RAW_LAYOUT, w, h, channels).bytes, dtype=np.uint8)
+    raw[RAW_HEADER_LENGTH:] = frame.reshape(-1)
+    return raw
+
+def _decode_raw(data: Any) -> Optional[np.ndarray]:
+    data = memoryview(data).cast("B")
+    if len(data) < RAW_HEADER_LENGTH:
+        return None
+    w, h, channels = bs.Bits(bytes=data[:RAW_HEADER_LENGTH]).unpack(RAW_LAYOUT)
+    if len(data) != RAW_HEADER_LENGTH + w * h * channels:
+        return None
+    shape = (h, w) if channels == 1 else (h, w, channels)
+    # copied, since the message it came in is read only
+    return np.frombuffer(data[RAW_HEADER_LENGTH:], dtype=np.uint8).reshape(shape).copy()
+
+def _encode_raw_zlib(frame: np.ndarray, level: int) -> np.ndarray:
+    return np.frombuffer(zlib.compress(_encode_raw(frame), level), dtype=np.uint8)
+
+def _decode_raw_zlib(data: Any) -> Optional[np.ndarray]:
+    try:
+        return _decode_raw(zlib.decompress(data))
+    except zlib.error:
+        return None
+
+JPEG = "jpeg"
+PNG = "png"
+TILES = "tiles" # JPEG tiles of only the parts of the frame that changed, see `TileEncoder`
+WEBP = "webp"
+RAW = "raw" # uncompressed, for when the link is fast and CPU time is precious
+RAW_ZLIB = "raw+zlib" # losslessly compressed, and a lot faster than PNG at low levels
+
+# This heavy compression leads to very low image quality, but also extremely small packet sizes
+register_codec(Codec(JPEG, 0, lambda f, q: cv.imencode(".jpg", f, [cv.IMWRITE_JPEG_QUALITY, q])[1], _imdecode, range(101), 9))
+register_codec(Codec(PNG, 1, lambda f, l: cv.imencode(".png", f, [cv.IMWRITE_PNG_COMPRESSION, l])[1], _imdecode, range(10), 1, lossy = False))
+# on its own, all a frame can be is a keyframe. Streams keep a `TileEncoder` instead, and 
+# clients a `TileDecoder` (see `decode_image`).
+register_codec(Codec(TILES, 2, lambda f, q: np.frombuffer(TileEncoder(q).encode(f, keyframe = True), dtype=np.uint8),
+                     lambda d: TileDecoder().apply(d), range(101), 9))
+register_codec(Codec(WEBP, 3, lambda f, q: cv.imencode(".webp", f, [cv.IMWRITE_WEBP_QUALITY, max(1, q)])[1], _imdecode, range(101), 50))
+register_codec(Codec(RAW, 4, _encode_raw, _decode_raw, range(1), 0, lossy = False))
+register_codec(Codec(RAW_ZLIB, 5, _encode_raw_zlib, _decode_raw_zlib, range(10), 1, lossy = False))
+
+@dataclass(frozen=True)
+class StreamProfile:
+    """How a client wants its video: frame size (`None` for the source's own size), codec, 
+    quality and the most frames per second it wants (0 for as many as there are). Clients with 
+    equal profiles share the same encoded frames.
+
+    Quality is whatever level the codec takes, and its default if `None`: 0-100 for JPEG, WebP 
+    and tiles, a compression level of 0-9 for PNG and raw+zlib (lower is faster, and bigger), 
+    and nothing but 0 for raw.
+    """
+    size: Optional[tuple[int, int]] = None
+    codec: str = JPEG
+    quality: Optional[int] = None
+    max_fps: float = 0
+
+    layout = ["uintbe16", "uintbe16", "uintbe8", "uintbe8", "floatbe32"]
+    byte_length = 10
+
+    def __post_init__(self):
+        codec = get_codec(self.codec)
+        if self.quality is None:
+            object.__setattr__(self, "quality", codec.default_level)
+        if self.quality not in codec.levels:
+            raise ValueError(f"quality of codec '{self.codec}' must be between {codec.levels.start} and {codec.levels.stop - 1} ({self.quality})")
+        if self.size is not None:
+            object.__setattr__(self, "size", (int(self.size[0]), int(self.size[1])))
+
+    def encode(self, frame: np.ndarray) -> np.ndarray:
+        """Resizes and compresses `frame` as this profile asks for."""
+        if self.size is not None and (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv.resize(frame, self.size)
+        return get_codec(self.codec).encode(frame, self.quality)
+
+    def to_bytes(self) -> bytes:
+        w, h = self.size if self.size is not None else (0, 0)
+        return bs.pack(StreamProfile.layout, w, h, get_codec(self.codec).id, self.quality, self.max_fps).bytes
+
+    @classmethod
+    def from_bytes(cls, b: bytes) -> "StreamProfile":
+        w, h, codec, quality, max_fps = bs.Bits(bytes=b).unpack(StreamProfile.layout)
+        return cls(None if w == 0 or h == 0 else (w, h), get_codec_by_id(codec).name, quality, max_fps)
+
+
+# Tile payloads travel as the image of a regular frame message, and are told apart from 
+# images by this prefix. Each one is either a keyframe, which is a single JPEG of the whole 
+# frame, or a delta, which only has the tiles that changed since the previous payload: their 
+# positions, followed by one JPEG with all of them packed into a grid. Payloads are numbered, 
+# so a client can tell when it missed one.
+TILE_MAGIC_FLAG = bs.Bits(hex="711e5d17", length=32).bytes
+TILE_HEADER_LAYOUT = ["uintbe32", "uintbe8", "uintbe16", "uintbe16", "uintbe16", "uintbe16"] # sequence, keyframe, width, height, tile size, tile count
+TILE_HEADER_LENGTH = len(TILE_MAGIC_FLAG) + 13
+TILE_LAYOUT = ["uintbe16", "uintbe16"] # column and row of a tile in the frame
+TILE_LENGTH = 4
+
+def is_tile_payload(data: Any) -> bool:
+    return bytes(data[:len(TILE_MAGIC_FLAG)]) == TILE_MAGIC_FLAG
+
+class TileEncoder:
+    """Encodes a stream of frames as tiles, so that bandwidth and encoding time follow how much
+    of the frame moves, rather than how big it is.
+
+    Frames are split into `tile_size` squares, and only tiles whose mean difference from what
+    was last sent for them is over `threshold` (in 0-255 levels) are encoded. They're packed
+    into one image and encoded as a single JPEG at `quality`, which saves repeating the JPEG
+    headers for every tile. Tile sizes that are a multiple of 16 line up with JPEG's own
+    blocks, so tiles don't bleed into each other. Differences are always measured against the
+    last content sent, so slow changes add up. Only every `sample`th pixel (in each direction)
+    is compared, which keeps finding the changes a small part of the cost at any resolution.
+    A keyframe (the whole frame as one JPEG) goes out every `keyframe_interval` seconds, and
+    whenever `encode` is asked for one, so clients that joined late or lost track can recover.
+    """
+    quality: int
+    tile_size: int
+    threshold: float
+    keyframe_interval: float
+    sample: int
+    sequence: int
+
+    def __init__(self, quality: int = 9, tile_size: int = 32, threshold: float = 4.0, keyframe_interval: float = 2.0, sample: int = 4):
+        if tile_size <= 0:
+            raise ValueError(f"tile size must be positive ({tile_size})")
+        if sample <= 0 or tile_size % sample != 0:
+            raise ValueError(f"tile size ({tile_size}) must be a multiple of the sample step ({sample})")
+        self.quality = quality
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.sample = sample
+        self.sequence = 0
+        self._reference = None
+        self._last_keyframe = 0
+
+    def encode(self, frame: np.ndarray, keyframe: bool = False, now: Optional[float] = None) -> Optional[bytes]:
+        """The next payload, or `None` if nothing changed enough to be worth sending."""
+        if now is None:
+            now = time.monotonic()
+        h, w = frame.shape[:2]
+        ts = self.tile_size
+        params = [cv.IMWRITE_JPEG_QUALITY, self.quality]
+        # what changes are measured on, and what the reference is kept as
+        step = ts // self.sample
+        cols, rows = -(-w // ts), -(-h // ts)
+        sampled = frame
+        if self.sample > 1:
+            sampled = cv.resize(frame, (max(1, w // self.sample), max(1, h // self.sample)), interpolation=cv.INTER_NEAREST)
+        keyframe = (keyframe or self._reference is None or self._reference.shape != sampled.shape
+                    or now - self._last_keyframe >= self.keyframe_interval)
+        changed = []
+        if keyframe:
+            self._reference = sampled.copy()
+            self._last_keyframe = now
+            image = frame
+        else:
+            # the mean difference of every tile at once, by shrinking the difference image so 
+            # that each tile becomes one pixel
+            diff = cv.absdiff(sampled, self._reference)
+            if diff.ndim == 3:
+                # weighing the channel differences like luminance, but after taking their 
+                # magnitude, so changes in colour alone still count
+                diff = cv.cvtColor(diff, cv.COLOR_BGR2GRAY)
+            sh, sw = diff.shape
+            if (rows * step, cols * step) != (sh, sw):
+                diff = cv.copyMakeBorder(diff, 0, max(0, rows * step - sh), 0, max(0, cols * step - sw), cv.BORDER_CONSTANT)
+                diff = diff[:rows * step, :cols * step]
+            means = cv.resize(diff, (cols, rows), interpolation=cv.INTER_AREA)
+            if (rows * step, cols * step) != (sh, sw):
+                # partial tiles along the right and bottom were padded, which mustn't water down 
+                # the changes in them
+                heights = np.clip(sh - np.arange(rows) * step, 1, step)
+                widths = np.clip(sw - np.arange(cols) * step, 1, step)
+                means = means * (step * step / np.outer(heights, widths))
+            changed = np.argwhere(means > self.threshold)
+            if len(changed) == 0:
+                return None
+            grid = int(np.ceil(np.sqrt(len(changed))))
+            image = np.zeros((-(-len(changed) // grid) * ts, grid * ts) + frame.shape[2:], dtype=frame.dtype)
+            for i, (row, col) in enumerate(changed):
+                area = (slice(row * ts, (row + 1) * ts), slice(col * ts, (col + 1) * ts))
+                tile = frame[area]
+                y, x = (i // grid) * ts, (i % grid) * ts
+                image[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+                sampled_area = (slice(row * step, (row + 1) * step), slice(col * step, (col + 1) * step))
+                self._reference[sampled_area] = sampled[sampled_area]
+
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        msg = bytearray(TILE_MAGIC_FLAG)
+        msg.extend(bs.pack(TILE_HEADER_LAYOUT, self.sequence, int(keyframe), w, h, ts, len(changed)).bytes)
+        # same as packing `TILE_LAYOUT` for every tile, without the per call cost of bitstring
+        msg.extend(np.asarray(changed, dtype=">u2").reshape(-1, 2)[:, ::-1].tobytes())
+        msg.extend(cv.imencode(".jpg", image, params)[1])
+        return bytes(msg)
+
+class TileDecoder:
+    """Rebuilds frames from tile payloads, into a buffer that persists between them.
+
+    A delta can only be applied on top of the payload right before it. When one is missing
+    (dropped by a slow connection, or lost on the network), `apply` returns `None` and sets
+    `needs_keyframe` until a keyframe comes along, and the client should ask for one.
+    """
+    frame: Optional[np.ndarray]
+    needs_keyframe: bool
+
+    def __init__(self):
+        self.frame = None
+        self.needs_keyframe = False
+        self._sequence = None
+
+    def apply(self, payload: Any) -> Optional[np.ndarray]:
+        """Applies a payload, and returns (a copy of) the frame as it now stands."""
+        payload = memoryview(payload).cast("B")
+        if len(payload) < TILE_HEADER_LENGTH or not is_tile_payload(payload):
+            return None
+        sequence, keyframe, w, h, ts, count = bs.Bits(bytes=payload[len(TILE_MAGIC_FLAG):TILE_HEADER_LENGTH]).unpack(TILE_HEADER_LAYOUT)
+        if not keyframe and (self.frame is None or sequence != (self._sequence + 1) & 0xFFFFFFFF or self.frame.shape[:2] != (h, w)):
+            self.needs_keyframe = True
+            return None
+
+        start = TILE_HEADER_LENGTH + count * TILE_LENGTH
+        image = None
+        if start < len(payload):
+            image = cv.imdecode(np.frombuffer(payload[start:], dtype=np.uint8), cv.IMREAD_COLOR)
+        if image is None:
+            self.needs_keyframe = True
+            return None
+        if keyframe:
+            self.frame = image
+        grid = image.shape[1] // ts if count > 0 else 1
+        positions = np.frombuffer(payload[TILE_HEADER_LENGTH:start], dtype=">u2").reshape(-1, 2)
+        for i, (col, row) in enumerate(positions.tolist()):
+            y, x = row * ts, col * ts
+            th, tw = min(ts, h - y), min(ts, w - x)
+            ay, ax = (i // grid) * ts, (i % grid) * ts
+            self.frame[y:y + th, x:x + tw] = image[ay:ay + th, ax:ax + tw]
+        self._sequence = sequence
+        if keyframe:
+            self.needs_keyframe = False
+        return self.frame.copy()
 
-#TODO Explore variable compression at lower framerates
 
 FRAME_MAGIC_FLAG = bs.Bits(hex="99c3e3c5efe55837", length=64).bytes
-def format_frame(frame: np.ndarray, compressed: bool = True) -> bytes:
+def format_frame(frame: np.ndarray, compressed: bool = True, header: Optional[MessageHeader] = None, profile: Optional[StreamProfile] = None) -> bytes:
+    """Packs a frame for sending, encoded as `profile` asks for, or as JPEG (PNG if not 
+    `compressed`) at their default levels. The image's codec and size are filled into `header`, 
+    whose timestamp should be the frame's capture time (see `FrameInfo`). It defaults to a 
+    header made now.
+    """
+    return b"".join(frame_segments(frame, compressed, header, profile))
+
+def frame_segments(frame: np.ndarray, compressed: bool = True, header: Optional[MessageHeader] = None, profile: Optional[StreamProfile] = None) -> list[memoryview]:
+    """Same as `format_frame`, but leaves the message in pieces, see `encoded_frame_segments`."""
+    if profile is None:
+        profile = StreamProfile(codec = JPEG if compressed else PNG)
+    if header is None:
+        header = MessageHeader.now(FRAME)
+    image = profile.encode(frame)
+    w, h = profile.size if profile.size is not None else (frame.shape[1], frame.shape[0])
+    flags = header.flags | (STANDALONE if profile.codec != TILES else 0)
+    return encoded_frame_segments(image, replace(header, codec_id = get_codec(profile.codec).id, width = w, height = h, flags = flags))
+
+def format_encoded_frame(image: Any, header: MessageHeader) -> bytes:
+    """Packs an already compressed image (such as the JPEG frames from an MJPEG camera) for 
+    sending, without touching the image data. `header` says what it was compressed with (see 
+    `Codec`), and how big it is.
+    """
+    return b"".join(encoded_frame_segments(image, header))
+
+def encoded_frame_segments(image: Any, header: MessageHeader) -> list[memoryview]:
+    """The message `format_encoded_frame` would build, as a header and a view of the image itself,
+    without joining them. They can be sent with a single `socket.sendmsg`, so the image data is 
+    never copied on its way to the kernel.
+    """
+    image = memoryview(image).cast("B")
     msg = bytearray(FRAME_MAGIC_FLAG)
-    # This heavy compression leads to very low image quality, but also extremely small packet sizes
-    if compressed:
-        comp = cv.imencode(".jpg", frame, [cv.IMWRITE_JPEG_QUALITY, 9])[1].data # we're just going to assume it succeeds
-    else:
-        comp = cv.imencode(".png", frame)[1].data # we're just going to assume it succeeds
-        #  comp = zlib.compress(frame.tobytes(), level = 4) # lower level to make faster, since we're streaming
-    msg.extend(bs.pack(["uintbe32"], len(comp)).bytes)
-    msg.extend(comp)
+    msg.extend(replace(header, kind = FRAME, length = len(image)).to_bytes())
+    return [memoryview(msg), image]
 
-    return bytes(msg)
+def decode_image(image: Any, codec_id: int, tiles: Optional[TileDecoder] = None) -> Optional[np.ndarray]:
+    """Decodes an image sent with the codec `codec_id`. Tile payloads are applied to `tiles`, 
+    and without a decoder only keyframes can be read.
+    """
+    codec = get_codec_by_id(codec_id)
+    if codec.name == TILES and tiles is not None:
+        return tiles.apply(image)
+    return codec.decode(image)
 
-def parse_frame(sock: BufferedSocket) -> Optional[np.ndarray]:
+# Sent instead of a frame that looks the same as the last one the client got. The client keeps 
+# showing the image it has, and only takes the new header.
+REPEAT_MAGIC_FLAG = bs.Bits(hex="99c3e3c5efe5ae9e", length=64).bytes
+def format_repeat(header: MessageHeader) -> bytes:
+    """Packs a message that says the frame `header` is about looks like the previous one."""
+    return REPEAT_MAGIC_FLAG + replace(header, kind = REPEAT, length = 0).to_bytes()
+
+def parse_repeat(data: bytes) -> Optional[MessageHeader]:
+    """The header of a repeat message received whole, as a datagram, or `None` if it isn't one."""
+    if data[:len(REPEAT_MAGIC_FLAG)] != REPEAT_MAGIC_FLAG:
+        return None
+    res = split_header(data[len(REPEAT_MAGIC_FLAG):])
+    return None if res is None else res[0]
+
+def parse_frame(sock: BufferedSocket, tiles: Optional[TileDecoder] = None, latest_only: bool = False) -> Optional[tuple[Optional[np.ndarray], MessageHeader]]:
+    """Reads the next frame, and decodes it with whichever codec it was sent with. A repeat 
+    message (see `format_repeat`) comes back as a `None` frame, meaning the previous one still 
+    stands. So does a frame that can't be decoded, such as a tile payload that can't be applied 
+    to `tiles` (see `decode_image` and `TileDecoder`), and, with `latest_only`, one that isn't 
+    worth decoding because another frame has already arrived after it. Tile payloads are always 
+    applied, since later ones build on them.
+    """
     magic = sock.read(len(FRAME_MAGIC_FLAG))
-    if magic is None or magic != FRAME_MAGIC_FLAG:
+    if magic is None or magic not in (FRAME_MAGIC_FLAG, REPEAT_MAGIC_FLAG):
         return None
 
-    shape = sock.read(4)
-    if shape is None or len(shape) != 4:
+    header = read_header(sock)
+    if header is None:
         return None
-    
-    length = bs.Bits(bytes=shape).unpack(["uintbe32"])[0]
-    #  width, height, length = bs.Bits(bytes=shape).unpack(["uintbe16", "uintbe16", "uintbe32"])
+    if magic == REPEAT_MAGIC_FLAG:
+        return None, header
 
-    frame_data = sock.read(length)
-    if frame_data is None or len(frame_data) != length:
+    frame_data = sock.read(header.length)
+    if frame_data is None or len(frame_data) != header.length:
         return None
-    
-    #  frame_data = zlib.decompress(frame_data)
-    frame_data = np.ndarray(length, buffer=frame_data, dtype=np.uint8)
-    frame_data = cv.imdecode(frame_data, 1)
+    if latest_only and header.flags & STANDALONE and _frame_follows(sock):
+        return None, header
+
+    try:
+        return decode_image(frame_data, header.codec_id, tiles), header
+    except ValueError:
+        # a codec this side doesn't know. The message was read whole, so the stream is fine.
+        return None, header
 
-    #  return np.ndarray((height, width, 3), dtype="uint8", buffer=frame_data)
-    return frame_data
+def _frame_follows(sock: BufferedSocket) -> bool:
+    """Whether the next message already waiting on `sock` is a frame. Anything else, like a 
+    repeat, relies on the frame before it having been decoded.
+    """
+    if not sock.has_pending():
+        return False
+    try:
+        return sock.peek(len(FRAME_MAGIC_FLAG)) == FRAME_MAGIC_FLAG
+    except TimeoutError:
+        # whatever did arrive stays buffered for the next read
+        return False
 
 def salvage_frame_stream(sock: BufferedSocket) -> bool:
     while sock.can_read():
         read = sock.peek(len(FRAME_MAGIC_FLAG))
         if read is None or len(read) < len(FRAME_MAGIC_FLAG):
             return False
-        if read == FRAME_MAGIC_FLAG:
+        if read == FRAME_MAGIC_FLAG or read == REPEAT_MAGIC_FLAG:
             return True
         sock.read(1)
     return False
 
 
 
+SUBSCRIBE_MAGIC_FLAG = bs.Bits(hex="5ab5c41b", length=32).bytes
+SUBSCRIBE_MESSAGE_LENGTH = len(SUBSCRIBE_MAGIC_FLAG) + StreamProfile.byte_length
+def format_subscription(profile: StreamProfile) -> bytes:
+    """Packs the profile a frame client wants its video in. Clients send this to the server."""
+    return SUBSCRIBE_MAGIC_FLAG + profile.to_bytes()
+
+# Clients with a `TileDecoder` that lost track send this to get a keyframe
+KEYFRAME_REQUEST = bs.Bits(hex="5ab5c4f7", length=32).bytes
+
+def parse_subscriptions(buffer: bytearray) -> list[StreamProfile]:
+    """Takes every complete subscription out of `buffer`, see `parse_client_messages`."""
+    return parse_client_messages(buffer)[0]
+
+def parse_client_messages(buffer: bytearray) -> tuple[list[StreamProfile], bool]:
+    """Takes every complete message out of `buffer`, which collects whatever a client sent, in 
+    order: the profiles it subscribed with, and whether it asked for a keyframe. Bytes that 
+    can't be part of a message are skipped, and an incomplete one at the end is left for when 
+    the rest arrives.
+    """
+    profiles = []
+    keyframe = False
+    while True:
+        starts = [i for i in (buffer.find(SUBSCRIBE_MAGIC_FLAG), buffer.find(KEYFRAME_REQUEST)) if i >= 0]
+        if len(starts) == 0:
+            # keep what could still be the start of a magic flag
+            del buffer[:max(0, len(buffer) - len(SUBSCRIBE_MAGIC_FLAG) + 1)]
+            return profiles, keyframe
+        del buffer[:min(starts)]
+        if buffer.startswith(KEYFRAME_REQUEST):
+            keyframe = True
+            del buffer[:len(KEYFRAME_REQUEST)]
+            continue
+        if len(buffer) < SUBSCRIBE_MESSAGE_LENGTH:
+            return profiles, keyframe
+        body = bytes(buffer[len(SUBSCRIBE_MAGIC_FLAG):SUBSCRIBE_MESSAGE_LENGTH])
+        try:
+            profiles.append(StreamProfile.from_bytes(body))
+            del buffer[:SUBSCRIBE_MESSAGE_LENGTH]
+        except ValueError:
+            del buffer[:len(SUBSCRIBE_MAGIC_FLAG)]
+
+
+
 DATA_MAGIC_FLAG = bs.Bits(hex="D5896268", length=32).bytes
-def format_data(data: list[MatchData]) -> bytes:
+def format_data(data: list[MatchData], header: Optional[MessageHeader] = None) -> bytes:
+    """Packs match data for sending. `header` should be about the frame the matches were found 
+    in, and defaults to one made now. Its length is filled in with the number of matches.
+    """
+    if header is None:
+        header = MessageHeader.now(DATA)
     msg = bytearray(DATA_MAGIC_FLAG)
-    msg.extend(bs.Bits(uintbe=len(data), length=16).bytes)
+    msg.extend(replace(header, kind = DATA, length = len(data)).to_bytes())
     for m in data:
         msg.extend(m.to_bytes())
 
     return bytes(msg)
 
-def parse_data(sock: BufferedSocket) -> Optional[list[MatchData]]:
+def parse_data(sock: BufferedSocket) -> Optional[tuple[list[MatchData], MessageHeader]]:
     magic = sock.read(len(DATA_MAGIC_FLAG))
     if magic is None or magic != DATA_MAGIC_FLAG:
         return None
 
-    count_bytes = sock.read(2)
-    if count_bytes is None or len(count_bytes) < 2:
+    header = read_header(sock)
+    if header is None:
         return None
-    count: int = bs.Bits(bytes=count_bytes).unpack("uintbe16")[0]
 
     matches = []
     bytes_per = MatchData.byte_length()
-    for _ in range(count):
+    for _ in range(header.length):
         match_bytes = sock.read(bytes_per)
         if match_bytes is None or len(match_bytes) != bytes_per:
             return None
         matches.append(MatchData.from_bytes(match_bytes))
 
-    return matches
+    return matches, header
 
 def salvage_data_stream(sock: BufferedSocket) -> bool:
     print("trying to salvage stream")
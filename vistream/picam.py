@@ -3,13 +3,14 @@ import numpy as np
 
 from typing import Optional
 
-from .camera import Camera
+from .camera import Camera, BGR, YUV420
 
 class PiCamera(Camera):
     cam: picamera2.Picamera2
     _frame_size: tuple[int, int] 
+    _sensor_timestamp: Optional[float]
 
-    def __init__(self, size: tuple[int, int], mode: int = 0):
+    def __init__(self, size: tuple[int, int], mode: int = 0, pixel_format: str = BGR):
         """Creates a new instance of the Raspberry Pi camera connect to the CSI port
         By default the camera is launched into mode 0, which is usually, if not always, 
         the highest framerate. To determine the modes, you can run the following program.
@@ -23,10 +24,17 @@ class PiCamera(Camera):
         Note that, since you can only have one Pi camera without external modules, attempting
         to instantiate this class more than once is undefined behaviour. It may work fine, 
         but don't count on it in general use.
+
+        `pixel_format` can be `YUV420` to have the ISP deliver planar YUV instead of BGR. That's 
+        half the data per frame, and grayscale consumers get the Y plane without any conversion.
         """
+        if pixel_format not in (BGR, YUV420):
+            raise ValueError(f"the Pi camera can't capture {pixel_format} frames")
+        self.pixel_format = pixel_format
         cam = picamera2.Picamera2()
         mode = cam.sensor_modes[mode]
-        config = cam.create_preview_configuration({"size": size, "format": "RGB888"},
+        # picamera2 names formats by their little endian layout, so "RGB888" is BGR in memory
+        config = cam.create_preview_configuration({"size": size, "format": "RGB888" if pixel_format == BGR else "YUV420"},
                                  controls={"FrameDurationLimits": (100, 8333)},
                                  sensor={"output_size": mode["size"], "bit_depth": mode["bit_depth"]})
 
@@ -35,6 +43,7 @@ class PiCamera(Camera):
         cam.start()
         self.cam = cam
         self._frame_size = config["main"]["size"]
+        self._sensor_timestamp = None
         super().__init__()
 
     def source(self) -> picamera2.Picamera2:
@@ -43,5 +52,17 @@ class PiCamera(Camera):
     def frame_size(self) -> tuple[int, int]:
         return self._frame_size
 
-    def _next_frame_(self) -> Optional[np.ndarray]:
-        return self.cam.capture_array()
+    def _next_frame_(self, out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        # picamera2 always hands back its own array, so `out` can't be used here
+        request = self.cam.capture_request()
+        try:
+            frame = request.make_array("main")
+            # SensorTimestamp is the start of exposure, in nanoseconds
+            ts = request.get_metadata().get("SensorTimestamp")
+            self._sensor_timestamp = None if ts is None else ts / 1e9
+        finally:
+            request.release()
+        return frame
+
+    def _sensor_timestamp_(self) -> Optional[float]:
+        return self._sensor_timestamp
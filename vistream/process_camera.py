@@ -0,0 +1,342 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from threading import Thread, Lock, Event, Condition
+from queue import Queue, Empty
+
+from typing import Any, Optional
+
+from .camera import FrameSource, FrameInfo, Layer, BGR, frame_format, _formats_from, _wait_for_frame
+from .layers import _apply_layers
+
+
+def _layer_worker(layers: list[Layer], input_name: str, output_name: str,
+                  input_layout: tuple[tuple[int, ...], str], output_layout: tuple[tuple[int, ...], str],
+                  tasks: Any, results: Any, in_progress: Any, index: int):
+    """Worker process body. Only slot indices and sequence numbers go through the queues, the
+    pixel data itself stays in shared memory. `in_progress[index]` holds the sequence number
+    being worked on (-1 when idle), so the camera knows what was lost if this process dies.
+    """
+    input_mem = SharedMemory(name=input_name)
+    output_mem = SharedMemory(name=output_name)
+    inputs = np.ndarray(input_layout[0], dtype=input_layout[1], buffer=input_mem.buf)
+    outputs = np.ndarray(output_layout[0], dtype=output_layout[1], buffer=output_mem.buf)
+    scratch = [None, None]
+    frame = None
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, seq = task
+            in_progress[index] = seq
+            try:
+                # buffered layers at the end of the chain write straight into shared memory
+                frame = _apply_layers(layers, inputs[slot], scratch,
+                                      lambda shape, dtype: outputs[slot] if (shape, dtype) == (outputs.shape[1:], outputs.dtype) else np.empty(shape, dtype=dtype))
+                if frame.shape != outputs[slot].shape:
+                    raise ValueError(f"layers produced a {frame.shape} frame, expected {outputs[slot].shape}")
+                if not np.may_share_memory(frame, outputs):
+                    np.copyto(outputs[slot], frame, casting="unsafe")
+                results.put((slot, seq, None))
+            except Exception as e:
+                results.put((slot, seq, repr(e)))
+            in_progress[index] = -1
+    finally:
+        # the arrays have to go before the memory they point into can be closed
+        del inputs, outputs, scratch, frame
+        input_mem.close()
+        output_mem.close()
+
+
+class ProcessPoolCamera(FrameSource):
+    """A `FrameSource` that runs its layers in a pool of worker processes, so that layers written
+    in Python (which hold the GIL) can use more than one core.
+
+    Frames are copied once into slots of a shared memory block, and workers write their results
+    into a matching output block. Only slot indices and sequence numbers cross the process
+    boundary, so pixel data is never pickled. Results are published strictly in the order frames
+    were captured, with the id of the source frame they came from.
+
+    The layers themselves are pickled once when the workers start. With the default "spawn"
+    start method that means they must be importable (module level functions or instances of
+    module level classes), rather than lambdas or closures. All layers must also produce frames
+    of a constant size, which is determined by running them once on the first frame.
+
+    A worker that dies is replaced, and the frame it was working on is skipped. So is a frame it
+    had only just taken, before it could say so: once the other workers have moved on to later
+    frames (or have nothing left to do), it can't be anywhere else. Once the source stops, the
+    frames still in flight are published, and then this stops too.
+    """
+    _source: FrameSource
+    layers: list[Layer]
+    worker_count: int
+    slot_count: int
+
+    frame_lock: Lock
+    frame_ready: Condition
+    stop_capture: Event
+    current_frame: Optional[np.ndarray]
+    current_info: Optional[FrameInfo]
+    _frame_id: int
+
+    dispatcher: Thread
+    collector: Thread
+    workers: list[Any]
+
+    def __init__(self, source: FrameSource, layers: list[Layer], workers: int = 2, slots: Optional[int] = None, start_method: str = "spawn"):
+        """`slots` is the number of frames that can be in flight at once, and defaults to twice the
+        number of workers. When every slot is busy, new source frames are dropped.
+        """
+        if workers <= 0:
+            raise ValueError(f"worker count must be positive ({workers})")
+        self._source = source
+        self.layers = list(layers)
+        self.worker_count = workers
+        self.slot_count = slots if slots is not None else 2 * workers
+        if self.slot_count < workers:
+            raise ValueError(f"need at least one slot per worker ({self.slot_count} < {workers})")
+
+        self.frame_lock = Lock()
+        self.frame_ready = Condition(self.frame_lock)
+        self.stop_capture = Event()
+        self.current_frame = None
+        self.current_info = None
+        self._frame_id = 0
+
+        self._context = mp.get_context(start_method)
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._free_slots = Queue()
+        for slot in range(self.slot_count):
+            self._free_slots.put(slot)
+        self._pending = {}
+        self._pending_lock = Lock()
+        self.workers = []
+        self._memory = []
+        self._inputs = None
+        self._outputs = None
+        self._pool_ready = Event()
+        self._source_ended = Event()
+        self._in_progress = self._context.Array("q", [-1] * workers, lock=False)
+        # after a worker died, frames dispatched before this may have been lost with it
+        self._lost_before = None
+        self._worker_args = None
+        self._stopped = False
+
+        self.dispatcher = Thread(target=self._dispatch)
+        self.collector = Thread(target=self._collect)
+        self.dispatcher.start()
+        self.collector.start()
+
+    def _start_pool(self, frame: np.ndarray, result: np.ndarray):
+        input_layout = ((self.slot_count, *frame.shape), frame.dtype.str)
+        output_layout = ((self.slot_count, *result.shape), result.dtype.str)
+        input_mem = SharedMemory(create=True, size=max(1, self.slot_count * frame.nbytes))
+        output_mem = SharedMemory(create=True, size=max(1, self.slot_count * result.nbytes))
+        self._memory = [input_mem, output_mem]
+        self._inputs = np.ndarray(input_layout[0], dtype=input_layout[1], buffer=input_mem.buf)
+        self._outputs = np.ndarray(output_layout[0], dtype=output_layout[1], buffer=output_mem.buf)
+
+        self._worker_args = (self.layers, input_mem.name, output_mem.name, input_layout, output_layout, self._tasks, self._results, self._in_progress)
+        for i in range(self.worker_count):
+            self.workers.append(self._start_worker(i))
+        self._pool_ready.set()
+
+    def _start_worker(self, index: int) -> Any:
+        self._in_progress[index] = -1
+        p = self._context.Process(target=_layer_worker, args=(*self._worker_args, index), daemon=True)
+        p.start()
+        return p
+
+    def _end_of_stream(self):
+        self.stop_capture.set()
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+
+    def _dispatch(self):
+        try:
+            self._dispatch_frames()
+        except Exception as e:
+            print(f"frame dispatch failed, stopping: {e!r}")
+            self._end_of_stream()
+
+    def _dispatch_frames(self):
+        last_id = None
+        seq = 0
+        while not self.stop_capture.is_set():
+            # the timeout only exists so that stop requests are noticed
+            if self._source.wait_for_frame(last_id, timeout=0.1) is None:
+                if not self._source.is_capturing():
+                    # the collector finishes what's in flight, and then ends the stream
+                    self._source_ended.set()
+                    return
+                continue
+            frame, info = self._source.get_frame_with_info()
+            if frame is None:
+                continue
+            last_id = info.frame_id
+
+            if self._inputs is None:
+                # Run the first frame locally to find out what the layers produce. It's a
+                # perfectly good frame, so publish it too. Layers that can't even do that
+                # aren't going to work on the frames after it, so failing here stops the camera.
+                result = frame
+                for layer in self.layers:
+                    result = layer(result)
+                self._start_pool(frame, result)
+                self._publish(info, np.array(result))
+                continue
+
+            if frame.shape != self._inputs.shape[1:]:
+                continue
+            try:
+                slot = self._free_slots.get_nowait()
+            except Empty:
+                # every slot is busy; drop this frame rather than fall further behind
+                continue
+            np.copyto(self._inputs[slot], frame, casting="unsafe")
+            with self._pending_lock:
+                self._pending[seq] = (info, slot)
+            self._tasks.put((slot, seq))
+            seq += 1
+
+    def _collect(self):
+        try:
+            self._collect_results()
+        except Exception as e:
+            print(f"collecting frames failed, stopping: {e!r}")
+            self._end_of_stream()
+
+    def _collect_results(self):
+        done = {}
+        next_seq = 0
+        while not self.stop_capture.is_set():
+            if not self._pool_ready.wait(timeout=0.1):
+                if self._source_ended.is_set():
+                    self._end_of_stream()
+                continue
+            try:
+                slot, seq, error = self._results.get(timeout=0.1)
+                # a frame given up on because its worker died may still turn up
+                if seq >= next_seq and seq not in done:
+                    done[seq] = (slot, error)
+            except Empty:
+                self._replace_dead_workers(done, next_seq)
+                self._give_up_lost(done, next_seq)
+            # hold on to results that finished early, so frames always come out in order
+            while next_seq in done:
+                slot, error = done.pop(next_seq)
+                with self._pending_lock:
+                    info, _ = self._pending.pop(next_seq)
+                if error is None:
+                    self._publish(info, np.array(self._outputs[slot]))
+                else:
+                    print(f"layer failed on frame {info.frame_id}: {error}")
+                self._free_slots.put(slot)
+                next_seq += 1
+            if self._source_ended.is_set():
+                with self._pending_lock:
+                    if len(self._pending) == 0:
+                        self._end_of_stream()
+
+    def _replace_dead_workers(self, done: dict[int, tuple[int, Optional[str]]], next_seq: int):
+        for i, p in enumerate(self.workers):
+            if p.is_alive():
+                continue
+            seq = self._in_progress[i]
+            print(f"layer worker {p.pid} died with exit code {p.exitcode}, starting another")
+            if seq >= next_seq and seq not in done:
+                # skip the frame it was working on, and get its slot back
+                with self._pending_lock:
+                    _, slot = self._pending[seq]
+                done[seq] = (slot, f"worker died with exit code {p.exitcode}")
+            # it may also have died holding a task it hadn't marked as in progress yet
+            with self._pending_lock:
+                self._lost_before = max(self._pending, default=-1) + 1
+            self.workers[i] = self._start_worker(i)
+
+    def _give_up_lost(self, done: dict[int, tuple[int, Optional[str]]], next_seq: int):
+        if self._lost_before is None:
+            return
+        if next_seq >= self._lost_before:
+            self._lost_before = None
+            return
+        # Tasks are taken in order, so a frame that nobody is working on, while some worker is on
+        # a later one (or all are idle with nothing queued), was taken by the worker that died.
+        # Only called once no results turned up for a while, so it isn't just late.
+        running = [self._in_progress[i] for i, p in enumerate(self.workers) if p.is_alive()]
+        idle = all(seq < 0 for seq in running) and self._tasks.empty()
+        with self._pending_lock:
+            for seq in range(next_seq, self._lost_before):
+                if seq not in self._pending or seq in done or seq in running:
+                    continue
+                if idle or any(r > seq for r in running):
+                    done[seq] = (self._pending[seq][1], "lost with a worker that died")
+
+    def _publish(self, info: FrameInfo, frame: np.ndarray):
+        with self.frame_ready:
+            self.current_frame = frame
+            self.current_info = info
+            self._frame_id = info.frame_id
+            self.frame_ready.notify_all()
+
+    def stop(self):
+        # also after the stream ended on its own, since the workers and source still need to stop
+        if self._stopped:
+            return
+        self._stopped = True
+        self._end_of_stream()
+        self.dispatcher.join()
+        self.collector.join()
+        for _ in self.workers:
+            self._tasks.put(None)
+        for p in self.workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._inputs = None
+        self._outputs = None
+        for mem in self._memory:
+            mem.close()
+            mem.unlink()
+        self._source.stop()
+
+    def is_capturing(self) -> bool:
+        return self.dispatcher.is_alive() and self.collector.is_alive()
+
+    def get_frame(self) -> Optional[np.ndarray]:
+        """Returns the most recent frame to make it through the layers. The frame is copied out of
+        shared memory, so it is safe to hold on to.
+        """
+        with self.frame_lock:
+            res = self.current_frame
+        return res
+
+    def get_frame_with_info(self) -> tuple[Optional[np.ndarray], Optional[FrameInfo]]:
+        with self.frame_lock:
+            return self.current_frame, self.current_info
+
+    def frame_info(self) -> Optional[FrameInfo]:
+        return self.current_info
+
+    def pixel_formats(self) -> tuple[str, ...]:
+        # layers may end the chain with gray frames, and `get_frame_as` goes by the frame anyway
+        with self.frame_lock:
+            frame = self.current_frame
+        return _formats_from(BGR if frame is None else frame_format(frame))
+
+    def source(self) -> Any:
+        return self._source.source()
+
+    def frame_size(self) -> tuple[int, int]:
+        if self._outputs is not None:
+            return (self._outputs.shape[2], self._outputs.shape[1])
+        return self._source.frame_size()
+
+    def frame_id(self) -> int:
+        return self._frame_id
+
+    def wait_for_frame(self, last_id: Optional[int] = None, timeout: Optional[float] = None) -> Optional[int]:
+        return _wait_for_frame(self.frame_ready, lambda: self.current_frame is not None,
+                               lambda: self._frame_id, last_id, self.stop_capture, timeout)
@@ -0,0 +1,144 @@
+import time
+from dataclasses import replace
+
+from typing import Optional
+
+from .client_writer import ClientWriter
+from .message import StreamProfile, get_codec
+
+
+class AdaptiveController:
+    """Adjusts the video one client gets to what its connection can actually carry.
+
+    The client's own profile is the best it will ever get (the ceiling). Below that is a ladder
+    of cheaper profiles: lower quality first (for lossy codecs), then smaller frames, then fewer
+    frames per second. Every `interval` seconds, `update` looks at how the client's
+    `ClientWriter` got on, and moves along the ladder:
+        - down, fast, when the client is congested: it had messages dropped, its queue is
+          full, it stalled, or messages took longer than `latency_budget` to go out. It falls
+          halfway to the bottom of the ladder at once.
+        - down one step when it used more than `target_bitrate` (bits per second).
+        - up one step once it has been comfortably within both limits for `up_after` seconds.
+    A step up that is undone right away doubles the wait before trying that step again (up to
+    `max_up_after`), so a connection that sits right at a limit doesn't oscillate across it.
+    Steps below the one that failed are still retaken after `up_after`.
+
+    Ladder steps are plain profiles, so clients that end up on the same step share their
+    encoded frames like any others.
+    """
+    ceiling: StreamProfile
+    source_size: tuple[int, int]
+    target_bitrate: Optional[float]
+    latency_budget: Optional[float]
+    interval: float
+    up_after: float
+    max_up_after: float
+    ladder: list[StreamProfile]
+    level: int
+    bitrate: float
+
+    def __init__(self, ceiling: StreamProfile, source_size: tuple[int, int], target_bitrate: Optional[float] = None, latency_budget: Optional[float] = None,
+                 interval: float = 0.5, up_after: float = 2.0, max_up_after: float = 16.0, min_quality: int = 5):
+        if interval <= 0:
+            raise ValueError(f"interval must be positive ({interval})")
+        self.ceiling = ceiling
+        self.source_size = (int(source_size[0]), int(source_size[1]))
+        self.target_bitrate = target_bitrate
+        self.latency_budget = latency_budget
+        self.interval = interval
+        self.up_after = up_after
+        self.max_up_after = max_up_after
+        self.ladder = self._build_ladder(min_quality)
+        self.level = 0
+        self.bitrate = 0
+
+        self._hold = up_after
+        self._failed_level = None
+        self._good_since = None
+        self._climbed_at = None
+        self._last_update = None
+        self._last_bytes = 0
+        self._last_dropped = 0
+
+    def _build_ladder(self, min_quality: int) -> list[StreamProfile]:
+        top = self.ceiling
+        ladder = [top]
+        if get_codec(top.codec).lossy:
+            q = top.quality
+            while q > min_quality:
+                q = max(min_quality, int(q * 0.7))
+                ladder.append(replace(ladder[-1], quality = q))
+        w, h = top.size if top.size is not None else self.source_size
+        for scale in (0.75, 0.5):
+            ladder.append(replace(ladder[-1], size = (max(1, int(w * scale)), max(1, int(h * scale)))))
+        for fps in (15, 10, 5):
+            if top.max_fps <= 0 or fps < top.max_fps:
+                ladder.append(replace(ladder[-1], max_fps = fps))
+        return ladder
+
+    @property
+    def profile(self) -> StreamProfile:
+        """The profile the client should be sent right now."""
+        return self.ladder[self.level]
+
+    def update(self, writer: ClientWriter, now: Optional[float] = None) -> StreamProfile:
+        """Measures how `writer` did since the last call, moves along the ladder if needed, and
+        returns the profile to use. Does nothing until `interval` has passed since the last
+        measurement, so it's fine to call for every frame.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self._last_update is None:
+            self._last_update = now
+            self._last_bytes = writer.bytes_sent
+            self._last_dropped = writer.dropped
+            return self.profile
+        elapsed = now - self._last_update
+        if elapsed < self.interval:
+            return self.profile
+
+        self.bitrate = 8 * (writer.bytes_sent - self._last_bytes) / elapsed
+        dropped = writer.dropped - self._last_dropped
+        self._last_update = now
+        self._last_bytes = writer.bytes_sent
+        self._last_dropped = writer.dropped
+
+        budget = self.latency_budget
+        congested = (dropped > 0 or len(writer.queue) >= writer.max_queue
+                     or (budget is not None and (writer.latency > budget or writer.stalled_for() > budget)))
+        over = self.target_bitrate is not None and self.bitrate > self.target_bitrate
+        if congested or over:
+            last = len(self.ladder) - 1
+            step = max(1, (last - self.level + 1) // 2) if congested else 1
+            self._step_down(min(last, self.level + step), now)
+            return self.profile
+
+        comfortable = ((self.target_bitrate is None or self.bitrate < 0.7 * self.target_bitrate)
+                       and (budget is None or writer.latency < budget / 2))
+        if not comfortable:
+            self._good_since = None
+        elif self._good_since is None:
+            self._good_since = now
+        elif self.level > 0 and now - self._good_since >= self._wait_before(self.level - 1):
+            if self._failed_level is not None and self.level <= self._failed_level:
+                # made it past the step that failed, so the connection has settled
+                self._failed_level = None
+                self._hold = self.up_after
+            self.level -= 1
+            self._climbed_at = now
+            self._good_since = now
+        return self.profile
+
+    def _wait_before(self, level: int) -> float:
+        if self._failed_level is not None and level <= self._failed_level:
+            return self._hold
+        return self.up_after
+
+    def _step_down(self, level: int, now: float):
+        if self._climbed_at is not None and now - self._climbed_at < self._wait_before(self.level):
+            # the last step up didn't hold, so be slower to try it again
+            self._hold = min(self.max_up_after, self._hold * 2)
+            self._failed_level = self.level
+        self._climbed_at = None
+        self._good_since = None
+        self.level = level
@@ -1,66 +1,230 @@
 import numpy as np
-from threading import Thread, Lock, Event
-from socket import socket
+from threading import Thread, Lock, Event, Condition
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, SO_SNDBUF, IPPROTO_IP, IP_MULTICAST_TTL, IP_MULTICAST_IF, inet_aton
 import time
+from dataclasses import dataclass, replace
 import cv2 as cv
 
 
-from .socket_buffer import BufferedSocket
+from .client_writer import ClientWriter, Message, DROP_OLDEST, DROP_NEWEST, DISCONNECT
+from .event_loop import EventLoop
 from .socket_pool import SocketPool
-from .camera import FrameSource
+from .camera import FrameSource, FrameInfo, BGR, JPEG as JPEG_FRAMES
 from .frame_limiter import FrameSequencer
-from .message import format_data, format_frame
+from .message import (StreamProfile, TileEncoder, MessageHeader, format_data, format_repeat, encoded_frame_segments, parse_client_messages, get_codec,
+                      SUBSCRIBE_MAGIC_FLAG, KEYFRAME_REQUEST, JPEG, PNG, TILES, FRAME, REPEAT, DATA, RESENT, STANDALONE)
+from .udp import fragment_frame, send_fragments, DEFAULT_DATAGRAM_SIZE, DATAGRAM_CLIENT_TIMEOUT
+from .encode_cache import EncodeCache
+from .rate_control import AdaptiveController
+from .change_detector import ChangeDetector
 from .match_data import MatchData
 
-from typing import Optional, Callable
+from typing import Any, Optional, Callable
 
 import time
 
 
+def _reference_view(frame: Any) -> np.ndarray:
+    # a `CameraGroup` frame is a tuple with one frame per camera, and the first one is what gets streamed
+    return frame[0] if isinstance(frame, tuple) else frame
+
+
+class _Latest:
+    """Hands items from one thread to another, keeping only the newest. Putting never blocks, and
+    anything the consumer didn't get to in time is counted in `dropped`.
+    """
+    def __init__(self):
+        self.cond = Condition()
+        self.item = None
+        self.fresh = False
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item: Any):
+        with self.cond:
+            if self.fresh:
+                self.dropped += 1
+            self.item = item
+            self.fresh = True
+            self.cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """The newest item that hasn't been taken yet, or `None` if none arrives in `timeout` 
+        seconds, or the hand-off is closed.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.fresh or self.closed, timeout) or not self.fresh:
+                return None
+            self.fresh = False
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        """Wakes up anyone waiting in `get`, for good."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+_event_loop_lock = Lock()
+
+
+@dataclass(frozen=True)
+class ClientOptions:
+    """How a `MatchStream` sends to each of its TCP clients, see `ClientWriter`. Each client has
+    its own queue of `max_queue` messages, so a slow one only ever loses its own messages, and
+    `policy` decides which ones it loses.
+    """
+    max_queue: int = 2
+    policy: str = DROP_OLDEST
+    stall_timeout: float = 1.0
+
+    def __post_init__(self):
+        # fail now rather than on the first connection
+        if self.policy not in (DROP_OLDEST, DROP_NEWEST, DISCONNECT):
+            raise ValueError(f"unknown send policy '{self.policy}'")
+        if self.max_queue <= 0:
+            raise ValueError(f"queue must hold at least one message ({self.max_queue})")
+
+@dataclass(frozen=True)
+class DatagramOptions:
+    """Where a `MatchStream` sends video over UDP, where a lost packet only ever costs the frame 
+    it was in (see `udp.py`).
+
+    Clients subscribe by sending their profile to `port` (any free port if `None`), and renew it 
+    regularly, see `DatagramFrameStreamClient`. With a `multicast_group` (address, port), the 
+    default profile is sent there as well, whether anyone listens or not, so any number of 
+    viewers on the network cost a single send. `multicast_interface` picks the interface it 
+    goes out of (`"127.0.0.1"` keeps it on this machine), and `multicast_ttl` how many routers 
+    it may cross. Frames are split into datagrams of at most `datagram_size` bytes.
+    """
+    port: Optional[int] = None
+    multicast_group: Optional[tuple[str, int]] = None
+    multicast_interface: Optional[str] = None
+    multicast_ttl: int = 1
+    datagram_size: int = DEFAULT_DATAGRAM_SIZE
+
+@dataclass(frozen=True)
+class EncodingOptions:
+    """How a `MatchStream` decides what to encode, and how well.
+
+    Setting `target_bitrate` (bits per second, per client) or `latency_budget` (seconds) makes 
+    video adaptive: each frame client gets an `AdaptiveController`, which lowers its quality, 
+    size and rate below what it asked for while its connection can't keep up, and raises them 
+    again once it can.
+
+    With a `change_threshold`, frames that look the same as the last one sent (see 
+    `ChangeDetector`) aren't encoded or sent again. Clients get a tiny repeat message instead, 
+    and keep showing the image they have, while clients that don't have it yet get the 
+    previous encoded frame. A real frame goes out at least every `max_repeat_age` seconds 
+    anyway. Frames passed through from the camera are always sent, since they're never decoded 
+    to compare.
+
+    Clients that subscribe with the `TILES` codec get only the `tile_size` tiles that changed by 
+    more than `tile_threshold` (see `TileEncoder`), with a keyframe every `keyframe_interval` 
+    seconds, and whenever a client joins or asks for one.
+    """
+    target_bitrate: Optional[float] = None
+    latency_budget: Optional[float] = None
+    change_threshold: Optional[float] = None
+    max_repeat_age: float = 1.0
+    tile_size: int = 32
+    tile_threshold: float = 4.0
+    keyframe_interval: float = 2.0
+
+
 class MatchStream:
     source: FrameSource
     stream_size: Optional[tuple[int, int]]
     stream_rate: Optional[float]
-    last_frame: float
-    frame_delay: float
+    default_profile: StreamProfile
+    client_profiles: dict[ClientWriter, StreamProfile]
+    client_options: ClientOptions
+    encode_cache: Optional[EncodeCache]
+    encodes: int
+    target_bitrate: Optional[float]
+    latency_budget: Optional[float]
+    controllers: dict[ClientWriter, AdaptiveController]
+    change_detector: Optional[ChangeDetector]
+    tile_options: dict[str, Any]
+    repeats: int
 
-    frame_listener: Thread
     frame_connection_listener: socket
-    frame_connections: list[socket]
+    frame_connections: list[ClientWriter]
     frame_connection_lock: Lock
     
-    match_listener: Thread
     match_connection_listener: socket
-    match_connections: list[socket]
+    match_connections: list[ClientWriter]
     match_connection_lock: Lock
 
+    datagram_socket: Optional[socket]
+    datagram_clients: dict[tuple[str, int], tuple[Optional[StreamProfile], float]] # profile (`None` for the default) and when it was last renewed
+    multicast_group: Optional[tuple[str, int]]
+    datagram_size: int
+
     matcher: Optional[Callable[[np.ndarray], list[MatchData]]]
+    matcher_format: str
     match_visualizer: Optional[Callable[[np.ndarray, list[MatchData]], np.ndarray]]
     match_worker: Thread
+    frame_encoder: Thread
 
+    event_loop: EventLoop # shared by all streams, see `shared_event_loop`
     terminate_call: Event
 
     @classmethod
     def create_socket_pool(cls, start, end):
         cls.socket_pool = SocketPool(start, end)
 
-    def __init__(self, source: FrameSource, port: Optional[int] = None, stream_size: Optional[tuple[int, int]] = None, stream_rate: Optional[float] = None, compressed: bool = True):
+    def __init__(self, source: FrameSource, port: Optional[int] = None, stream_size: Optional[tuple[int, int]] = None, stream_rate: Optional[float] = None, compressed: bool = True,
+                 default_profile: Optional[StreamProfile] = None, clients: ClientOptions = ClientOptions(), datagrams: Optional[DatagramOptions] = None,
+                 encoding: EncodingOptions = EncodingOptions(), encode_cache: Optional[EncodeCache] = None):
+        """`stream_size`, `stream_rate` and `compressed` make up the default `StreamProfile`, for 
+        frame clients that don't subscribe with one of their own. A whole `default_profile` can 
+        be given instead, for any other registered codec and level (see `register_codec`), such 
+        as raw frames for clients on the same machine. Each distinct profile is encoded once per 
+        frame, and shared by every client that asked for it. Streams of the same source can also 
+        share their encoded frames by sharing an `encode_cache`. Entries are keyed by frame id, 
+        so a cache must never be shared across sources.
+
+        `clients` decides what happens to clients that can't keep up (see `ClientOptions`), 
+        `datagrams` sends video over UDP as well (see `DatagramOptions`), and `encoding` makes 
+        video adaptive, skips unchanged frames and sets up tiles (see `EncodingOptions`).
+        """
         if not hasattr(MatchStream, "socket_pool"):
             raise ValueError("socket pool not initialized")
+        self.client_options = clients
         self.source = FrameSequencer(source)
         self.stream_size = stream_size
         self.stream_rate = stream_rate
         self.compressed = compressed
-        self.last_frame = 0
-        if stream_rate is not None and stream_rate > 0:
-            self.frame_delay = 1 / stream_rate
-        else:
-            self.frame_delay = 0
+        if default_profile is None:
+            default_profile = StreamProfile(stream_size, JPEG if compressed else PNG, max_fps = stream_rate if stream_rate is not None and stream_rate > 0 else 0)
+        self.default_profile = default_profile
+        self.client_profiles = {}
+        self._subscription_buffers = {}
+        self.encode_cache = encode_cache
+        self.encodes = 0
+        self.target_bitrate = encoding.target_bitrate
+        self.latency_budget = encoding.latency_budget
+        self.controllers = {}
+        self.change_detector = None
+        if encoding.change_threshold is not None:
+            self.change_detector = ChangeDetector(encoding.change_threshold, max_repeat_age = encoding.max_repeat_age)
+        self.repeats = 0
+        # the last frame each profile was sent in, and the profile each client last got a whole 
+        # frame in, so that repeats only go to clients that have something to repeat
+        self._last_encoded = {}
+        self._primed = {}
+        # the sequence number of the last message sent to each frame client, and to all data clients
+        self._sequences = {}
+        self._data_sequence = 0
+        self.tile_options = {"tile_size": encoding.tile_size, "threshold": encoding.tile_threshold, "keyframe_interval": encoding.keyframe_interval}
+        self._tile_encoders = {}
+        # when each profile was last sent, for its `max_fps`
+        self._last_sent = {}
 
         self.terminate_call = Event()
 
         self.frame_connection_listener = MatchStream.socket_pool.allocate(port)
-        self.frame_connection_listener.settimeout(1)
         if self.frame_connection_listener is None:
             raise ValueError("out of valid sockets")
 
@@ -68,111 +232,439 @@ class MatchStream:
         self.frame_connection_lock = Lock()
 
         self.match_connection_listener = MatchStream.socket_pool.allocate(None if port is None else port+1)
-        self.match_connection_listener.settimeout(1)
         if self.match_connection_listener is None:
             raise ValueError("out of valid sockets")
 
         self.match_connections = []
         self.match_connection_lock = Lock()
 
-        def frame_listener():
-            self.frame_connection_listener.listen()
-            while not self.terminate_call.is_set():
-                try:
-                    sock, _addr = self.frame_connection_listener.accept()
-                    with self.frame_connection_lock:
-                        self.frame_connections.append(BufferedSocket(sock))
-                except TimeoutError:
-                    time.sleep(0.1)
-                    pass
-
-        self.frame_listener = Thread(target=frame_listener)
-
-        def match_listener():
-            self.match_connection_listener.listen()
-            while not self.terminate_call.is_set():
-                try:
-                    sock, _addr = self.match_connection_listener.accept()
-                    with self.match_connection_lock:
-                        self.match_connections.append(BufferedSocket(sock))
-                except TimeoutError:
-                    time.sleep(0.1)
-                    pass
-
-        self.match_listener = Thread(target=match_listener)
+        self.datagram_clients = {}
+        self.multicast_group = None
+        self.datagram_size = DEFAULT_DATAGRAM_SIZE
+        self.datagram_socket = None
+        if datagrams is not None:
+            self.multicast_group = datagrams.multicast_group
+            self.datagram_size = datagrams.datagram_size
+            self.datagram_socket = socket(AF_INET, SOCK_DGRAM)
+            self.datagram_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            # room for a few whole frames, since a full buffer drops the rest of a frame
+            self.datagram_socket.setsockopt(SOL_SOCKET, SO_SNDBUF, 1 << 20)
+            if datagrams.multicast_group is not None:
+                self.datagram_socket.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, datagrams.multicast_ttl)
+                if datagrams.multicast_interface is not None:
+                    self.datagram_socket.setsockopt(IPPROTO_IP, IP_MULTICAST_IF, inet_aton(datagrams.multicast_interface))
+            self.datagram_socket.bind(("", datagrams.port or 0))
+            self.datagram_socket.setblocking(False)
+        # notified whenever a client comes or goes, so idle streams can wait for one
+        self.connections_changed = Condition()
 
         self.matcher = None
+        self.matcher_format = BGR
         self.match_visualizer = None
-        
-        def detect_send():
+
+        # The encoder only ever looks at the newest frame that has been matched. If it falls 
+        # behind, it skips ahead instead of holding up the matcher.
+        self.video_handoff = _Latest()
+
+        def detect():
+            # Pulls frames and runs the matcher, as fast as the matcher allows. Nothing on the 
+            # video side can block this thread: it only ever drops a frame into a hand-off, and 
+            # messages are passed to the event loop, which never blocks on a client either.
             while not self.terminate_call.is_set():
-                if len(self.frame_connections) == 0 and len(self.match_connections) == 0:
-                    time.sleep(0.1)
+                with self.connections_changed:
+                    self.connections_changed.wait_for(lambda: self.terminate_call.is_set() or self.has_clients())
+                if self.terminate_call.is_set():
+                    break
+                if self.can_pass_through():
+                    # time out occasionally so that a stalled source can't keep the stream from stopping
+                    encoded, info = self.source.get_encoded_frame(timeout=0.5)
+                    if encoded is not None:
+                        self.video_handoff.put((None, encoded, None, info))
+                        continue
+                matching = self.matcher is not None and len(self.match_connections) > 0
+                # Only ask for colour if someone actually looks at it. Both formats come from 
+                # the same frame, so matches always line up with what's streamed.
+                formats = [self.matcher_format] if matching else []
+                if BGR not in formats and self.has_frame_clients():
+                    formats.append(BGR)
+                # time out occasionally so that a stalled source can't keep the stream from stopping
+                frames, info = self.source.get_frame_as(formats, timeout=0.5)
+                if frames is None:
                     continue
-                frame = self.source.get_frame()
-                if frame is None:
-                    time.sleep(0.05)
-                    continue
-                if self.matcher is not None and len(self.match_connections) > 0:
-                    matches = self.matcher(frame)
-                    if self.match_visualizer is not None:
-                        frame = self.match_visualizer(frame, matches)
-                   
-                    msg = format_data(matches)
-                    bads = []
-                    for c in self.match_connections:
-                        try:
-                            c.write(msg, flush=True)
-                        except:
-                            c.close()
-                            bads.append(c)
-                    with self.match_connection_lock:
-                        for c in bads:
-                            self.match_connections.remove(c)
-                
-                if len(self.frame_connections) == 0:
+                matches = None
+                if matching:
+                    matches = self.matcher(frames[0])
+                    # every data client gets every message, so one count covers them all
+                    self._data_sequence = (self._data_sequence + 1) & 0xFFFFFFFF
+                    height, width = _reference_view(frames[0]).shape[:2]
+                    header = MessageHeader.now(DATA, info.timestamp, sequence = self._data_sequence, frame_id = info.frame_id,
+                                               width = width, height = height)
+                    self.broadcast(format_data(matches, header), self.match_connections, self.match_connection_lock)
+                if BGR in formats:
+                    self.video_handoff.put((_reference_view(frames[formats.index(BGR)]), None, matches, info))
+
+        def encode():
+            while not self.terminate_call.is_set():
+                item = self.video_handoff.get()
+                if item is None:
                     continue
-                if time.perf_counter() < self.last_frame + self.frame_delay:
+                frame, encoded, matches, info = item
+                now = time.perf_counter()
+                writers = self.profile_groups()
+                addresses = self.datagram_groups()
+                due = [p for p in set(writers) | set(addresses)
+                       if p.max_fps <= 0 or now >= self._last_sent.get(p, 0) + 1 / p.max_fps]
+                if len(due) == 0:
                     continue
-                self.last_frame = time.perf_counter()
-                
-                if self.stream_size is not None:
-                    frame = cv.resize(frame, self.stream_size)
-                msg = format_frame(frame, compressed = self.compressed)
-                bads = []
-                for c in self.frame_connections:
-                    try:
-                        c.write(msg, flush=True)
-                    except:
-                        c.close()
-                        bads.append(c)
-                with self.frame_connection_lock:
-                    for c in bads:
-                        self.frame_connections.remove(c)
-
-        self.match_worker = Thread(target=detect_send)
+                if frame is not None and matches is not None and self.match_visualizer is not None:
+                    frame = self.match_visualizer(frame, matches)
+                current = set(writers) | set(addresses)
+                self._last_encoded = {p: e for p, e in self._last_encoded.items() if p in current}
+                thumbnail = None
+                if frame is not None and self.change_detector is not None:
+                    thumbnail = self.change_detector.thumbnail(frame)
+                    self.change_detector.forget(current)
+                self._tile_encoders = {p: e for p, e in self._tile_encoders.items() if p in current}
+                for profile in due:
+                    self._last_sent[profile] = now
+                    if profile.codec == TILES and frame is not None:
+                        self._send_tiles(profile, frame, writers.get(profile, []), addresses.get(profile, []), info)
+                        continue
+                    # asked even for a profile's first frame, which becomes the reference to compare with
+                    if thumbnail is not None and not self.change_detector.changed(thumbnail, profile) and profile in self._last_encoded:
+                        self._send_repeat(profile, writers.get(profile, []), addresses.get(profile, []), info)
+                        continue
+                    # passed through frames are already compressed, and suit every profile 
+                    # (see `can_pass_through`)
+                    image = encoded if encoded is not None else self._encode(frame, info, profile)
+                    self._last_encoded[profile] = (image, info)
+                    self._send_frame(profile, image, writers.get(profile, []), addresses.get(profile, []), info)
+
+        self.match_worker = Thread(target=detect)
+        self.frame_encoder = Thread(target=encode)
+        self._listening = Event()
+        self._closed = Event()
+
+    def _frame_header(self, kind: int, profile: StreamProfile, info: FrameInfo, flags: int = 0) -> MessageHeader:
+        w, h = profile.size if profile.size is not None else self.source.frame_size()
+        if kind == FRAME and profile.codec != TILES:
+            flags |= STANDALONE
+        return MessageHeader.now(kind, info.timestamp, frame_id = info.frame_id, codec_id = get_codec(profile.codec).id,
+                                 width = w, height = h, flags = flags)
 
+    def _next_sequences(self, clients: list[Any]) -> list[int]:
+        # every client counts its own messages, so the ones it misses show up as gaps however 
+        # it's grouped with others
+        with self.frame_connection_lock:
+            sequences = []
+            for c in clients:
+                self._sequences[c] = (self._sequences.get(c, 0) + 1) & 0xFFFFFFFF
+                sequences.append(self._sequences[c])
+            return sequences
+
+    def _send_frame(self, profile: StreamProfile, image: np.ndarray, writers: list[ClientWriter], addresses: list[tuple[str, int]], info: FrameInfo, flags: int = 0):
+        header = self._frame_header(FRAME, profile, info, flags)
+        for w, sequence in zip(writers, self._next_sequences(writers)):
+            # the image itself is shared, only the header is each client's own
+            self.send_to(encoded_frame_segments(image, replace(header, sequence = sequence)), [w])
+        for address, sequence in zip(addresses, self._next_sequences(addresses)):
+            send_fragments(self.datagram_socket, fragment_frame(image, replace(header, sequence = sequence), self.datagram_size), address)
+        with self.frame_connection_lock:
+            for c in writers + addresses:
+                self._primed[c] = profile
+
+    def _send_tiles(self, profile: StreamProfile, frame: np.ndarray, writers: list[ClientWriter], addresses: list[tuple[str, int]], info: FrameInfo):
+        with self.frame_connection_lock:
+            # anyone without a picture to build on needs a keyframe, and everyone gets it
+            keyframe = any(self._primed.get(c) != profile for c in writers + addresses)
+        encoder = self._tile_encoders.get(profile)
+        if encoder is None:
+            encoder = TileEncoder(profile.quality, **self.tile_options)
+            self._tile_encoders[profile] = encoder
+        if profile.size is not None and (frame.shape[1], frame.shape[0]) != profile.size:
+            frame = cv.resize(frame, profile.size)
+        payload = encoder.encode(frame, keyframe)
+        if payload is None:
+            # not a single tile changed
+            self._send_repeat(profile, writers, addresses, info)
+            return
+        self._send_frame(profile, np.frombuffer(payload, dtype=np.uint8), writers, addresses, info)
+
+    def _send_repeat(self, profile: StreamProfile, writers: list[ClientWriter], addresses: list[tuple[str, int]], info: FrameInfo):
+        with self.frame_connection_lock:
+            fresh = [c for c in writers + addresses if self._primed.get(c) != profile]
+        if len(fresh) > 0 and profile in self._last_encoded:
+            # these have no image in this profile yet, so they get the one the others are keeping
+            image, previous = self._last_encoded[profile]
+            self._send_frame(profile, image, [w for w in writers if w in fresh], [a for a in addresses if a in fresh], previous, RESENT)
+        header = self._frame_header(REPEAT, profile, info)
+        writers = [w for w in writers if w not in fresh]
+        for w, sequence in zip(writers, self._next_sequences(writers)):
+            self.send_to(format_repeat(replace(header, sequence = sequence)), [w])
+        addresses = [a for a in addresses if a not in fresh]
+        for address, sequence in zip(addresses, self._next_sequences(addresses)):
+            send_fragments(self.datagram_socket, [[memoryview(format_repeat(replace(header, sequence = sequence)))]], address)
+        self.repeats += 1
+
+    @classmethod
+    def shared_event_loop(cls) -> EventLoop:
+        """The event loop that does the socket work for every stream."""
+        with _event_loop_lock:
+            if not hasattr(MatchStream, "event_loop"):
+                MatchStream.event_loop = EventLoop()
+            return MatchStream.event_loop
 
     def start(self):
         if self.terminate_call.is_set():
             raise ValueError("cannot restart a terminated stream")
-        self.frame_listener.start()
-        self.match_listener.start()
-        self.match_worker.start()
+        loop = self.shared_event_loop()
+        loop.acquire()
+        loop.call_soon(self._listen, loop)
+        # clients may connect as soon as this returns
+        self._listening.wait()
+        for t in self.workers():
+            t.start()
+
+    def _listen(self, loop: EventLoop):
+        for listener, connections, lock in ((self.frame_connection_listener, self.frame_connections, self.frame_connection_lock),
+                                            (self.match_connection_listener, self.match_connections, self.match_connection_lock)):
+            listener.listen()
+            loop.add_listener(listener, lambda sock, c=connections, l=lock: self._accept(loop, sock, c, l))
+        if self.datagram_socket is not None:
+            loop.add_datagram_socket(self.datagram_socket, self._datagram_subscribe)
+        self._listening.set()
+
+    def _accept(self, loop: EventLoop, sock: socket, connections: list[ClientWriter], lock: Lock):
+        options = self.client_options
+        writer = ClientWriter(sock, options.max_queue, options.policy, options.stall_timeout)
+        with lock:
+            connections.append(writer)
+        on_data = self._subscribe if connections is self.frame_connections else None
+        loop.add_client(writer, lambda w: self._disconnected(w, connections, lock), on_data)
+        with self.connections_changed:
+            self.connections_changed.notify_all()
+
+    def _subscribe(self, writer: ClientWriter, data: bytes):
+        buffer = self._subscription_buffers.setdefault(writer, bytearray())
+        buffer.extend(data)
+        profiles, keyframe = parse_client_messages(buffer)
+        with self.frame_connection_lock:
+            if len(profiles) > 0:
+                self.client_profiles[writer] = profiles[-1]
+            if keyframe:
+                # as far as the encoder is concerned, the client has nothing to build on now
+                self._primed.pop(writer, None)
+
+    def _datagram_subscribe(self, data: bytes, address: tuple[str, int]):
+        if data == KEYFRAME_REQUEST:
+            with self.frame_connection_lock:
+                # requests from multicast viewers come from addresses the server doesn't know
+                self._primed.pop(address if address in self.datagram_clients else self.multicast_group, None)
+            return
+        # a bare magic flag asks for the default profile
+        if data == SUBSCRIBE_MAGIC_FLAG:
+            profile = None
+        else:
+            profiles, _ = parse_client_messages(bytearray(data))
+            if len(profiles) == 0:
+                return
+            profile = profiles[-1]
+        with self.frame_connection_lock:
+            new = address not in self.datagram_clients
+            self.datagram_clients[address] = (profile, time.monotonic())
+        if new:
+            with self.connections_changed:
+                self.connections_changed.notify_all()
+
+    def _disconnected(self, writer: ClientWriter, connections: list[ClientWriter], lock: Lock):
+        with lock:
+            connections.remove(writer)
+            self.client_profiles.pop(writer, None)
+            self.controllers.pop(writer, None)
+            self._primed.pop(writer, None)
+            self._sequences.pop(writer, None)
+        self._subscription_buffers.pop(writer, None)
+        with self.connections_changed:
+            self.connections_changed.notify_all()
+
+    def _close(self, loop: EventLoop):
+        if self._listening.is_set():
+            loop.remove_listener(self.frame_connection_listener)
+            loop.remove_listener(self.match_connection_listener)
+            if self.datagram_socket is not None:
+                loop.remove_listener(self.datagram_socket)
+        for connections, lock in ((self.frame_connections, self.frame_connection_lock), (self.match_connections, self.match_connection_lock)):
+            with lock:
+                writers = list(connections)
+            for w in writers:
+                loop.close_client(w)
+        self._closed.set()
+
+    def broadcast(self, msg: Message, connections: list[ClientWriter], lock: Lock):
+        """Queues `msg` for every client in `connections`. Safe to call from any thread, and never 
+        blocks on a client. Every client shares the same message, rather than a copy of it.
+        """
+        with lock:
+            writers = list(connections)
+        self.send_to(msg, writers)
+
+    def send_to(self, msg: Message, writers: list[ClientWriter]):
+        loop = self.shared_event_loop()
+        for w in writers:
+            loop.call_soon(loop.send, w, msg)
+
+    def profile_groups(self) -> dict[StreamProfile, list[ClientWriter]]:
+        """The frame clients, grouped by the profile they should get their video in right now. 
+        For adaptive streams, that's where each client's controller has it on its ladder.
+        """
+        groups = {}
+        with self.frame_connection_lock:
+            for w in self.frame_connections:
+                profile = self.client_profiles.get(w, self.default_profile)
+                if self.is_adaptive():
+                    controller = self.controllers.get(w)
+                    if controller is None or controller.ceiling != profile:
+                        controller = AdaptiveController(profile, self.source.frame_size(), self.target_bitrate, self.latency_budget)
+                        self.controllers[w] = controller
+                    profile = controller.update(w)
+                groups.setdefault(profile, []).append(w)
+        return groups
+
+    def datagram_groups(self) -> dict[StreamProfile, list[tuple[str, int]]]:
+        """Where video goes over UDP, grouped by profile, after forgetting subscribers that 
+        haven't renewed in time. These clients don't adapt, since nothing tells the server how 
+        they're doing.
+        """
+        groups = {}
+        if self.multicast_group is not None:
+            groups[self.default_profile] = [self.multicast_group]
+        with self.frame_connection_lock:
+            self._expire_datagram_clients()
+            for address, (profile, _) in self.datagram_clients.items():
+                groups.setdefault(profile or self.default_profile, []).append(address)
+        return groups
+
+    def _expire_datagram_clients(self):
+        now = time.monotonic()
+        for address in [a for a, (_, seen) in self.datagram_clients.items() if now - seen > DATAGRAM_CLIENT_TIMEOUT]:
+            del self.datagram_clients[address]
+            self._primed.pop(address, None)
+            self._sequences.pop(address, None)
+
+    def is_adaptive(self) -> bool:
+        return self.target_bitrate is not None or self.latency_budget is not None
+
+    def has_clients(self) -> bool:
+        return self.has_frame_clients() or len(self.match_connections) > 0
+
+    def has_frame_clients(self) -> bool:
+        if len(self.frame_connections) > 0 or self.multicast_group is not None:
+            return True
+        with self.frame_connection_lock:
+            self._expire_datagram_clients()
+            return len(self.datagram_clients) > 0
 
     def stop(self):
         if self.terminate_call.is_set():
             return
         self.terminate_call.set()
-        self.frame_listener.join()
-        self.match_listener.join()
-        self.match_worker.join()
+        with self.connections_changed:
+            self.connections_changed.notify_all()
+        self.video_handoff.close()
+        for t in self.workers():
+            if t.is_alive():
+                t.join()
+        if self.match_worker.ident is not None:
+            # started, so the event loop has to let go of the sockets before they're closed
+            loop = self.shared_event_loop()
+            loop.call_soon(self._close, loop)
+            self._closed.wait()
+            loop.release()
         type(self).socket_pool.deallocate(self.frame_connection_listener.getsockname()[1])
         type(self).socket_pool.deallocate(self.match_connection_listener.getsockname()[1])
+        if self.datagram_socket is not None:
+            self.datagram_socket.close()
+
+
+    def workers(self) -> list[Thread]:
+        """The threads frames go through. Matches are handed to the event loop as soon as the 
+        matcher is done, while encoding video happens on a thread of its own, and only ever gets
+        the newest frame that has been matched. Video therefore can't add latency to match data,
+        however slow encoding or viewers are.
+        """
+        return [self.match_worker, self.frame_encoder]
+
+    def dropped_frames(self) -> dict[str, int]:
+        """How many matched frames the encoder skipped, because it was still busy with an earlier 
+        one. Frames dropped for individual clients are in `client_stats`.
+        """
+        return {"video": self.video_handoff.dropped}
+
+    def _encode(self, frame: np.ndarray, info: FrameInfo, profile: StreamProfile) -> np.ndarray:
+        if self.encode_cache is not None:
+            return self.encode_cache.get(frame, info, profile)
+        self.encodes += 1
+        return profile.encode(frame)
+
+    def encode_stats(self) -> dict[str, int]:
+        """How many frames were encoded, how many times an encoded frame was reused, and how 
+        many frames were sent as repeats of the one before. With an `encode_cache`, the first 
+        two count for every stream sharing it.
+        """
+        if self.encode_cache is not None:
+            return {"encodes": self.encode_cache.encodes, "hits": self.encode_cache.hits, "repeats": self.repeats}
+        return {"encodes": self.encodes, "hits": 0, "repeats": self.repeats}
+
+    def client_stats(self) -> dict[str, list[dict[str, int]]]:
+        """Per-client send statistics (see `ClientWriter.stats`), for frame and match clients."""
+        with self.frame_connection_lock:
+            frames = [c.stats() for c in self.frame_connections]
+        with self.match_connection_lock:
+            matches = [c.stats() for c in self.match_connections]
+        return {"frames": frames, "matches": matches}
+
+    def can_pass_through(self) -> bool:
+        """Whether frames can be forwarded exactly as the camera compressed them, skipping both 
+        decoding and re-encoding. That's the case when nothing needs the pixels (no matcher 
+        with anyone listening), and every client wants JPEG at native size anyway. Passed 
+        through frames keep the camera's own quality, whatever the profiles say.
+        It also requires a source that can provide compressed frames at all, such as 
+        `CVCamera(passthrough=True)`.
+
+        This runs for every frame on the detect thread, so it only looks: adapting clients and 
+        expiring subscribers is left to the encode thread.
+        """
+        if self.source.pixel_formats()[0] != JPEG_FRAMES:
+            return False
+        if self.matcher is not None and len(self.match_connections) > 0:
+            return False
+        profiles = set()
+        with self.frame_connection_lock:
+            for w in self.frame_connections:
+                controller = self.controllers.get(w)
+                # passed through frames can't be made any cheaper
+                if controller is not None and controller.level > 0:
+                    return False
+                profiles.add(self.client_profiles.get(w, self.default_profile))
+            profiles.update(profile or self.default_profile for profile, _ in self.datagram_clients.values())
+        if self.multicast_group is not None:
+            profiles.add(self.default_profile)
+        native = tuple(self.source.frame_size())
+        return all(p.codec == JPEG and (p.size is None or p.size == native) for p in profiles)
 
+    def set_matcher(self, matcher: Callable[[np.ndarray], list[MatchData]], pixel_format: str = BGR):
+        """Sets the function used to find matches in each frame. `pixel_format` is the format the 
+        matcher wants its frames in, so a matcher that only needs luminance can ask for `GRAY`, 
+        which is free on sources that capture in YUV.
 
-    def set_matcher(self, matcher: Callable[[np.ndarray], list[MatchData]]):
+        With a `CameraGroup` source, the matcher gets the whole group, a tuple with one frame per 
+        camera, so it can fuse them. Video streams only the group's first camera, and the size in 
+        each match message is that of its frames.
+        """
+        if pixel_format not in self.source.pixel_formats():
+            raise ValueError(f"source can't provide {pixel_format} frames")
         self.matcher = matcher
+        self.matcher_format = pixel_format
 
     def set_match_visualizer(self, viz: Callable[[np.ndarray, list[MatchData]], np.ndarray]):
         self.match_visualizer = viz
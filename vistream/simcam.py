@@ -0,0 +1,293 @@
+import cv2 as cv
+import numpy as np
+import time
+import os
+from glob import glob
+
+from typing import Any, Optional
+
+from .camera import Camera, BGR, GRAY, YUV420, JPEG
+
+
+class PacedCamera(Camera):
+    """Base class for cameras that aren't backed by real hardware, and so need to decide for
+    themselves how quickly frames arrive.
+
+    When `realtime` is set, frames are produced at (up to) `fps`, like a real camera would.
+    Otherwise they are produced as fast as the consumer side of the pipeline allows, which is
+    what you want when benchmarking throughput.
+
+    Subclasses implement `_produce_frame_` instead of `_next_frame_`.
+    """
+    fps: float
+    realtime: bool
+    _frame_delay: float
+    _next_deadline: float
+
+    def __init__(self, fps: float = 30, realtime: bool = True, buffer_count: int = 4):
+        if fps <= 0:
+            raise ValueError(f"fps must be positive ({fps})")
+        self.fps = fps
+        self.realtime = realtime
+        self._frame_delay = 1 / fps
+        self._next_deadline = time.perf_counter()
+        super().__init__(buffer_count)
+
+    def _next_frame_(self, out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        if self.realtime:
+            delay = self._next_deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # schedule from the deadline rather than from now, so the rate doesn't drift, but
+            # don't try to catch up if we've fallen far behind
+            self._next_deadline = max(self._next_deadline + self._frame_delay, time.perf_counter())
+        return self._produce_frame_(out)
+
+    def _produce_frame_(self, out: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        raise NotImplementedError()
+
+
+def _fit(frame: np.ndarray, size: Optional[tuple[int, int]], out: Optional[np.ndarray]) -> np.ndarray:
+    if size is None or (frame.shape[1], frame.shape[0]) == tuple(size):
+        if out is None or out.shape != frame.shape:
+            return frame
+        np.copyto(out, frame)
+        return out
+    if out is not None and (out.shape[1], out.shape[0]) != tuple(size):
+        out = None
+    return cv.resize(frame, size, dst=out, interpolation=cv.INTER_AREA)
+
+
+class VideoFileCamera(PacedCamera):
+    """A camera that plays back a video file. Anything `cv.VideoCapture` can open works.
+
+    If `size` is given, frames are resized to it. `fps` defaults to the rate recorded in the file.
+    When the file ends, it starts over if `loop` is set, and otherwise the camera stops.
+    """
+    cam: cv.VideoCapture
+    path: str
+    size: Optional[tuple[int, int]]
+    loop: bool
+
+    def __init__(self, path: str, size: Optional[tuple[int, int]] = None, fps: Optional[float] = None, realtime: bool = True, loop: bool = True):
+        cam = cv.VideoCapture(path)
+        if not cam.isOpened():
+            raise ValueError(f"could not open video file '{path}'")
+        self.cam = cam
+        self.path = path
+        self.size = size
+        self.loop = loop
+        self._scratch = None
+        if fps is None:
+            fps = cam.get(cv.CAP_PROP_FPS)
+            if fps <= 0:
+                fps = 30
+        super().__init__(fps, realtime)
+
+    def _produce_frame_(self, out: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        target = out if self.size is None else self._scratch
+        ok, frame = self.cam.read(image=target)
+        if not ok and self.loop:
+            self.cam.set(cv.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.cam.read(image=target)
+        if not ok:
+            self._end_of_stream_()
+            return None
+        if self.size is None:
+            return frame
+        self._scratch = frame
+        return _fit(frame, self.size, out)
+
+    def _sensor_timestamp_(self) -> Optional[float]:
+        # position in the file, which is the closest thing a recording has to a sensor clock
+        return self.cam.get(cv.CAP_PROP_POS_MSEC) / 1000
+
+    def source(self) -> cv.VideoCapture:
+        return self.cam
+
+    def frame_size(self) -> tuple[int, int]:
+        if self.size is not None:
+            return tuple(self.size)
+        return (int(self.cam.get(cv.CAP_PROP_FRAME_WIDTH)), int(self.cam.get(cv.CAP_PROP_FRAME_HEIGHT)))
+
+    def stop(self):
+        super().stop()
+        self.cam.release()
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+class ImageDirectoryCamera(PacedCamera):
+    """A camera that cycles through the images in a directory, in name order.
+
+    Every image is resized to `size`, which defaults to the size of the first image. Images
+    are read from disk as they are needed, unless `preload` is set, in which case they are all
+    decoded up front so that disk and decode time don't show up in measurements.
+
+    With `passthrough`, JPEG files are served without being decoded, the way an MJPEG camera 
+    with `CVCamera(passthrough=True)` would. This requires every image to be a JPEG, and 
+    `size` to be left alone.
+    """
+    path: str
+    files: list[str]
+    size: tuple[int, int]
+    loop: bool
+    _index: int
+    _preloaded: Optional[list[np.ndarray]]
+
+    def __init__(self, path: str, size: Optional[tuple[int, int]] = None, fps: float = 30, realtime: bool = True, loop: bool = True, preload: bool = False, passthrough: bool = False):
+        files = sorted(f for f in glob(os.path.join(path, "*")) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if len(files) == 0:
+            raise ValueError(f"no images found in '{path}'")
+        self.path = path
+        self.files = files
+        self.loop = loop
+        self._index = 0
+
+        first = cv.imread(files[0])
+        if first is None:
+            raise ValueError(f"could not read image '{files[0]}'")
+        self.size = tuple(size) if size is not None else (first.shape[1], first.shape[0])
+        if passthrough:
+            if size is not None:
+                raise ValueError("passthrough frames can't be resized")
+            if not all(f.lower().endswith((".jpg", ".jpeg")) for f in files):
+                raise ValueError("passthrough requires every image to be a JPEG")
+            self.pixel_format = JPEG
+        self._preloaded = None
+        if preload:
+            self._preloaded = [self._load(f) for f in files]
+        super().__init__(fps, realtime)
+
+    def _load(self, filename: str) -> np.ndarray:
+        if self.encoded:
+            return self._read(filename)
+        return _fit(self._read(filename), self.size, None)
+
+    def _read(self, filename: str) -> np.ndarray:
+        if self.encoded:
+            return np.fromfile(filename, dtype=np.uint8)
+        img = cv.imread(filename)
+        if img is None:
+            raise ValueError(f"could not read image '{filename}'")
+        return img
+
+    def _produce_frame_(self, out: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        if self._index >= len(self.files):
+            if not self.loop:
+                self._end_of_stream_()
+                return None
+            self._index = 0
+        i = self._index
+        self._index += 1
+        if self.encoded:
+            return self._preloaded[i] if self._preloaded is not None else self._read(self.files[i])
+        if self._preloaded is not None:
+            return _fit(self._preloaded[i], None, out)
+        return _fit(self._read(self.files[i]), self.size, out)
+
+    def source(self) -> str:
+        return self.path
+
+    def frame_size(self) -> tuple[int, int]:
+        return self.size
+
+
+class PatternCamera(PacedCamera):
+    """A camera that generates its own frames, for testing without any hardware or files.
+
+    Available patterns are:
+        "shapes":   a gradient background with a few shapes moving across it
+        "noise":    uniform random noise in every channel, the worst case for compression
+        "markers":  AprilTag-like square markers (a black border around a 6x6 grid of bits)
+                    drifting across a white background
+
+    Frames are drawn directly into the camera's frame buffers, so generation itself doesn't
+    allocate once the buffer pool is warm. Setting `pixel_format` to `GRAY` or `YUV420` makes
+    the camera produce frames natively in that format, the way a sensor configured for it would.
+    """
+    patterns = ("shapes", "noise", "markers")
+
+    size: tuple[int, int]
+    pattern: str
+    marker_count: int
+    _step: int
+    _rng: np.random.Generator
+
+    def __init__(self, size: tuple[int, int] = (640, 480), pattern: str = "shapes", fps: float = 30, realtime: bool = True, marker_count: int = 3, seed: Optional[int] = None, pixel_format: str = BGR):
+        if pattern not in PatternCamera.patterns:
+            raise ValueError(f"unknown pattern '{pattern}' (expected one of {', '.join(PatternCamera.patterns)})")
+        if pixel_format not in (BGR, GRAY, YUV420):
+            raise ValueError(f"pattern cameras can't produce {pixel_format} frames")
+        self.pixel_format = pixel_format
+        self._canvas = None
+        self.size = tuple(size)
+        self.pattern = pattern
+        self.marker_count = marker_count
+        self._step = 0
+        self._rng = np.random.default_rng(seed)
+
+        w, h = self.size
+        gradient = np.linspace(40, 200, w, dtype=np.float32)
+        self._background = np.empty((h, w, 3), dtype=np.uint8)
+        self._background[:] = gradient.astype(np.uint8)[None, :, None]
+        self._markers = [self._make_marker() for _ in range(marker_count)]
+        self._marker_origins = [(self._rng.uniform(0, w), self._rng.uniform(0, h)) for _ in range(marker_count)]
+        self._marker_velocities = [tuple(self._rng.uniform(-3, 3, size=2)) for _ in range(marker_count)]
+        super().__init__(fps, realtime)
+
+    def _make_marker(self) -> np.ndarray:
+        # 10x10 cells: a white quiet zone, a black border, and the 6x6 payload
+        cells = np.full((10, 10), 255, dtype=np.uint8)
+        cells[1:9, 1:9] = 0
+        cells[2:8, 2:8] = self._rng.integers(0, 2, size=(6, 6), dtype=np.uint8) * 255
+        side = max(10, min(self.size) // 5)
+        return cv.resize(cells, (side, side), interpolation=cv.INTER_NEAREST)
+
+    def _produce_frame_(self, out: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        if self.pixel_format == BGR:
+            return self._draw(out)
+        # draw in colour on a canvas we keep around, then convert into the frame buffer
+        w, h = self.size
+        self._canvas = self._draw(self._canvas)
+        shape = (h, w) if self.pixel_format == GRAY else (h * 3 // 2, w)
+        if out is None or out.shape != shape:
+            out = np.empty(shape, dtype=np.uint8)
+        code = cv.COLOR_BGR2GRAY if self.pixel_format == GRAY else cv.COLOR_BGR2YUV_I420
+        return cv.cvtColor(self._canvas, code, dst=out)
+
+    def _draw(self, out: Optional[np.ndarray]) -> np.ndarray:
+        w, h = self.size
+        if out is None or out.shape != (h, w, 3):
+            out = np.empty((h, w, 3), dtype=np.uint8)
+        t = self._step
+        self._step += 1
+
+        if self.pattern == "noise":
+            cv.randu(out, 0, 256)
+        elif self.pattern == "shapes":
+            np.copyto(out, self._background)
+            r = max(4, min(w, h) // 10)
+            cx = int((t * 4) % (w + 2*r)) - r
+            cy = h // 2 + int(h / 4 * np.sin(t / 15))
+            cv.circle(out, (cx, cy), r, (0, 0, 255), -1)
+            rx = w - 1 - int((t * 3) % (w + 2*r)) + r
+            ry = h // 4
+            cv.rectangle(out, (rx - r, ry - r), (rx + r, ry + r), (255, 128, 0), -1)
+            cv.putText(out, str(t), (8, h - 8), cv.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        else:
+            out[:] = 255
+            for marker, (ox, oy), (vx, vy) in zip(self._markers, self._marker_origins, self._marker_velocities):
+                side = marker.shape[0]
+                # bounce around inside the frame
+                x = int(abs((ox + vx * t) % (2 * max(1, w - side)) - max(1, w - side)))
+                y = int(abs((oy + vy * t) % (2 * max(1, h - side)) - max(1, h - side)))
+                region = out[y:y+side, x:x+side]
+                region[:] = marker[:region.shape[0], :region.shape[1], None]
+        return out
+
+    def source(self) -> Any:
+        return self
+
+    def frame_size(self) -> tuple[int, int]:
+        return self.size
@@ -40,6 +40,13 @@ class BufferedSocket:
         readables, _, _ = select.select(reads, [], [])
         return len(readables) == 1
 
+    def has_pending(self) -> bool:
+        """Whether there's anything to read right now, without waiting for it."""
+        if len(self.read_buffer) > 0:
+            return True
+        readables, _, _ = select.select([self.sock], [], [], 0)
+        return len(readables) == 1
+
     def peek(self, n: int) -> Optional[bytes]:
         if len(self.read_buffer) >= n:
             return bytes(self.read_buffer[:n])
@@ -72,11 +79,13 @@ class BufferedSocket:
 
     def _write(self) -> bool:
         total_sent = 0
-        while total_sent < len(self.write_buffer):
-            sent = self.sock.send(self.write_buffer[total_sent:])
-            if sent == 0:
-                return False
-            total_sent += sent
+        # a view, so that partial sends don't copy what's left of the buffer
+        with memoryview(self.write_buffer) as pending:
+            while total_sent < len(pending):
+                sent = self.sock.send(pending[total_sent:])
+                if sent == 0:
+                    return False
+                total_sent += sent
         self.write_buffer = bytearray()
         return True
 
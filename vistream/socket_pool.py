@@ -1,40 +1,101 @@
 from threading import Lock
 import socket
+import os
+import tempfile
 from collections import deque
 
 from typing import Optional
 
-# This whole thing is a problem if the model shifts to being a process per stream group
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where ports are only ever tracked within the process
+    fcntl = None
+
+
+DEFAULT_LOCK_DIR = os.path.join(os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir()), "vistream-ports")
+
 class SocketPool:
+    """Hands out listening sockets from a range of ports.
+
+    Pools in different processes (stream groups run by a `Supervisor`, for instance) can share a
+    range: every port handed out is also claimed with an exclusive `flock` on a lock file in
+    `lock_dir`, so no two pools ever hand out the same port. The operating system releases
+    those locks when a process exits, however it exits, so a crashed process never leaves its
+    ports claimed. Pass `lock_dir=None` to only keep track within this process.
+    """
     available_ports: deque[int]
     availability_lock: Lock
     port_range: range
     sockets: dict[int, socket.socket]
+    lock_dir: Optional[str]
 
 
-    def __init__(self, start: int, end: int):
+    def __init__(self, start: int, end: int, lock_dir: Optional[str] = DEFAULT_LOCK_DIR):
         self.port_range = range(start, end+1)
         self.available_ports = deque(self.port_range)
         self.availability_lock = Lock()
         self.sockets = {}
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self._port_locks = {}
+        if self.lock_dir is not None:
+            os.makedirs(self.lock_dir, exist_ok=True)
 
     def allocate(self, port: Optional[int]) -> Optional[socket.socket]:
         with self.availability_lock:
             if len(self.available_ports) == 0 or port is not None and port not in self.available_ports:
                 return None
-            elif port in self.available_ports:
-                self.available_ports.remove(port)
-            else:  
-                port = self.available_ports.popleft()
-        
+            candidates = [port] if port is not None else list(self.available_ports)
+            for p in candidates:
+                # ports another process holds stay in the queue, they may come free later
+                if self._claim(p):
+                    self.available_ports.remove(p)
+                    port = p
+                    break
+            else:
+                return None
+
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(("", port))
+        # streams close their clients when they stop, which leaves the port in TIME_WAIT for a
+        # while. Without this, the port couldn't be used again until that runs out.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("", port))
+        except OSError:
+            s.close()
+            with self.availability_lock:
+                self._unclaim(port)
+                self.available_ports.append(port)
+            raise
 
         self.sockets[port] = s
         print(f"port {port} allocated")
 
         return s
 
+    def _claim(self, port: int) -> bool:
+        if self.lock_dir is None:
+            return True
+        try:
+            fd = os.open(os.path.join(self.lock_dir, f"{port}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+        except PermissionError:
+            # another user's process made the lock file, and may well be holding the port
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._port_locks[port] = fd
+        return True
+
+    def _unclaim(self, port: int):
+        fd = self._port_locks.pop(port, None)
+        if fd is not None:
+            # closing the file is enough to release the lock, and the file itself stays for
+            # the next claim, since removing it would race with other processes opening it
+            os.close(fd)
+
     def deallocate(self, port) -> bool:
         # technically not thread safe right here, but so vanishingly rare that we won't worry about it for now
         print(f"deallocating port {port}")
@@ -49,6 +110,7 @@ class SocketPool:
             with self.availability_lock:
                 self.available_ports.append(port)
                 del self.sockets[port]
+                self._unclaim(port)
             return True
 
         return True
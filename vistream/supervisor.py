@@ -0,0 +1,169 @@
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from threading import Thread, Lock, Event
+import time
+
+from typing import Any, Optional, Callable
+
+from .server import MatchStream
+from .socket_pool import SocketPool, DEFAULT_LOCK_DIR
+
+
+def _run_group(build: Callable[..., list[MatchStream]], args: tuple, port_range: tuple[int, int], lock_dir: Optional[str], stop: Any):
+    """Group process body. The pool here shares its ports with every other group's through the
+    lock files, so streams can ask for specific ports or take whichever is free.
+    """
+    MatchStream.socket_pool = SocketPool(*port_range, lock_dir=lock_dir)
+    streams = []
+    try:
+        streams = build(*args)
+        for s in streams:
+            s.start()
+        stop.wait()
+    finally:
+        for s in streams:
+            s.stop()
+            s.source.stop()
+        MatchStream.socket_pool.collapse()
+
+
+class _Group:
+    name: str
+    build: Callable[..., list[MatchStream]]
+    args: tuple
+    process: Optional[Any]
+    stop_call: Any
+    restarts: int
+    started_at: float
+    restart_at: Optional[float]
+    restart_delay: float
+
+    def __init__(self, name: str, build: Callable[..., list[MatchStream]], args: tuple, restart_delay: float):
+        self.name = name
+        self.build = build
+        self.args = args
+        self.process = None
+        self.stop_call = None
+        self.restarts = 0
+        self.started_at = 0
+        self.restart_at = None
+        self.restart_delay = restart_delay
+
+
+class Supervisor:
+    """Runs groups of streams in processes of their own, so each group gets its own interpreter
+    (and GIL), and matchers written in Python can use as many cores as there are groups.
+
+    A group is a function that builds a list of (not yet started) `MatchStream`s, along with the
+    cameras they use, inside the group's process. With the default "spawn" start method it has
+    to be importable, so a module level function, and its arguments must pickle. The
+    supervisor starts every group's streams, and stops them and their sources when it stops.
+
+    All groups allocate ports from `port_range` (first, last), coordinated through lock files in
+    `lock_dir`, see `SocketPool`. A group whose process dies is started again after
+    `restart_delay` seconds, doubling up to `max_restart_delay` while it keeps dying within
+    `stable_after` seconds of starting. Its ports are released by the operating system when it
+    dies, so the new process can pick them right back up.
+    """
+    port_range: tuple[int, int]
+    lock_dir: Optional[str]
+    restart_delay: float
+    max_restart_delay: float
+    stable_after: float
+    groups: dict[str, _Group]
+    groups_lock: Lock
+    monitor: Thread
+    terminate_call: Event
+
+    def __init__(self, port_range: tuple[int, int], lock_dir: Optional[str] = DEFAULT_LOCK_DIR, restart_delay: float = 1.0,
+                 max_restart_delay: float = 30.0, stable_after: float = 10.0, start_method: str = "spawn"):
+        if lock_dir is None:
+            raise ValueError("groups in separate processes need a lock directory to share ports")
+        self.port_range = port_range
+        self.lock_dir = lock_dir
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.groups = {}
+        self.groups_lock = Lock()
+        self.terminate_call = Event()
+        self._context = mp.get_context(start_method)
+        self.monitor = Thread(target=self._monitor)
+
+    def add_group(self, name: str, build: Callable[..., list[MatchStream]], *args: Any):
+        """Adds a group that runs `build(*args)` in its own process. Groups added after `start`
+        are started right away.
+        """
+        with self.groups_lock:
+            if name in self.groups:
+                raise ValueError(f"there already is a group called '{name}'")
+            group = _Group(name, build, args, self.restart_delay)
+            self.groups[name] = group
+            if self.monitor.is_alive():
+                self._launch(group)
+
+    def _launch(self, group: _Group):
+        group.stop_call = self._context.Event()
+        group.process = self._context.Process(target=_run_group, name=f"vistream-{group.name}",
+                                              args=(group.build, group.args, self.port_range, self.lock_dir, group.stop_call))
+        group.process.start()
+        group.started_at = time.monotonic()
+        group.restart_at = None
+
+    def start(self):
+        if self.terminate_call.is_set():
+            raise ValueError("cannot restart a terminated supervisor")
+        with self.groups_lock:
+            for group in self.groups.values():
+                self._launch(group)
+        self.monitor.start()
+
+    def _monitor(self):
+        while not self.terminate_call.is_set():
+            with self.groups_lock:
+                running = [g.process.sentinel for g in self.groups.values() if g.process is not None]
+            # wakes as soon as any group's process exits
+            wait(running, timeout=0.5)
+            if self.terminate_call.is_set():
+                break
+            now = time.monotonic()
+            with self.groups_lock:
+                for group in self.groups.values():
+                    if group.process is not None and not group.process.is_alive():
+                        if now - group.started_at > self.stable_after:
+                            group.restart_delay = self.restart_delay
+                        print(f"stream group '{group.name}' exited with code {group.process.exitcode}, restarting in {group.restart_delay:g}s")
+                        group.restart_at = now + group.restart_delay
+                        group.restart_delay = min(self.max_restart_delay, group.restart_delay * 2)
+                        group.process = None
+                    elif group.process is None and group.restart_at is not None and now >= group.restart_at:
+                        group.restarts += 1
+                        self._launch(group)
+
+    def stop(self, timeout: float = 5.0):
+        """Stops every group, giving each `timeout` seconds to shut down cleanly before its
+        process is terminated.
+        """
+        if self.terminate_call.is_set():
+            return
+        self.terminate_call.set()
+        if self.monitor.is_alive():
+            self.monitor.join()
+        with self.groups_lock:
+            groups = [g for g in self.groups.values() if g.process is not None]
+        for g in groups:
+            g.stop_call.set()
+        for g in groups:
+            g.process.join(timeout)
+            if g.process.is_alive():
+                print(f"stream group '{g.name}' did not stop in time, terminating it")
+                g.process.terminate()
+                g.process.join()
+
+    def status(self) -> dict[str, dict[str, Any]]:
+        """Whether each group is running, its process id, and how often it was restarted."""
+        with self.groups_lock:
+            return {name: {"running": g.process is not None and g.process.is_alive(),
+                           "pid": None if g.process is None else g.process.pid,
+                           "restarts": g.restarts}
+                    for name, g in self.groups.items()}
@@ -0,0 +1,144 @@
+import socket
+import bitstring as bs
+from dataclasses import replace
+
+from typing import Any, Optional
+
+from .message import MessageHeader, FRAME, split_header
+
+
+# Frames sent over UDP are split into fragments that each fit in one datagram. Every fragment
+# carries the message's sequence number, its own index and the number of fragments in the 
+# frame, so they can be put back together in whatever order they arrive. The sequence number 
+# rather than the frame id tells messages apart, since a frame may be sent again later (see 
+# `RESENT`). The frame's `MessageHeader` rides along in every fragment, so it doesn't matter 
+# which ones make it.
+FRAGMENT_MAGIC_FLAG = bs.Bits(hex="f7a6e0d1", length=32).bytes
+FRAGMENT_LAYOUT = ["uintbe32", "uintbe16", "uintbe16"] # message sequence number, fragment index, fragment count
+FRAGMENT_LAYOUT_LENGTH = 8
+FRAGMENT_HEADER_LENGTH = len(FRAGMENT_MAGIC_FLAG) + FRAGMENT_LAYOUT_LENGTH + MessageHeader.byte_length
+
+# Fits in a standard 1500 byte ethernet frame, with room to spare for IP and UDP headers, so
+# fragments never get fragmented again on the way
+DEFAULT_DATAGRAM_SIZE = 1400
+
+def fragment_frame(image: Any, header: MessageHeader, datagram_size: int = DEFAULT_DATAGRAM_SIZE) -> list[list[memoryview]]:
+    """Splits an encoded image into datagrams of at most `datagram_size` bytes. Each one is a
+    header and a view into the image, see `encoded_frame_segments`.
+    """
+    payload_size = datagram_size - FRAGMENT_HEADER_LENGTH
+    if payload_size <= 0:
+        raise ValueError(f"datagrams must be longer than the {FRAGMENT_HEADER_LENGTH} byte fragment header ({datagram_size})")
+    image = memoryview(image).cast("B")
+    count = max(1, -(-len(image) // payload_size))
+    if count >= 1 << 16:
+        raise ValueError(f"frame of {len(image)} bytes needs too many fragments ({count})")
+    header_bytes = replace(header, kind = FRAME, length = len(image)).to_bytes()
+    sequence = header.sequence & 0xFFFFFFFF
+    fragments = []
+    for i in range(count):
+        prefix = bytearray(FRAGMENT_MAGIC_FLAG)
+        prefix.extend(bs.pack(FRAGMENT_LAYOUT, sequence, i, count).bytes)
+        prefix.extend(header_bytes)
+        fragments.append([memoryview(prefix), image[i * payload_size:(i + 1) * payload_size]])
+    return fragments
+
+_RESTART_RUN = 64
+
+def _newer(a: int, b: int) -> bool:
+    # sequence numbers wrap around, so compare them the way TCP does
+    return 0 < (a - b) & 0xFFFFFFFF < 1 << 31
+
+class FrameReassembler:
+    """Puts frames back together from their fragments.
+
+    Only one frame is ever being assembled, and the newest one wins: as soon as a fragment of a
+    newer message arrives, whatever is left of the current one is discarded, and fragments of
+    older messages are ignored. Newer goes by sequence number, so a frame that was resent 
+    counts as new, however old the frame itself is. A lost fragment therefore costs at most the one frame it was in,
+    and never holds up the frames after it.
+    """
+    completed: int
+    discarded: int # frames abandoned because a newer one started before they were complete
+    late: int # fragments of messages that had already been completed or abandoned
+
+    def __init__(self):
+        self.completed = 0
+        self.discarded = 0
+        self.late = 0
+        self._sequence = None
+        self._done = False
+        self._fragments = []
+        self._missing = 0
+        self._late_run = 0
+
+    def add(self, datagram: bytes) -> Optional[tuple[bytes, MessageHeader]]:
+        """Adds one datagram, and returns the image and header of the frame it completes, if 
+        any. Datagrams that aren't fragments are ignored.
+        """
+        if len(datagram) < FRAGMENT_HEADER_LENGTH or datagram[:len(FRAGMENT_MAGIC_FLAG)] != FRAGMENT_MAGIC_FLAG:
+            return None
+        header_end = len(FRAGMENT_MAGIC_FLAG) + FRAGMENT_LAYOUT_LENGTH
+        sequence, index, count = bs.Bits(bytes=datagram[len(FRAGMENT_MAGIC_FLAG):header_end]).unpack(FRAGMENT_LAYOUT)
+        # headers of later versions may be longer, and say so themselves
+        payload_start = header_end + datagram[header_end + 1]
+        if count == 0 or index >= count or payload_start > len(datagram):
+            return None
+
+        # A long run of nothing but old messages means the server started over with its 
+        # sequence numbers, rather than that the network is reordering things
+        if self._sequence is None or _newer(sequence, self._sequence) or self._late_run >= _RESTART_RUN:
+            if self._sequence is not None and not self._done:
+                self.discarded += 1
+            self._sequence = sequence
+            self._done = False
+            self._fragments = [None] * count
+            self._missing = count
+            self._late_run = 0
+        elif sequence != self._sequence or self._done:
+            self.late += 1
+            self._late_run += 1
+            return None
+        self._late_run = 0
+        if count != len(self._fragments):
+            return None
+
+        if self._fragments[index] is None:
+            self._fragments[index] = datagram[payload_start:]
+            self._missing -= 1
+        if self._missing > 0:
+            return None
+        self._done = True
+        self.completed += 1
+        image = b"".join(self._fragments)
+        self._fragments = []
+        res = split_header(datagram[header_end:])
+        return None if res is None else (image, res[0])
+
+    def stats(self) -> dict[str, int]:
+        return {"completed": self.completed, "discarded": self.discarded, "late": self.late}
+
+def send_fragments(sock: socket.socket, fragments: list[list[memoryview]], address: tuple[str, int]) -> bool:
+    """Sends every fragment of a frame to `address` from a non-blocking `sock`. If the socket
+    runs out of room partway, the rest of the frame is dropped, since it would be worthless
+    once the next frame is out anyway. Returns whether the whole frame went out.
+    """
+    for f in fragments:
+        try:
+            sock.sendmsg(f, [], 0, address)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError as e:
+            print(f"could not send frame to {address}: {e}")
+            return False
+    return True
+
+def multicast_membership(group: str, interface: Optional[str] = None) -> bytes:
+    """The `IP_ADD_MEMBERSHIP` option value for joining `group` on `interface` (any, by default)."""
+    return socket.inet_aton(group) + socket.inet_aton(interface or "0.0.0.0")
+
+# Datagram clients have no connection that could tell the server they're gone, so they repeat
+# their subscription every `DATAGRAM_KEEPALIVE` seconds, and the server forgets them after
+# `DATAGRAM_CLIENT_TIMEOUT` seconds without one.
+DATAGRAM_KEEPALIVE = 1.0
+DATAGRAM_CLIENT_TIMEOUT = 5.0
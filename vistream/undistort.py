@@ -0,0 +1,119 @@
+import cv2 as cv
+import numpy as np
+import hashlib
+import os
+
+from typing import Optional
+
+from .buffer_pool import BufferPool
+from .layers import BufferedLayer
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "vistream", "undistort")
+
+class UndistortLayer(BufferedLayer):
+    """A `ProcessedCamera` layer that removes lens distortion, given the camera matrix `K` and
+    distortion coefficients `D` from a calibration, and the `size` the frames were calibrated at.
+    Set `fisheye` for coefficients from `cv.fisheye.calibrate`, otherwise they're taken to be
+    for the regular pinhole model. `new_K` is the camera matrix of the undistorted frames, and
+    defaults to `K`.
+
+    The remap tables only depend on the calibration, so they are computed once, in the compact
+    fixed-point `CV_16SC2` form, and each frame costs a single `cv.remap`. Tables are also saved
+    to `cache_dir` (unless it's `None`), keyed by a hash of the calibration and the size, and
+    later instances memory map them from there instead of recomputing them.
+
+    When called directly, output frames come from a `BufferPool` of `buffer_count` buffers, so
+    they're safe to hold on to, same as camera frames. In a `ProcessedCamera`, the camera
+    provides the buffers instead.
+    """
+    K: np.ndarray
+    D: np.ndarray
+    new_K: np.ndarray
+    size: tuple[int, int]
+    fisheye: bool
+    interpolation: int
+    cache_dir: Optional[str]
+    buffer_count: int
+
+    map1: np.ndarray
+    map2: np.ndarray
+    buffer_pool: BufferPool
+
+    def __init__(self, K: np.ndarray, D: np.ndarray, size: tuple[int, int], fisheye: bool = False, new_K: Optional[np.ndarray] = None,
+                 interpolation: int = cv.INTER_LINEAR, cache_dir: Optional[str] = DEFAULT_CACHE_DIR, buffer_count: int = 4):
+        self.K = np.asarray(K, dtype=np.float64).reshape(3, 3)
+        self.D = np.asarray(D, dtype=np.float64).reshape(-1, 1)
+        if fisheye and self.D.shape[0] != 4:
+            raise ValueError(f"fisheye calibrations have 4 distortion coefficients, not {self.D.shape[0]}")
+        self.new_K = self.K if new_K is None else np.asarray(new_K, dtype=np.float64).reshape(3, 3)
+        self.size = (int(size[0]), int(size[1]))
+        self.fisheye = fisheye
+        self.interpolation = interpolation
+        self.cache_dir = cache_dir
+        self.buffer_count = buffer_count
+        self._setup()
+
+    def _setup(self):
+        self.buffer_pool = BufferPool(self.buffer_count)
+        self.map1, self.map2 = self._load_maps()
+
+    def calibration_key(self) -> str:
+        """Identifies the remap tables: the same calibration at the same size gives the same key."""
+        digest = hashlib.sha1()
+        digest.update(b"fisheye" if self.fisheye else b"pinhole")
+        for a in (self.K, self.D, self.new_K):
+            digest.update(np.ascontiguousarray(a).tobytes())
+        return f"{digest.hexdigest()[:16]}-{self.size[0]}x{self.size[1]}"
+
+    def _load_maps(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.cache_dir is None:
+            return self._compute_maps()
+        base = os.path.join(self.cache_dir, self.calibration_key())
+        paths = (base + ".map1.npy", base + ".map2.npy")
+        w, h = self.size
+        try:
+            maps = tuple(np.load(p, mmap_mode="r") for p in paths)
+            if maps[0].shape == (h, w, 2) and maps[1].shape == (h, w):
+                return maps
+        except (OSError, ValueError):
+            pass
+
+        maps = self._compute_maps()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for p, m in zip(paths, maps):
+                # write under another name first, so a half written table is never picked up
+                tmp = f"{p}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    np.save(f, m)
+                os.replace(tmp, p)
+        except OSError as e:
+            print(f"could not cache undistortion maps in '{self.cache_dir}': {e}")
+        return maps
+
+    def _compute_maps(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.fisheye:
+            return cv.fisheye.initUndistortRectifyMap(self.K, self.D, np.eye(3), self.new_K, self.size, cv.CV_16SC2)
+        return cv.initUndistortRectifyMap(self.K, self.D, np.eye(3), self.new_K, self.size, cv.CV_16SC2)
+
+    def output_spec(self, shape: tuple[int, ...], dtype: np.dtype) -> tuple[tuple[int, ...], np.dtype]:
+        return (self.size[1], self.size[0]) + tuple(shape[2:]), dtype
+
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return cv.remap(src, self.map1, self.map2, self.interpolation, dst=dst, borderMode=cv.BORDER_CONSTANT)
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        return self.apply(frame, self.buffer_pool.acquire(*self.output_spec(frame.shape, frame.dtype)))
+
+    def __getstate__(self) -> dict:
+        # For `ProcessPoolCamera`, which pickles its layers. Workers load the tables themselves
+        # (from the cache, usually), rather than having them copied over.
+        state = self.__dict__.copy()
+        for name in ("map1", "map2", "buffer_pool"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._setup()